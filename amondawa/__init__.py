@@ -20,8 +20,29 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
 # IN THE SOFTWARE.
 
-from boto import dynamodb2
+import os
+
+# storage backend: 'dynamodb' (default), 'local' (embedded SQLite database
+# in AMDW_DATA_DIR) or 'memory' (process memory, for benchmarks)
+BACKEND = os.environ.get('AMDW_BACKEND', 'dynamodb')
+DATA_DIR = os.environ.get('AMDW_DATA_DIR', os.path.expanduser('~/.amondawa'))
+# asynchronous (gevent) serving, set by bin/serve --gevent: requests in flight
+# and outstanding backend calls per process
+ASYNC = os.environ.get('AMDW_ASYNC') == 'gevent'
+CONNECTIONS = int(os.environ.get('AMDW_CONNECTIONS', 1000))
+BACKEND_CALLS = int(os.environ.get('AMDW_BACKEND_CALLS', 100))
 
 
 def connect(region):
-    return dynamodb2.connect_to_region(region)
+    """Connect to the configured storage backend.
+    """
+    from amondawa import storage
+    if ASYNC:
+        storage.limit_calls(BACKEND_CALLS)
+    if BACKEND == 'local':
+        return storage.SQLiteBackend(DATA_DIR)
+    if BACKEND == 'memory':
+        return storage.MemoryBackend.shared()
+    if BACKEND != 'dynamodb':
+        raise ValueError('unknown storage backend: %s' % BACKEND)
+    return storage.DynamoDBBackend.connect(region)
@@ -0,0 +1,219 @@
+# Copyright (c) 2013 Daniel Gardner
+# All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""
+Per domain admission control and fair scheduling.
+
+Requests of a domain are admitted while the domain is under its concurrency
+limit (requests in progress) and its token bucket (queries or datapoints per
+second) holds the request's tokens; others are refused (HTTP 429).  Limits are per node:
+rates and concurrency are shared out between a node's server processes.
+
+Datapoints fetches of the domains are queued into the reader pool by start
+time fair queuing: a domain's fetches are served in proportion to its weight
+whatever the length of its queue.  (The batch writers flush buffers mixing
+domains, so ingest is only bounded at admission.)
+"""
+
+from amondawa import config
+from concurrent.futures import Future
+from threading import Condition, Lock, Thread, current_thread
+
+import heapq
+import itertools
+import math
+import sys
+import time
+
+READ, WRITE = 'read', 'write'
+
+
+class TokenBucket(object):
+    """A token bucket of rate tokens per second holding up to burst tokens.
+     A take larger than the burst is allowed once the bucket is full (leaving
+     it in debt).
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.tokens = self.burst
+        self.last = time.time()
+
+    def take(self, n=1):
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens < min(n, self.burst):
+            return False
+        self.tokens -= n
+        return True
+
+
+class Admission(object):
+    """Per domain concurrency limits and token buckets of reads (queries) and
+     writes (datapoints).
+    """
+
+    def __init__(self, workers=1):
+        self.workers = workers
+        self.lock = Lock()
+        # (domain, kind) -> TokenBucket
+        self.buckets = {}
+        # (domain, kind) -> requests in progress
+        self.active = {}
+
+    def limits(self, domain, kind):
+        """(rate, concurrency) of domain for kind (READ or WRITE), 0 if
+           unlimited, for this process.
+        """
+        c = config.get()
+        limits = c.AD_DOMAINS.get(domain) or {}
+        rate = float(limits.get('%s_rate' % kind, getattr(c, 'AD_%s_RATE' % kind.upper())))
+        concurrency = int(limits.get('%s_concurrency' % kind, getattr(c, 'AD_%s_CONCURRENCY' % kind.upper())))
+        return rate / self.workers, int(math.ceil(float(concurrency) / self.workers))
+
+    def admit(self, domain, kind, cost=1):
+        """Start a request of domain costing cost tokens; return False (the
+           request is refused) if the domain is over its limits.  An admitted
+           request must be released.
+        """
+        rate, concurrency = self.limits(domain, kind)
+        key = (domain, kind)
+        with self.lock:
+            if concurrency and self.active.get(key, 0) >= concurrency:
+                return False
+            if cost and not self._take(key, rate, cost):
+                return False
+            self.active[key] = self.active.get(key, 0) + 1
+            return True
+
+    def take(self, domain, kind, cost):
+        """Take cost tokens for an admitted request (e.g. once its size is
+           known); return False if the domain's bucket is short of them.
+        """
+        rate, _ = self.limits(domain, kind)
+        with self.lock:
+            return self._take((domain, kind), rate, cost)
+
+    def release(self, domain, kind):
+        key = (domain, kind)
+        with self.lock:
+            self.active[key] -= 1
+            if not self.active[key]:
+                del self.active[key]
+
+    def _take(self, key, rate, cost):
+        if not rate:
+            return True
+        bucket = self.buckets.get(key)
+        if bucket is None or bucket.rate != rate:
+            bucket = self.buckets[key] = TokenBucket(rate)
+        return bucket.take(cost)
+
+
+def weight(domain):
+    """Fair queuing weight of domain.
+    """
+    return float((config.get().AD_DOMAINS.get(domain) or {}).get('weight', 1))
+
+
+class FairExecutor(object):
+    """An executor running tasks of domains in start time fair queuing order
+     on up to workers threads (started as needed).
+    """
+
+    def __init__(self, workers, weight=weight):
+        self.workers = workers
+        self.weight = weight
+        self.cond = Condition(Lock())
+        self.heap = []
+        self.seq = itertools.count()
+        # domain -> finish tag of its last queued task
+        self.finish = {}
+        self.vtime = 0.
+        self.threads = []
+        self.idle = 0
+
+    def submit(self, fn, *args):
+        return self.submit_for(None, fn, *args)
+
+    def submit_for(self, domain, fn, *args):
+        """Queue fn(*args) for domain; return its future.
+        """
+        future = Future()
+        with self.cond:
+            tag = max(self.vtime, self.finish.get(domain, 0.)) + 1. / self.weight(domain)
+            self.finish[domain] = tag
+            heapq.heappush(self.heap, (tag, next(self.seq), future, fn, args))
+            if len(self.heap) <= self.idle:
+                self.cond.notify()
+            elif len(self.threads) < self.workers:
+                thread = Thread(target=self._work)
+                thread.daemon = True
+                self.threads.append(thread)
+                thread.start()
+        return future
+
+    def domain(self, domain):
+        """An executor (submit only) queuing tasks for domain.
+        """
+        return DomainExecutor(self, domain)
+
+    def resize(self, workers):
+        """Run on up to workers threads (excess threads exit when idle).
+        """
+        with self.cond:
+            self.workers = workers
+            self.cond.notify_all()
+
+    def _work(self):
+        while True:
+            with self.cond:
+                while not self.heap:
+                    if len(self.threads) > self.workers:
+                        self.threads.remove(current_thread())
+                        return
+                    self.idle += 1
+                    self.cond.wait()
+                    self.idle -= 1
+                tag, _, future, fn, args = heapq.heappop(self.heap)
+                self.vtime = tag
+                if not self.heap:
+                    self.finish.clear()   # all finish tags are behind vtime
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = fn(*args)
+            except BaseException:
+                future.set_exception_info(*sys.exc_info()[1:])
+            else:
+                future.set_result(result)
+
+
+class DomainExecutor(object):
+    def __init__(self, executor, domain):
+        self.executor = executor
+        self.domain = domain
+
+    def submit(self, fn, *args):
+        return self.executor.submit_for(self.domain, fn, *args)
@@ -0,0 +1,204 @@
+# Copyright (c) 2013 Daniel Gardner
+# All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""
+Local archive of expired blocks.
+
+Before a block's tables are deleted its columns are exported to one file
+per block (<directory>/block_<tbase>.amda):
+
+  columns     zlib compressed column data, one after the other
+  index       JSON: {'keys': {domain_metric: [tbase_tags, ...]},
+                     'columns': {datapoints key: [offset, length, kind]}}
+  footer      index offset (uint64), 'AMDA'
+
+Numeric columns (kind 'f') hold int64 toffsets followed by float64 values;
+other columns (kind 'j') are stored as compaction chunks.  Archive files are
+memory-mapped and only the columns a query reads are decompressed.
+"""
+
+from amondawa import compaction
+from amondawa.util import IndexKey
+from decimal import Decimal
+from threading import Lock
+
+import json
+import mmap
+import numpy as np
+import os
+import re
+import struct
+import zlib
+
+MAGIC = 'AMDA'
+FOOTER = struct.Struct('<Q4s')
+FILENAME = re.compile(r'^block_(\d+)\.amda$')
+
+
+class ArchivedIndexKey(IndexKey):
+    """Index key of a column in an archived block.
+    """
+
+    def __init__(self, key, block_tbase):
+        super(ArchivedIndexKey, self).__init__(key)
+        self.block_tbase = block_tbase
+
+
+class ArchiveFile(object):
+    """A memory-mapped archive file.
+    """
+
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        offset, magic = FOOTER.unpack_from(self.mm, len(self.mm) - FOOTER.size)
+        if magic != MAGIC:
+            raise ValueError('not an archive file: %s' % path)
+        index = json.loads(self.mm[offset:len(self.mm) - FOOTER.size])
+        self.keys_, self.columns = index['keys'], index['columns']
+
+    def keys(self, domain_metric):
+        """Index keys of the columns of a metric.
+        """
+        return [{'domain_metric': domain_metric, 'tbase_tags': tbase_tags}
+                for tbase_tags in self.keys_.get(domain_metric, [])]
+
+    def read(self, key):
+        """Return the (toffset, value) of a column (datapoints key), ascending.
+        """
+        column = self.columns.get(key)
+        if column is None:
+            return []
+        offset, length, kind = column
+        data = self.mm[offset:offset + length]
+        if kind == 'j':
+            return compaction.decode(data)
+        data = zlib.decompress(data)
+        n = len(data) / 16
+        return zip(np.frombuffer(data, '<i8', n).tolist(), np.frombuffer(data, '<f8', n, 8 * n).tolist())
+
+    def close(self):
+        self.mm.close()
+        self.file.close()
+
+
+class Archive(object):
+    """Archive files of expired blocks in directory.
+    """
+
+    def __init__(self, directory, block_size):
+        self.directory = directory
+        self.block_size = block_size
+        self.lock = Lock()
+        self.files = {}
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def path(self, tbase):
+        return os.path.join(self.directory, 'block_%d.amda' % tbase)
+
+    def blocks(self):
+        """Base times of archived blocks.
+        """
+        return sorted(int(m.group(1)) for m in map(FILENAME.match, os.listdir(self.directory)) if m)
+
+    def write(self, tbase, index_keys, columns):
+        """Archive a block given its index keys and columns: (datapoints key,
+           points) with points a list of (toffset, value), ascending.
+        """
+        path = self.path(tbase)
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        index = {'keys': {}, 'columns': {}}
+        for item in index_keys:
+            index['keys'].setdefault(item['domain_metric'], []).append(item['tbase_tags'])
+        with open(tmp, 'wb') as f:
+            for key, points in columns:
+                if not points:
+                    continue
+                data, kind = self._encode(points)
+                index['columns'][key] = [f.tell(), len(data), kind]
+                f.write(data)
+            offset = f.tell()
+            f.write(json.dumps(index, separators=(',', ':')))
+            f.write(FOOTER.pack(offset, MAGIC))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, path)
+        with self.lock:
+            stale = self.files.pop(tbase, None)
+        if stale:
+            stale.close()
+
+    def query_index(self, domain_metric, start_time, end_time, exclude=()):
+        """Index keys of archived columns intersecting [start_time, end_time]
+           (of blocks not in exclude).
+        """
+        ret = []
+        for tbase in self.blocks():
+            if tbase in exclude or tbase + self.block_size <= start_time or tbase > end_time:
+                continue
+            archive_file = self._open(tbase)
+            if archive_file is None:
+                continue
+            for key in archive_file.keys(domain_metric):
+                index_key = ArchivedIndexKey(key, tbase)
+                if index_key.get_tbase() <= end_time and index_key.get_tbase() + index_key.get_height() > start_time:
+                    ret.append(index_key)
+        return ret
+
+    def query_datapoints(self, index_key, start, end, shard=0):
+        """Datapoints of a column with toffset in [start, end] as datastore
+           items, ascending.
+        """
+        archive_file = self._open(index_key.block_tbase)
+        if archive_file is None:
+            return []
+        points = archive_file.read(index_key.to_data_points_key(shard))
+        return [{'toffset': toffset, 'value': value} for toffset, value in points
+                if start <= toffset <= end]
+
+    def expire(self, before):
+        """Delete archives of blocks ending before before.
+        """
+        for tbase in self.blocks():
+            if tbase + self.block_size <= before:
+                with self.lock:
+                    archive_file = self.files.pop(tbase, None)
+                if archive_file:
+                    archive_file.close()
+                os.remove(self.path(tbase))
+
+    def _open(self, tbase):
+        with self.lock:
+            archive_file = self.files.get(tbase)
+            if archive_file is None and os.path.exists(self.path(tbase)):
+                archive_file = self.files[tbase] = ArchiveFile(self.path(tbase))
+            return archive_file
+
+    @staticmethod
+    def _encode(points):
+        if all(isinstance(value, (int, long, float, Decimal)) and not isinstance(value, bool)
+               for toffset, value in points):
+            toffsets = np.array([toffset for toffset, value in points], '<i8')
+            values = np.array([float(value) for toffset, value in points], '<f8')
+            return zlib.compress(toffsets.tostring() + values.tostring()), 'f'
+        return compaction.encode(points), 'j'
@@ -35,6 +35,7 @@ Sample auth header:
 
 from amondawa import config
 from hashlib import sha256 as sha256
+from repoze.lru import LRUCache
 
 import boto
 import datetime
@@ -42,6 +43,11 @@ import hmac
 import posixpath
 import urllib
 
+PAYLOAD_HEADER = 'X-Amz-Content-Sha256'
+
+# derived signing keys by (secret key, date, region, service)
+signing_keys = LRUCache(1000)
+
 
 def check_access(domain, op, permissions):
     """return True if the permissions allow access to the provided domain and
@@ -70,9 +76,12 @@ class ProxyHTTPRequest(object):
 
 
 def auth_add_auth1(aws_access_key_id, aws_secret_access_key,
-                   method, host, port, path, headers, protocol='http'):
-    """Client side: add auth header to headers (used by test client).
+                   method, host, port, path, headers, protocol='http', body=None):
+    """Client side: add auth header to headers (used by test client).  If body
+       is given its hash is signed (X-Amz-Content-Sha256).
     """
+    if body is not None:
+        headers[PAYLOAD_HEADER] = sha256(body).hexdigest()
     auth_add_auth(ProxyHTTPRequest(method, host, port, path, headers, protocol=protocol),
                   aws_access_key_id, aws_secret_access_key)
     return headers
@@ -165,6 +174,11 @@ def auth_canonical_uri(http_request):
 
 
 def auth_payload(http_request):
+    # a signed payload hash is used as is (the server checks the body against
+    # it as the body streams in)
+    for name, value in http_request.headers.items():
+        if name.lower() == PAYLOAD_HEADER.lower():
+            return value
     body = http_request.body
     # If the body is a file like object, we can use
     # boto.utils.compute_hash, which will avoid reading
@@ -174,11 +188,12 @@ def auth_payload(http_request):
     return sha256(http_request.body).hexdigest()
 
 
-def auth_canonical_request(http_request, host):
+def auth_canonical_request(http_request, host, headers_to_sign=None):
     cr = [http_request.method.upper()]
     cr.append(auth_canonical_uri(http_request))
     cr.append(auth_canonical_query_string(http_request))
-    headers_to_sign = auth_headers_to_sign(http_request, host)
+    if headers_to_sign is None:
+        headers_to_sign = auth_headers_to_sign(http_request, host)
     cr.append(auth_canonical_headers(headers_to_sign) + '\n')
     cr.append(auth_signed_headers(headers_to_sign))
     cr.append(auth_payload(http_request))
@@ -221,16 +236,40 @@ def auth_string_to_sign(http_request, canonical_request, service_name, region_na
     return '\n'.join(sts)
 
 
+def auth_signing_key(secret_key, timestamp, region_name, service_name):
+    """Derive (or get the cached) signing key of a secret key for a date,
+       region and service.
+    """
+    cache_key = (secret_key, timestamp, region_name, service_name)
+    k_signing = signing_keys.get(cache_key)
+    if k_signing is None:
+        k_date = auth_sign(('AWS4' + secret_key).encode('utf-8'), timestamp)
+        k_region = auth_sign(k_date, region_name)
+        k_service = auth_sign(k_region, service_name)
+        k_signing = auth_sign(k_service, 'aws4_request')
+        signing_keys.put(cache_key, k_signing)
+    return k_signing
+
+
 def auth_signature(http_request, string_to_sign, secret_key):
-    key = secret_key
-    k_date = auth_sign(('AWS4' + key).encode('utf-8'),
-                       http_request.timestamp)
-    k_region = auth_sign(k_date, http_request.region_name)
-    k_service = auth_sign(k_region, http_request.service_name)
-    k_signing = auth_sign(k_service, 'aws4_request')
+    k_signing = auth_signing_key(secret_key, http_request.timestamp,
+                                 http_request.region_name, http_request.service_name)
     return auth_sign(k_signing, string_to_sign, hex=True)
 
 
+def compare_digest(a, b):
+    """Compare two digests in constant time.
+    """
+    if hasattr(hmac, 'compare_digest'):
+        return hmac.compare_digest(a, b)
+    if len(a) != len(b):
+        return False
+    result = 0
+    for x, y in zip(a, b):
+        result |= ord(x) ^ ord(y)
+    return result == 0
+
+
 def auth_add_auth(req, access_key, secret_key, service_name='amondawa', region_name=config.REGION):
     """
     Add AWS4 authentication to a request.
@@ -267,17 +306,25 @@ def auth_check_auth(req, access_key, secret_key, service_name='amondawa', region
         # the signature will use req.auth_path.
         req.path = req.path.split('?')[0]
         req.path = req.path + '?' + qs
-    canonical_request = auth_canonical_request(req, req.host)
+    headers_to_sign = auth_headers_to_sign(req, req.host)
+    canonical_request = auth_canonical_request(req, req.host, headers_to_sign)
     # TODO: logging
     #print 'CanonicalRequest:\n%s' % canonical_request
     string_to_sign = auth_string_to_sign(req, canonical_request, service_name, region_name)
     #print 'StringToSign:\n%s' % string_to_sign
     signature = auth_signature(req, string_to_sign, secret_key)
     #print 'Signature:\n%s' % signature
-    headers_to_sign = auth_headers_to_sign(req, req.host)
     l = ['AWS4-HMAC-SHA256 Credential=%s' % auth_scope(req, access_key)]
     l.append('SignedHeaders=%s' % auth_signed_headers(headers_to_sign))
     l.append('Signature=%s' % signature)
     req.headers['Authorization'] = ','.join(l)
 
 
+def auth_check_signature(req, signature, secret_key, service_name='amondawa', region_name=config.REGION):
+    """Server side: return True if signature is the request's signature.
+       Only the signature is compared (in constant time): the credential scope
+       and signed headers are covered by it.
+    """
+    canonical_request = auth_canonical_request(req, req.host)
+    string_to_sign = auth_string_to_sign(req, canonical_request, service_name, region_name)
+    return compare_digest(auth_signature(req, string_to_sign, secret_key), str(signature))
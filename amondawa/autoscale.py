@@ -0,0 +1,177 @@
+# Copyright (c) 2013 Daniel Gardner
+# All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""
+Provisioned throughput autoscaling driven by consumed capacity.
+
+Every process meters the capacity its own requests consume (see
+storage.CapacityMeter) and adds it to per minute counters in the capacity
+table, so scaling decisions see the consumption of all nodes.  Each block
+table is then provisioned for the peak per second rate over the last
+TP_SCALE_WINDOW minutes at TP_TARGET_PCT utilization, within the configured
+bounds:
+
+  - increases are applied at once (at most doubling per update)
+  - decreases are applied only when well below the provisioned value and
+    spread over the day so the daily decrease limit is not exhausted early
+  - turned down blocks (not written to) keep 1 write unit; blocks being
+    written to keep at least 2 (1 write unit marks a block TURNED_DOWN)
+"""
+
+from amondawa import config
+from boto.dynamodb2.fields import HashKey, RangeKey
+from boto.dynamodb2.types import NUMBER
+
+import math
+import traceback
+
+MINUTE = 60 * 1000
+DAY = 24 * 60 * MINUTE
+
+
+class Autoscaler(object):
+    # decrease only if the target is below this fraction of the provisioned value
+    DECREASE_THRESHOLD = .75
+
+    @staticmethod
+    def create(connection):
+        return connection.create_table(config.table_name('capacity'),
+                                       schema=[HashKey('table_name'), RangeKey('period', data_type=NUMBER)],
+                                       throughput={'read': 1, 'write': 5})
+
+    def __init__(self, connection, on_update=None, describe=None):
+        self.connection = connection
+        self.on_update = on_update
+        # table descriptions (e.g. cached): scaling runs every maintenance tick
+        self.describe = describe or (lambda table: table.describe())
+        self.meter = connection.meter
+        self.table = connection.table(config.table_name('capacity'))
+        self.last_scaled = 0
+        self.enabled = self.meter is not None and bool(int(config.get().TP_AUTOSCALE))
+        if self.enabled:
+            try:
+                self.describe(self.table)
+            except:
+                print 'capacity table %s not found: throughput autoscaling disabled' % self.table.table_name
+                self.enabled = False
+
+    def perform(self, blocks, now):
+        """Record consumed capacity and, every TP_SCALE_INTERVAL seconds, scale
+           the tables of the given blocks.
+        """
+        if not self.enabled:
+            return
+        self.flush(now)
+        if now - self.last_scaled < 1000 * int(config.get().TP_SCALE_INTERVAL):
+            return
+        self.last_scaled = now
+        for block in blocks:
+            write_active = block.state == 'ACTIVE'
+            # the pre-created next block keeps its write capacity until it
+            # becomes current (it sees no writes before then)
+            upcoming = block.tbase > now
+            for table in (block.data_points_table, block.index_table, block.compact_table):
+                if table:
+                    try:
+                        self.scale(table, write_active, now, upcoming)
+                    except:     # TODO log
+                        print "Unexpected error scaling %s:" % table.table_name
+                        traceback.print_exc()
+
+    def flush(self, now):
+        """Add consumed capacity to the counters of the current minute.
+        """
+        period = now - now % MINUTE
+        for table_name, (read, write) in self.meter.take().items():
+            if table_name != self.table.table_name:
+                self.connection.increment(self.table, {'table_name': table_name, 'period': period},
+                                          {'read': read, 'write': write})
+
+    def forget(self, table_name, before=None):
+        """Delete the counters of a table (those for periods before before if
+           given).
+        """
+        if before is None:
+            items = self.table.query(table_name__eq=table_name)
+        else:
+            items = self.table.query(table_name__eq=table_name, period__lt=before)
+        for item in list(items):
+            self.table.delete_item(table_name=table_name, period=item['period'])
+
+    def window(self, now):
+        """Start of the scaling window.
+        """
+        return now - now % MINUTE - int(config.get().TP_SCALE_WINDOW) * MINUTE
+
+    def peak(self, table_name, now):
+        """Peak per second (read, write) consumption over the scaling window.
+        """
+        since = self.window(now)
+        read = write = 0.
+        for item in self.table.query(table_name__eq=table_name, period__gte=since):
+            read = max(read, float(item.get('read') or 0) / 60)
+            write = max(write, float(item.get('write') or 0) / 60)
+        return read, write
+
+    def scale(self, table, write_active, now, upcoming=False):
+        desc = self.describe(table)['Table']
+        if desc['TableStatus'] != 'ACTIVE':
+            return
+        self.forget(table.table_name, self.window(now))
+        throughput = plan(desc['ProvisionedThroughput'], self.peak(table.table_name, now), write_active, now,
+                          upcoming)
+        if throughput:
+            table.update(throughput)
+            if self.on_update:
+                self.on_update(table)
+
+
+def plan(provisioned, peak, write_active, now, upcoming=False):
+    """Return the new throughput ({'read': n, 'write': n}) for a table with
+       provisioned throughput (as described) and peak (read, write) per second
+       consumption, or None if it should not change.  The write capacity of an
+       upcoming (not yet current) block's table is only ever raised.
+    """
+    c = config.get()
+    decreases = int(provisioned.get('NumberOfDecreasesToday', 0))
+    # decreases allowed so far today: spread the daily limit over the day
+    budget = min(int(c.TP_MAX_DECREASES), 1 + int(int(c.TP_MAX_DECREASES) * float(now % DAY) / DAY))
+
+    def target(current, consumed, lower, upper, decrease=True):
+        wanted = min(max(int(math.ceil(100. * consumed / int(c.TP_TARGET_PCT))), lower), upper)
+        if wanted > current:
+            return min(wanted, 2 * current)
+        if decrease and wanted < current * Autoscaler.DECREASE_THRESHOLD and decreases < budget:
+            return wanted
+        return current
+
+    current_read = int(provisioned['ReadCapacityUnits'])
+    current_write = int(provisioned['WriteCapacityUnits'])
+    read = target(current_read, peak[0], int(c.TP_MIN_READ), int(c.TP_MAX_READ))
+    if write_active:
+        write = target(current_write, peak[1], max(2, int(c.TP_MIN_WRITE)), int(c.TP_MAX_WRITE),
+                       not upcoming)
+    else:
+        write = current_write
+    if (read, write) == (current_read, current_write):
+        return None
+    return {'read': read, 'write': write}
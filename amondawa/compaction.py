@@ -0,0 +1,124 @@
+# Copyright (c) 2013 Daniel Gardner
+# All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""
+Compaction of turned down blocks.
+
+Once a block is turned down it is no longer written to.  The compactor
+rewrites each column of the block (one item per datapoint) into zlib
+compressed chunks of up to CHUNK_POINTS datapoints in the block's compact
+table (hash key: datapoints key, range key: first toffset of the chunk),
+a few columns per maintenance tick.  When every column is compacted the
+block is marked compacted (its reads switch to the compact table) and, a
+grace period later (so all nodes have switched), the datapoints table is
+deleted.
+
+Values are stored as read back by queries: numbers as floats, sets as lists
+and other values unchanged.
+"""
+
+from amondawa import config
+from boto.dynamodb.types import Binary
+from decimal import Decimal
+
+import json
+import traceback
+import zlib
+
+CHUNK_POINTS = 1000
+GRACE = 2 * 60 * 1000       # ms between marking a block compacted and deleting its datapoints
+
+
+def encode(points):
+    """Compress a list of (toffset, value).
+    """
+    toffsets, values = [], []
+    for toffset, value in points:
+        toffsets.append(int(toffset))
+        if isinstance(value, Decimal):
+            value = float(value)
+        elif isinstance(value, (set, frozenset)):
+            value = [float(v) if isinstance(v, Decimal) else v for v in value]
+        values.append(value)
+    return zlib.compress(json.dumps([toffsets, values], separators=(',', ':')))
+
+
+def decode(data):
+    """Decompress a chunk into a list of (toffset, value).
+    """
+    toffsets, values = json.loads(zlib.decompress(str(data)))
+    return zip(toffsets, values)
+
+
+def chunk_item(key, points):
+    return {'domain_metric_tbase_tags': key,
+            'chunk': points[0][0],
+            'points': Binary(encode(points))}
+
+
+class Compactor(object):
+    """Compact turned down blocks, MX_COMPACT_COLUMNS columns per call to
+     perform.
+    """
+
+    def __init__(self):
+        self.block = self.tbase = self.columns = None
+
+    def perform(self, blocks, now):
+        if not int(config.get().MX_COMPACT):
+            return
+
+        for block in blocks:
+            if block.compacted and block.data_points_table and now - block.compacted > GRACE:
+                block.drop_data_points()
+
+        if self.block is None or self.block.tbase != self.tbase or self.block.compacted:
+            self.start([b for b in blocks if b.state == 'TURNED_DOWN' and not b.compacted])
+        if self.block is None:
+            return
+
+        if not self.block.create_compact_table():
+            return      # not yet ACTIVE
+
+        for _ in range(int(config.get().MX_COMPACT_COLUMNS)):
+            try:
+                key = self.columns.next()
+            except StopIteration:
+                self.block.seal_compaction(now)
+                self.block = None
+                return
+            try:
+                self.block.compact_column(key)
+            except:     # TODO log
+                print "Unexpected error compacting %s:" % key
+                traceback.print_exc()
+                self.block = None     # start over (compaction is idempotent)
+                return
+
+    def start(self, candidates):
+        """Start compacting the oldest candidate block.
+        """
+        self.block = None
+        if candidates:
+            self.block = min(candidates, key=lambda b: b.tbase)
+            self.tbase = self.block.tbase
+            self.columns = self.block.column_keys(self.block.index_keys())
@@ -20,21 +20,49 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
 # IN THE SOFTWARE.
 
+from amondawa.snapshot import Snapshot
 from boto.dynamodb2.fields import HashKey
-from boto.dynamodb2.table import Table
+from threading import Thread
 
 import amondawa
+import math
 import os
 import sys
 import time
+import traceback
 
 MAX_WAIT = 120
 
 REGION = os.environ.get('AMDW_REGION', 'us-west-2')
 TABLE_SPACE = os.environ.get('AMDW_TABLE_SPACE', 'amdw')
+# local directory for the hot tier of recent datapoints (disabled if not set)
+HOT_TIER_DIR = os.environ.get('AMDW_HOT_TIER_DIR')
+# local directory for the archive of expired blocks (disabled if not set)
+ARCHIVE_DIR = os.environ.get('AMDW_ARCHIVE_DIR')
+# server processes on this node (set by bin/serve); thread pools are shared
+# out between them
+WORKERS = int(os.environ.get('AMDW_WORKERS', 1))
+# lock file electing the one process of this node running maintenance (all
+# processes run it if not set)
+MAINTENANCE_LOCK = os.environ.get('AMDW_MAINTENANCE_LOCK')
+# local snapshot of the configuration and block metadata processes start from
+# while it is younger than SNAPSHOT_TTL seconds ('' disables, as for the
+# memory backend)
+SNAPSHOT = os.environ.get('AMDW_SNAPSHOT', '' if amondawa.BACKEND == 'memory' else
+                          os.path.join(amondawa.DATA_DIR, 'snapshot-%s-%s' % (REGION, TABLE_SPACE)))
+SNAPSHOT_TTL = int(os.environ.get('AMDW_SNAPSHOT_TTL', 600))
 
 connection = amondawa.connect(REGION)
 
+def per_worker(threads):
+    """Threads per server process of a node-wide thread count (greenlets for
+       each request in flight when serving asynchronously).
+    """
+    if amondawa.ASYNC:
+        return amondawa.CONNECTIONS
+    return max(1, int(math.ceil(float(threads) / WORKERS)))
+
+
 def table_name(table):
     """Return the name of the table give it's base name.
 
@@ -53,47 +81,175 @@ def table_names(tables):
     """
     return dict(map(lambda name: (name, table_name(name)), tables))
 
-config_table = Table(table_name('config'), connection=connection)
-desc = None
-try:
-    desc = config_table.describe()
-except:
-    config_table = Table.create(table_name('config'),
-                                schema=[HashKey('name')],
-                                throughput={'read': 1, 'write': 1}, connection=connection)
-
-desc = config_table.describe()
-while MAX_WAIT and desc['Table']['TableStatus'] != 'ACTIVE':
-    MAX_WAIT -= 1
-    time.sleep(1)
+snapshot = Snapshot(SNAPSHOT, SNAPSHOT_TTL)
+
+config_table = connection.table(table_name('config'))
+
+
+def wait_for_config_table():
+    """Create the config table if it does not exist and wait for it to be
+       active.
+    """
+    global config_table
+    max_wait = MAX_WAIT
+    try:
+        config_table.describe()
+    except:
+        config_table = connection.create_table(table_name('config'),
+                                               schema=[HashKey('name')],
+                                               throughput={'read': 1, 'write': 1})
+
     desc = config_table.describe()
+    while max_wait and desc['Table']['TableStatus'] != 'ACTIVE':
+        max_wait -= 1
+        time.sleep(1)
+        desc = config_table.describe()
 
-if desc['Table']['TableStatus'] != 'ACTIVE':
-    print 'error accessing', table_name('config'), 'table in region', REGION
-    sys.exit(1)
+    if desc['Table']['TableStatus'] != 'ACTIVE':
+        print 'error accessing', table_name('config'), 'table in region', REGION
+        sys.exit(1)
 
 config = None
 
+# settings fixing the layout of block tables and columns: running processes
+# keep the values they started with (changes need the schema recreated)
+STRUCTURAL = ('store_column_height', 'store_history', 'store_history_blocks',
+              'store_height_classes', 'store_shards', 'store_column_heights')
+
+# callbacks applying new configuration versions
+subscribers = []
+# structural setting -> ignored (changed) value
+ignored = {}
+
+# values for settings missing from the config table (e.g. settings added
+# after the table was written)
+DEFAULTS = {
+    'mx_status_ttl': 60,          # seconds to cache table status (describe)
+    'mx_compact': 1,              # compact turned down blocks into compressed chunks (0 disables)
+    'mx_compact_columns': 50,     # columns compacted per maintenance run
+    'mx_compact_write': 10,       # compact table write throughput while compacting
+    'mx_credentials_refresh': 60, # seconds between refreshes of the credentials
+    'mx_config_refresh': 30,      # seconds between refreshes of the configuration by servers
+    'store_hot_columns': 2,       # recent columns of each series kept in the hot tier
+    'store_shard_rate': 200,      # datapoints per second per hash key before a series' columns are sharded
+    'store_max_shards': 16,       # maximum hash keys (shards) a series' column is spread over
+    'store_shards': {},           # fixed shard counts by metric name e.g. {'cpu.load': 4}
+    'store_height_classes': [],   # column heights (ms) metrics may use, each dividing the block size
+    'store_column_points': 2000,  # target datapoints per series column when choosing a metric's height
+    'store_column_heights': {},   # fixed column heights by metric name e.g. {'cpu.load': 60000}
+    'store_archive_history': 0,   # milliseconds of expired blocks kept in the archive (0: keep all)
+    'store_filter_fp': 0.01,      # false positive rate of the series bloom filters of turned down blocks
+    'store_filter_bytes': 32768,  # maximum size of a block's bloom filter (0: no filters)
+    'cache_index_columns': 2,     # recent columns (per height) whose written index keys are remembered
+    'ad_read_rate': 0,            # queries per second per domain on a node (0: unlimited)
+    'ad_read_concurrency': 0,     # queries in progress per domain on a node (0: unlimited)
+    'ad_write_rate': 0,           # datapoints written per second per domain on a node (0: unlimited)
+    'ad_write_concurrency': 0,    # write requests in progress per domain on a node (0: unlimited)
+    'ad_domains': {},             # limits and fair queuing weights by domain e.g. {'ops': {'read_rate': 5, 'weight': 2}}
+    'tp_autoscale': 1,            # scale block table throughput to consumed capacity (0 disables)
+    'tp_scale_interval': 60,      # seconds between throughput scaling decisions
+    'tp_scale_window': 5,         # minutes of consumed capacity considered when scaling
+    'tp_target_pct': 70,          # target utilization in percent of provisioned throughput
+    'tp_min_read': 1,             # minimum read throughput of a block table
+    'tp_max_read': 1000,          # maximum read throughput of a block table
+    'tp_min_write': 2,            # minimum write throughput of a block table being written to
+    'tp_max_write': 1000,         # maximum write throughput of a block table
+    'tp_max_decreases': 4,        # throughput decreases allowed per table per (UTC) day
+}
+
 
 class Configuration(object):
-    def __init__(self, config_table):
-        vars(self).update(dict((item['name'].upper(), item['value']) \
-                               for item in config_table.scan()))
+    """Settings (upper case attributes) of a configuration version.
+    """
+
+    def __init__(self, settings, version=0):
+        vars(self).update(dict((name.upper(), value) for name, value in DEFAULTS.items()))
+        vars(self).update(dict((name.upper(), value) for name, value in settings))
+        self.version = version
+        self.configured = bool(settings)    # (else defaults only)
 
 
 def get():
     return config
 
 
+def subscribe(callback, started=None):
+    """Call callback(previous, configuration) with each new configuration
+       version, and at once if the caller started from (read its settings
+       from) an older version.
+    """
+    subscribers.append(callback)
+    if started is not None and started is not config:
+        callback(started, config)
+
+
 def refresh():
+    """Read the config table (and save it to the snapshot).  A changed
+       configuration becomes a new version, passed to the subscribers.
+    """
     global config
-    config = Configuration(config_table)
+    settings = [(item['name'], item['value']) for item in config_table.scan()]
+    snapshot.update(config=settings)
+    previous, current = config, Configuration(settings)
+    if previous is None:
+        config = current
+        return config
+    for name in STRUCTURAL if previous.configured else ():
+        value = getattr(current, name.upper(), None)
+        started = getattr(previous, name.upper(), None)
+        if value != started:
+            if ignored.get(name) != value:
+                print 'warning: %s changed, restart with a new schema to apply it' % name
+            ignored[name] = value
+            setattr(current, name.upper(), started)
+    current.version = previous.version
+    if vars(current) == vars(previous):
+        return config
+    current.version += 1
+    config = current
+    for callback in subscribers:
+        # noinspection PyBroadException
+        try:
+            callback(previous, current)
+        except:     # TODO log
+            print "Unexpected error applying configuration:"
+            traceback.print_exc()
     return config
 
 
+def refresh_later():
+    # noinspection PyBroadException
+    try:
+        refresh()
+    except:
+        pass    # keep the snapshot configuration (TODO log)
+
+
+def watch():
+    """Refresh the configuration every MX_CONFIG_REFRESH seconds in the
+       background.
+    """
+    def run():
+        while True:
+            time.sleep(int(config.MX_CONFIG_REFRESH))
+            refresh_later()
+    watcher = Thread(target=run)
+    watcher.daemon = True
+    watcher.start()
+
+
 def write(configuration):
     for name, value in configuration.items():
         config_table.put_item({'name': name, 'value': value}, overwrite=True)
-
-
-refresh()
+    refresh()
+
+
+settings = snapshot.get('config')
+if settings is None:
+    wait_for_config_table()
+    refresh()
+else:
+    config = Configuration(settings)
+    refresher = Thread(target=refresh_later)
+    refresher.daemon = True
+    refresher.start()
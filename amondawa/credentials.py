@@ -0,0 +1,116 @@
+# Copyright (c) 2013 Daniel Gardner
+# All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""
+Credential store.
+
+Access keys are read from the credentials table in the background (requests
+arriving before the first read wait for it) and refreshed; each refresh swaps
+in a new snapshot, reusing the compiled credentials of unchanged keys.
+Permissions ('domain:op', domain '*' for any domain) are compiled into per
+operation domain sets.
+"""
+
+from threading import Event, Thread
+
+import time
+import traceback
+
+
+class Credential(object):
+    """An access key with compiled permissions.
+    """
+
+    def __init__(self, item):
+        self.access_key_id = item['access_key_id']
+        self.secret_access_key = item['secret_access_key']
+        self.state = item['state']
+        self.permissions = frozenset(item['permissions'])
+        # op -> domains, op -> True if any domain
+        self.domains, self.any_domain = {}, {}
+        for permission in self.permissions:
+            domain, op = permission.split(':')
+            if domain == '*':
+                self.any_domain[op] = True
+            else:
+                self.domains.setdefault(op, set()).add(domain)
+
+    @property
+    def active(self):
+        return self.state == 'ACTIVE'
+
+    def allows(self, domain, op):
+        """Return True if the permissions allow op on domain.
+        """
+        return op in self.any_domain or domain in self.domains.get(op, ())
+
+    def matches(self, item):
+        """Return True if item (a credentials table item) is this credential.
+        """
+        return (item['secret_access_key'], item['state'], frozenset(item['permissions'])) == \
+               (self.secret_access_key, self.state, self.permissions)
+
+
+class CredentialStore(Thread):
+    """Credentials by access key id, refreshed every interval seconds.
+    """
+
+    def __init__(self, table, interval):
+        super(CredentialStore, self).__init__()
+        self.table = table
+        self.interval = interval
+        self.daemon = True
+        self.credentials = {}
+        self.loaded = Event()
+
+    def get(self, access_key_id):
+        if not self.loaded.is_set():
+            self.loaded.wait(self.interval)
+        return self.credentials.get(access_key_id)
+
+    def refresh(self):
+        """Read the credentials table and swap in the new snapshot.  Malformed
+           items are skipped.
+        """
+        current = self.credentials
+        credentials = {}
+        for item in self.table.scan():
+            try:
+                credential = current.get(item['access_key_id'])
+                if credential is None or not credential.matches(item):
+                    credential = Credential(item)
+            except (KeyError, TypeError, ValueError) as e:  # TODO log
+                print "Skipping malformed credentials item %s: %r" % (item.get('access_key_id'), e)
+                continue
+            credentials[credential.access_key_id] = credential
+        self.credentials = credentials
+        self.loaded.set()
+
+    def run(self):
+        while True:
+            # noinspection PyBroadException
+            try:
+                self.refresh()
+            except:     # TODO log
+                print "Unexpected error refreshing credentials:"
+                traceback.print_exc()
+            time.sleep(self.interval)
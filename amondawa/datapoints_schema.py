@@ -24,16 +24,25 @@
 """
 
 from amondawa import config, util
+from amondawa import compaction, sharding
+from amondawa.archive import Archive, ArchivedIndexKey
+from amondawa.autoscale import Autoscaler
+from amondawa.filters import BloomFilter, IndexedColumns, may_contain, series_keys
+from amondawa.heights import HeightPolicy
+from amondawa.hot_tier import HotTier
+from amondawa.sharding import ShardPolicy
 from amondawa.util import IndexKey
 from amondawa.writer import TimedBatchTable
 
+from boto.dynamodb.types import Binary
+from boto.dynamodb2.exceptions import ItemNotFound
 from boto.dynamodb2.fields import HashKey, RangeKey
-from boto.dynamodb2.items import Item
-from boto.dynamodb2.table import Table
 from boto.dynamodb2.types import *
-from repoze.lru import LRUCache
-from threading import Thread
+from threading import Lock, Thread
 
+import fcntl
+import itertools
+import operator
 import time
 import traceback
 
@@ -66,14 +75,97 @@ def wait_for_active(table, max_wait=120, retry_secs=1):
         desc = table.describe()
 
 
-class Block(object):
-    index_key_lru = LRUCache(config.get().CACHE_WRITE_INDEX_KEY)
+class TableStatusCache(object):
+    """Cache of table descriptions (status and provisioned throughput).  Entries
+     expire after ttl seconds (sooner while a table is changing state) and are
+     re-described together by refresh().  Operations that create, update or
+     delete a table invalidate its entry.
+    """
+    TRANSITION_TTL = 5
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.lock = Lock()
+        self.entries = {}   # table name -> (expires, table, description)
+
+    def describe(self, table):
+        """Return the (possibly cached) description of table.
+        """
+        with self.lock:
+            entry = self.entries.get(table.table_name)
+        if entry and entry[0] > time.time():
+            return entry[2]
+        return self._describe(table)
+
+    def invalidate(self, table):
+        with self.lock:
+            self.entries.pop(table.table_name, None)
+
+    def load(self, descriptions, connection):
+        """Cache descriptions (table name -> description, e.g. from the
+           snapshot).
+        """
+        with self.lock:
+            for table_name, desc in descriptions.items():
+                self.entries[table_name] = (time.time() + self.ttl, connection.table(table_name), desc)
+
+    def descriptions(self):
+        """Cached descriptions of active tables by table name.
+        """
+        with self.lock:
+            return dict((table_name, desc) for table_name, (_, _, desc) in self.entries.items()
+                        if desc['Table']['TableStatus'] == 'ACTIVE')
+
+    def refresh(self, ahead=0):
+        """Re-describe tables expired or expiring within ahead seconds (e.g.
+           before the next refresh, so reads keep hitting the cache).
+        """
+        with self.lock:
+            expired = [table for expires, table, _ in self.entries.values() if expires <= time.time() + ahead]
+        for table in expired:
+            # noinspection PyBroadException
+            try:
+                self._describe(table)
+            except:
+                self.invalidate(table)   # e.g. deleted
+
+    def _describe(self, table):
+        desc = table.describe()
+        ttl = self.ttl if desc['Table']['TableStatus'] == 'ACTIVE' else TableStatusCache.TRANSITION_TTL
+        with self.lock:
+            self.entries[table.table_name] = (time.time() + ttl, table, desc)
+        return desc
+
+
+table_status = TableStatusCache(int(config.get().MX_STATUS_TTL))
+
+# the hot tier must see every write: one node, one (worker) process
+if config.HOT_TIER_DIR and config.WORKERS > 1:
+    print 'hot tier disabled: it needs a single worker process (AMDW_WORKERS=%d)' % config.WORKERS
+hot_tier = HotTier(config.HOT_TIER_DIR, util.COLUMN_HEIGHT,
+                   int(config.get().STORE_HOT_COLUMNS)) if config.HOT_TIER_DIR and config.WORKERS == 1 else None
+
+archive = Archive(config.ARCHIVE_DIR, BLOCK_SIZE) if config.ARCHIVE_DIR else None
+
+shard_policy = ShardPolicy(util.COLUMN_HEIGHT, config.get().STORE_SHARD_RATE,
+                           int(config.get().STORE_MAX_SHARDS), config.get().STORE_SHARDS,
+                           int(config.get().CACHE_WRITE_INDEX_KEY))
+
+height_policy = HeightPolicy(util.COLUMN_HEIGHT, config.get().STORE_HEIGHT_CLASSES, BLOCK_SIZE,
+                             config.get().STORE_COLUMN_POINTS, config.get().STORE_COLUMN_HEIGHTS,
+                             int(config.get().CACHE_WRITE_INDEX_KEY))
 
-    def __init__(self, master, connection, n):
+
+class Block(object):
+    def __init__(self, master, connection, n, item=None):
         self.master = master
         self.connection = connection
-        self.item = self.master.query(n__eq=n, consistent=True).next()
-        self.dp_writer = self.data_points_table = self.index_table = None
+        if item is None:
+            item = dict(self.master.query(n__eq=n, consistent=True).next().items())
+        self.item = item
+        self.dp_writer = self.data_points_table = self.index_table = self.compact_table = None
+        self._bloom = None
+        self.indexed = IndexedColumns(int(config.get().CACHE_INDEX_COLUMNS))
         # noinspection PyBroadException
         try:
             self.bind()
@@ -84,18 +176,25 @@ class Block(object):
         """Bind to existing tables.
         """
         if self.data_points_name and self.index_name:
-            data_points_table = Table(self.data_points_name, connection=self.connection)
-            try:
-                s1 = data_points_table.describe()['Table']['TableStatus']
-            except:
-                raise
+            if self.compact_name:
+                self.compact_table = self.connection.table(self.compact_name)
+            if self.compacted:
+                # datapoints are read from the compact table
+                s1 = table_status.describe(self.compact_table)['Table']['TableStatus']
+                self.data_points_table = self.dp_writer = None
             else:
-                self.data_points_table = data_points_table
-                self.dp_writer = TimedBatchTable(self.data_points_table.batch_write())
-
-            index_table = Table(self.index_name, connection=self.connection)
+                data_points_table = self.connection.table(self.data_points_name)
+                try:
+                    s1 = table_status.describe(data_points_table)['Table']['TableStatus']
+                except:
+                    raise
+                else:
+                    self.data_points_table = data_points_table
+                    self.dp_writer = TimedBatchTable(self.data_points_table.batch_write())
+
+            index_table = self.connection.table(self.index_name)
             try:
-                s2 = index_table.describe()['Table']['TableStatus']
+                s2 = table_status.describe(index_table)['Table']['TableStatus']
             except:
                 raise
             else:
@@ -108,6 +207,21 @@ class Block(object):
 
         return self.state
 
+    def rebind(self, item):
+        """Rebind to the tables of a (new) master item.
+        """
+        if self.dp_writer:
+            self.dp_writer.flush()
+        self.item = item
+        self.dp_writer = self.data_points_table = self.index_table = self.compact_table = None
+        self._bloom = None
+        self.indexed = IndexedColumns(int(config.get().CACHE_INDEX_COLUMNS))
+        # noinspection PyBroadException
+        try:
+            self.bind()
+        except:
+            pass  # TODO log (e.g. tables being created)
+
     def create_tables(self):
         """Create tables.
         """
@@ -121,33 +235,177 @@ class Block(object):
             self.bind()
         except:
             if not self.data_points_table:
-                Table.create(self.data_points_name,
-                             schema=[HashKey('domain_metric_tbase_tags'),
-                                     RangeKey('toffset', data_type=NUMBER)],
-                             throughput={'read': config.get().TP_READ_DATAPOINTS / BLOCKS,
-                                         'write': config.get().TP_WRITE_DATAPOINTS}, connection=self.connection)
+                self.connection.create_table(self.data_points_name,
+                                             schema=[HashKey('domain_metric_tbase_tags'),
+                                                     RangeKey('toffset', data_type=NUMBER)],
+                                             throughput={'read': config.get().TP_READ_DATAPOINTS / BLOCKS,
+                                                         'write': config.get().TP_WRITE_DATAPOINTS})
             if not self.index_table:
-                Table.create(self.index_name,
-                             schema=[HashKey('domain_metric'), RangeKey('tbase_tags')],
-                             throughput={'read': config.get().TP_READ_INDEX_KEY / BLOCKS,
-                                         'write': config.get().TP_WRITE_INDEX_KEY}, connection=self.connection)
+                self.connection.create_table(self.index_name,
+                                             schema=[HashKey('domain_metric'), RangeKey('tbase_tags')],
+                                             throughput={'read': config.get().TP_READ_INDEX_KEY / BLOCKS,
+                                                         'write': config.get().TP_WRITE_INDEX_KEY})
 
             self.item['state'] = self.bind()
 
-        self.item.save(overwrite=True)
+        self.save()
         return self.state
 
+    def save(self):
+        """Write the block item to the master table.
+        """
+        self.master.put_item(data=self.item, overwrite=True)
+
+    def create_compact_table(self):
+        """Create the compact table (if needed); return True if it is ACTIVE.
+        """
+        if not self.compact_table:
+            self.dp_writer = None     # no more (late) writes to the datapoints table
+            self.item['compact_name'] = '%s_%s' % (config.table_name('dp_compact'), self.tbase)
+            try:
+                self.compact_table = self.connection.create_table(self.compact_name,
+                                                                  schema=[HashKey('domain_metric_tbase_tags'),
+                                                                          RangeKey('chunk', data_type=NUMBER)],
+                                                                  throughput={'read': config.get().TP_READ_DATAPOINTS / BLOCKS,
+                                                                              'write': config.get().MX_COMPACT_WRITE})
+            except:
+                self.compact_table = self.connection.table(self.compact_name)    # already exists
+            self.save()
+        return table_status.describe(self.compact_table)['Table']['TableStatus'] == 'ACTIVE'
+
+    def compact_column(self, key):
+        """Rewrite a column (datapoints key) into compressed chunks.
+        """
+        points = self.read_column(key)
+        with self.compact_table.batch_write() as batch:
+            for i in range(0, len(points), compaction.CHUNK_POINTS):
+                batch.put_item(data=compaction.chunk_item(key, points[i:i + compaction.CHUNK_POINTS]))
+
+    def seal_compaction(self, now):
+        """Mark the block compacted: reads switch to the compact table.
+        """
+        self.item['compacted'] = now
+        self.save()
+        self.compact_table.update({'read': table_status.describe(self.compact_table)['Table']
+                                                       ['ProvisionedThroughput']['ReadCapacityUnits'],
+                                   'write': 1})
+        table_status.invalidate(self.compact_table)
+
+    def drop_data_points(self):
+        """Delete the datapoints table of a compacted block.
+        """
+        table_status.invalidate(self.data_points_table)
+        try:
+            self.data_points_table.delete()
+        except:
+            pass
+        self.data_points_table = self.dp_writer = None
+
     def replace(self, new_timestamp):
-        """Replace this block with new block.
+        """Replace this block with new block.  If the block cannot be archived
+           it is kept (maintenance tries again on its next pass).
         """
         if block_pos(new_timestamp) != self.n:
             raise ValueError('time %s (pos=%s) is not valid for block (pos=%s)' %
                              (new_timestamp, block_pos(new_timestamp), self.n))
         if base_time(new_timestamp) == self.tbase:
             return self
+        if archive and self.index_table:
+            # noinspection PyBroadException
+            try:
+                self.archive()
+            except:     # TODO log
+                print "Unexpected error archiving block %s (kept until archived):" % self.tbase
+                traceback.print_exc()
+                return self
         self.delete_tables(new_timestamp)
         return self
 
+    def archive(self):
+        """Export the block's columns to the local archive.
+        """
+        items = [index_key.key for index_key in self.index_keys()]
+        archive.write(self.tbase, items, ((key, self.read_column(key)) for key in
+                                          Block.column_keys(IndexKey(item) for item in items)))
+
+    def build_filter(self):
+        """Build the bloom filter of the block's series from its index and save
+           it in the master item.
+        """
+        keys = set()
+        for index_key in self.index_keys():
+            keys.update(series_keys(index_key.get_domain(), index_key.get_metric(), index_key.get_tags()))
+        bloom = BloomFilter.create(len(keys), float(config.get().STORE_FILTER_FP),
+                                   int(config.get().STORE_FILTER_BYTES))
+        for key in keys:
+            bloom.add(key)
+        self.item['filter'] = Binary(bloom.to_string())
+        self.save()
+
+    def clear_filter(self):
+        """Drop the block's bloom filter (e.g. before writing to a turned down
+           block); maintenance builds it again.  The master item is read again
+           first, as this node's copy may be behind (e.g. on compaction).
+        """
+        if self.item.pop('filter', None):
+            self._bloom = None
+            try:
+                item = dict(self.master.get_item(consistent=True, n=self.n, tbase=self.tbase).items())
+            except ItemNotFound:
+                return
+            if item.pop('filter', None):
+                self.master.put_item(data=item, overwrite=True)
+
+    def may_contain(self, domain, metric, tags=None):
+        """False if the block's filter rules out series of metric with tags.
+        """
+        bloom = self.bloom
+        return bloom is None or may_contain(bloom, domain, metric, tags)
+
+    @property
+    def bloom(self):
+        """The block's bloom filter (None until it is built).
+        """
+        data = self.item.get('filter')
+        if not data:
+            return None
+        if self._bloom is None or self._bloom[0] is not data:
+            self._bloom = (data, BloomFilter.from_string(str(data)))
+        return self._bloom[1]
+
+    def index_keys(self):
+        """Index keys of all the block's columns.
+        """
+        if not self.index_table:
+            return iter([])
+        return (IndexKey(item) for item in self.index_table.scan())
+
+    @staticmethod
+    def column_keys(index_keys):
+        """Datapoints keys (of all shards) of the columns of index keys.
+        """
+        seen = set()
+        for index_key in index_keys:
+            for shard in range(index_key.get_shards()):
+                key = index_key.to_data_points_key(shard)
+                if key not in seen:
+                    seen.add(key)
+                    yield key
+
+    def read_column(self, key):
+        """All (toffset, value) of a column (datapoints key), ascending.
+        """
+        # sorted here: compact_column keys chunks by their first (smallest)
+        # toffset and archives are written in order, whatever the backend
+        if self.compacted:
+            points = itertools.chain.from_iterable(
+                compaction.decode(chunk['points'])
+                for chunk in self.compact_table.query(consistent=False, domain_metric_tbase_tags__eq=key))
+        else:
+            points = ((item['toffset'], item['value']) for item in
+                      self.data_points_table.query(consistent=False, domain_metric_tbase_tags__eq=key))
+        return sorted(points, key=operator.itemgetter(0))
+
     def delete_tables(self, new_timestamp=None):
         """Delete the tables for this block.
         """
@@ -155,6 +413,7 @@ class Block(object):
             new_timestamp = self.tbase
 
         if self.data_points_table:
+            table_status.invalidate(self.data_points_table)
             # noinspection PyBroadException
             try:
                 self.data_points_table.delete()
@@ -163,37 +422,53 @@ class Block(object):
             self.data_points_table = None
             self.dp_writer = None
         if self.index_table:
+            table_status.invalidate(self.index_table)
             try:
                 self.index_table.delete()
             except:
                 pass
             self.index_table = None
+        if self.compact_table:
+            table_status.invalidate(self.compact_table)
+            try:
+                self.compact_table.delete()
+            except:
+                pass
+            self.compact_table = None
 
         try:
-            self.item.delete()
+            self.master.delete_item(n=self.n, tbase=self.tbase)
         except:
             pass
 
-        self.item = Item(self.master,
-                         data=dict(self.item.items()))
+        self.item = dict(self.item)
+        self.item.pop('compact_name', None)
+        self.item.pop('compacted', None)
+        self.item.pop('filter', None)
         self.item['state'] = 'INITIAL'
+        self.indexed = IndexedColumns(int(config.get().CACHE_INDEX_COLUMNS))
         self.item['tbase'] = base_time(new_timestamp)
-        self.item.save(overwrite=True)
+        self.save()
 
         return self.state
 
     def turndown_tables(self):
-        """Reduce write throughput for this block.
+        """Reduce write throughput for this block (and record when, see
+           DatapointsSchema.perform_maintenance).
         """
         try:
             self.dp_writer.flush()
         except:
             pass
         self.dp_writer = None
-        if self.data_points_table:
-            self.data_points_table.update({'read': config.get().TP_READ_DATAPOINTS / BLOCKS, 'write': 1})
-        if self.index_table:
-            self.index_table.update({'read': config.get().TP_READ_INDEX_KEY / BLOCKS, 'write': 1})
+        self.item['turned_down'] = util.now()
+        self.save()
+        # keep read throughput (it may have been scaled to the block's reads)
+        for table in (self.data_points_table, self.index_table):
+            if table:
+                read = table_status.describe(table)['Table']['ProvisionedThroughput']['ReadCapacityUnits']
+                table.update({'read': read, 'write': 1})
+                table_status.invalidate(table)
 
     @property
     def n(self):
@@ -205,19 +480,30 @@ class Block(object):
 
     @property
     def data_points_name(self):
-        return self.item['data_points_name']
+        return self.item.get('data_points_name')
 
     @property
     def index_name(self):
-        return self.item['index_name']
+        return self.item.get('index_name')
+
+    @property
+    def compact_name(self):
+        return self.item.get('compact_name')
+
+    @property
+    def compacted(self):
+        """Time the block was compacted (None if it is not).
+        """
+        return self.item.get('compacted')
 
     @property
     def state(self):
         state = self.item['state']
         if state == 'INITIAL':
             return state
-        s1 = self._calc_state(self.data_points_table.describe())
-        s2 = self._calc_state(self.index_table.describe())
+        s1 = self._calc_state(table_status.describe(self.compact_table if self.compacted
+                                                    else self.data_points_table))
+        s2 = self._calc_state(table_status.describe(self.index_table))
         if s1 != s2:
             return 'UNDEFINED'
         return s1
@@ -229,39 +515,98 @@ class Block(object):
         if not self.dp_writer:
             return
 
-        key = util.hdata_points_key(domain, metric, timestamp, tags)
-        self._store_index(key, timestamp, metric, tags, domain)
+        series = '|'.join([domain, metric, util.tag_string(tags)])
+        height = height_policy.height(metric, series, timestamp, self.tbase)
+        tbase, toffset = util.base_time(timestamp, height), util.offset_time(timestamp, height)
+        shards = shard_policy.shards(series, metric, tbase, height)
+        key = util.hdata_points_key(domain, metric, timestamp, tags, sharding.shard(timestamp, shards), height)
+        self._store_index(key, timestamp, metric, tags, domain, shards, height)
+        if hot_tier:
+            hot_tier.append(key, tbase, toffset, value, util.now())
         return self.dp_writer.put_item(data={
             'domain_metric_tbase_tags': key,
-            'toffset': util.offset_time(timestamp),
+            'toffset': toffset,
             'value': value
         })
 
+    def store_column(self, domain, metric, tags, points, height=util.COLUMN_HEIGHT, shards=1):
+        """Store datapoints [(timestamp, value)] of one column of a series
+           directly (bulk loads): unbuffered and bypassing the hot tier, which
+           then reads the column from the datastore.
+        """
+        timestamp = points[0][0]
+        key = util.hdata_points_key(domain, metric, timestamp, tags, 0, height)
+        self._store_index(key, timestamp, metric, tags, domain, shards, height)
+        keys = [util.hdata_points_key(domain, metric, timestamp, tags, shard, height) for shard in range(shards)]
+        if hot_tier:
+            for shard_key in keys:
+                hot_tier.bypass(shard_key, util.base_time(timestamp, height), util.now())
+        with self.data_points_table.batch_write() as batch:
+            for timestamp, value in points:
+                batch.put_item(data={
+                    'domain_metric_tbase_tags': keys[sharding.shard(timestamp, shards)],
+                    'toffset': util.offset_time(timestamp, height),
+                    'value': value
+                })
+
+    def metric_height(self, domain, metric):
+        """Column height of metric in this block as recorded in its index (None
+           if the block has no column of metric yet).
+        """
+        if not self.index_table:
+            return None
+        for item in self.index_table.query(consistent=False, limit=1,
+                                           domain_metric__eq=util.index_hash_key(domain, metric)):
+            return IndexKey(item).get_height()
+        return None
+
     def query_index(self, domain, metric, start_time, end_time):
-        """Query index for keys.
+        """Query index for keys.  Keys are yielded as index pages arrive.
         """
         if not self.index_table:
             return []
 
         key = util.index_hash_key(domain, metric)
-        time_range = map(str, [util.base_time(start_time), util.base_time(end_time) + 1])
-        return [IndexKey(k) for k in self.index_table.query(consistent=False,
-                                                            domain_metric__eq=key, tbase_tags__between=time_range)]
-
-    def query_datapoints(self, index_key, start_time, end_time, attributes=tuple(['value'])):
-        """Query datapoints.
+        # columns starting up to the largest column height before start_time
+        # may reach into the range
+        time_range = map(str, [start_time - height_policy.max_height + 1, end_time + 1])
+        keys = (IndexKey(k) for k in self.index_table.query(consistent=False,
+                                                            domain_metric__eq=key, tbase_tags__between=time_range))
+        return (k for k in keys if k.get_tbase() + k.get_height() > start_time)
+
+    def query_datapoints(self, index_key, start_time, end_time, attributes=tuple(['value']), shard=0):
+        """Query datapoints (of one shard of the column), ascending.
         """
+        if self.compacted:
+            return self._query_compacted(index_key, start_time, end_time, shard)
         if not self.data_points_table: return []
 
-        key = index_key.to_data_points_key()
+        key = index_key.to_data_points_key(shard)
         time_range = util.offset_range(index_key, start_time, end_time)
         attributes_ = ['toffset']
         attributes_.extend(attributes)
-        return [value for value in self.data_points_table.query(consistent=False,
-                                                                reverse=True, attributes=attributes_,
+        return [value for value in self.data_points_table.query(consistent=False, attributes=attributes_,
                                                                 domain_metric_tbase_tags__eq=key,
                                                                 toffset__between=time_range)]
 
+    def _query_compacted(self, index_key, start_time, end_time, shard=0):
+        """Query datapoints from the compact table, ascending: the chunks from
+           the last one starting at or before the start of the range to the last
+           one starting at or before its end.
+        """
+        if not self.compact_table: return []
+
+        key = index_key.to_data_points_key(shard)
+        start, end = util.offset_range(index_key, start_time, end_time)
+        chunks = []
+        for chunk in self.compact_table.query(consistent=False, domain_metric_tbase_tags__eq=key, chunk__lte=end):
+            if chunk['chunk'] <= start:
+                chunks = []     # earlier chunks end before this one starts
+            chunks.append(chunk)
+        return [{'toffset': toffset, 'value': value}
+                for chunk in chunks for toffset, value in compaction.decode(chunk['points'])
+                if start <= toffset <= end]
+
     # noinspection PyMethodMayBeStatic
     def _calc_state(self, desc):
         desc = desc['Table']
@@ -270,18 +615,18 @@ class Block(object):
             state = 'TURNED_DOWN'
         return state
 
-    # noinspection PyMethodMayBeStatic
-    def _store_cache(self, key, cache, table, data):
-        if not cache.get(key):
-            table.put_item(data=data(), overwrite=True)
-            cache.put(key, 1)
-
-    def _store_index(self, key, timestamp, metric, tags, domain):
+    def _store_index(self, key, timestamp, metric, tags, domain, shards=1, height=util.COLUMN_HEIGHT):
         """Store an index key if not yet stored.
         """
-        self._store_cache(key, Block.index_key_lru, self.index_table,
-                          lambda: {'domain_metric': util.index_hash_key(domain, metric),
-                                   'tbase_tags': util.index_range_key(timestamp, tags)})
+        column = (key, shards, util.base_time(timestamp, height), height)
+        if column not in self.indexed:
+            self.index_table.put_item(data={'domain_metric': util.index_hash_key(domain, metric),
+                                            'tbase_tags': util.index_range_key(timestamp, tags, shards, height)},
+                                      overwrite=True)
+            self.indexed.add(*column)
+            if self.item.get('filter') and \
+                    not self.may_contain(domain, metric, dict((name, [value]) for name, value in tags.items())):
+                self.clear_filter()     # a late write of a new series
 
     def __str__(self):
         return str((self.n, self.state, self.tbase, self.data_points_name, self.index_name))
@@ -293,10 +638,10 @@ class Block(object):
 class DatapointsSchema(object):
     @staticmethod
     def create(connection, max_wait=120):
-        master = Table.create(config.table_name('dp_master'),
-                              schema=[HashKey('n', data_type=NUMBER),
-                                      RangeKey('tbase', data_type=NUMBER)],
-                              throughput={'read': 5, 'write': 5}, connection=connection)
+        master = connection.create_table(config.table_name('dp_master'),
+                                         schema=[HashKey('n', data_type=NUMBER),
+                                                 RangeKey('tbase', data_type=NUMBER)],
+                                         throughput={'read': 5, 'write': 5})
 
         wait_for_active(master, max_wait)
 
@@ -308,22 +653,56 @@ class DatapointsSchema(object):
                 'tbase': base_time(next_block),
                 'state': 'INITIAL'
             })
+        config.snapshot.update(blocks=None)
 
     @staticmethod
     def delete(connection):
         for block in DatapointsSchema(connection).blocks:
             block.delete_tables()
         try:
-            Table(config.table_name('dp_master'), connection=connection).delete()
+            connection.table(config.table_name('dp_master')).delete()
         except:
             pass
+        config.snapshot.update(blocks=None)
 
     def __init__(self, connection):
         self.connection = connection
-        self.master = Table(config.table_name('dp_master'), connection=connection)
-        self.blocks = [Block(self.master, connection, n) for n in range(BLOCKS)]
-
-        self.mx_worker = MaintenanceWorker(self)
+        self.master = connection.table(config.table_name('dp_master'))
+        # start from the snapshot if fresh (master items are checked again by
+        # the maintenance worker)
+        snapshot = config.snapshot.get('blocks')
+        if snapshot:
+            table_status.load(snapshot['tables'], connection)
+        self.from_snapshot = bool(snapshot)
+        self.blocks = [Block(self.master, connection, n, snapshot and snapshot['master'].get(n))
+                       for n in range(BLOCKS)]
+        self.autoscaler = Autoscaler(connection, on_update=table_status.invalidate,
+                                     describe=table_status.describe)
+        self.compactor = compaction.Compactor()
+        self.saved = time.time() if snapshot else 0
+        current = self.current()
+        if snapshot and (not current or current.data_points_name and not current.data_points_table):
+            # the snapshot predates the current block (or its tables): read the
+            # master table now rather than drop writes until maintenance does
+            self.reload()
+
+        self.mx_worker = MaintenanceWorker(self, config.MAINTENANCE_LOCK)
+        self.save_snapshot()
+        config.subscribe(self.configure)
+
+    def configure(self, previous, current):
+        """Apply a new configuration to the caches and write policies (new
+           shard rates and column points take effect from the next column).
+        """
+        table_status.ttl = int(current.MX_STATUS_TTL)
+        shard_policy.shard_rate = float(current.STORE_SHARD_RATE)
+        shard_policy.max_shards = int(current.STORE_MAX_SHARDS)
+        height_policy.column_points = float(current.STORE_COLUMN_POINTS)
+        if int(current.CACHE_WRITE_INDEX_KEY) != int(previous.CACHE_WRITE_INDEX_KEY):
+            shard_policy.series = util.resized_cache(shard_policy.series, int(current.CACHE_WRITE_INDEX_KEY))
+            height_policy.metrics = util.resized_cache(height_policy.metrics, int(current.CACHE_WRITE_INDEX_KEY))
+        for block in self.blocks:
+            block.indexed.columns = int(current.CACHE_INDEX_COLUMNS)
 
     def start_maintenance(self):
         """Start maintenance worker.
@@ -389,7 +768,14 @@ class DatapointsSchema(object):
     def create_block(self, timestamp):
         """Create the block for time timestamp.
         """
-        return self.blocks[block_pos(timestamp)].replace(timestamp)
+        block = self.blocks[block_pos(timestamp)]
+        tables = filter(None, [block.data_points_name, block.index_name, block.compact_name])
+        tbase = block.tbase
+        block.replace(timestamp)
+        if block.tbase != tbase and self.autoscaler.enabled:
+            for table_name in tables:
+                self.autoscaler.forget(table_name)
+        return block
 
     def perform_maintenance(self):
         """Perform maintenance tasks.
@@ -411,6 +797,85 @@ class DatapointsSchema(object):
             current = self.create_current()
             current.create_tables()
 
+        if hot_tier:
+            hot_tier.expire(util.now())
+
+        if archive and int(config.get().STORE_ARCHIVE_HISTORY):
+            archive.expire(util.now() - int(config.get().STORE_ARCHIVE_HISTORY))
+
+        self.refresh()
+        self.stop_writers()
+        if int(config.get().STORE_FILTER_BYTES):
+            # filters are built once no process writes to the block: when
+            # compaction seals it or, without compaction, once every process
+            # has seen it turned down (after a status ttl and a grace period)
+            compact = int(config.get().MX_COMPACT)
+            sealed = util.now() - 1000 * int(config.get().MX_STATUS_TTL) - compaction.GRACE
+            for block in self.blocks:
+                if block.state == 'TURNED_DOWN' and not block.item.get('filter') and \
+                        (block.compacted if compact else block.item.get('turned_down', sealed) < sealed):
+                    block.build_filter()
+                    break
+        self.compactor.perform(self.blocks, util.now())
+        self.autoscaler.perform(self.blocks, util.now())
+
+    def refresh(self):
+        """Pick up compaction and filters of blocks by other nodes.
+        """
+        for item in self.master.scan():
+            block = self.blocks[int(item['n'])]
+            if item['tbase'] != block.tbase:
+                continue
+            if (item.get('compact_name'), item.get('compacted')) != (block.compact_name, block.compacted):
+                block.item = dict(item.items())
+                block.bind()
+            elif str(item.get('filter') or '') != str(block.item.get('filter') or '') or \
+                    item.get('turned_down') != block.item.get('turned_down'):
+                block.item = dict(item.items())
+
+    def reload(self):
+        """Rebind blocks whose master items changed (e.g. since the snapshot)
+           or whose tables are not yet bound.
+        """
+        for item in self.master.scan():
+            block = self.blocks[int(item['n'])]
+            if (item['tbase'], item.get('data_points_name'), item.get('index_name')) != \
+                    (block.tbase, block.data_points_name, block.index_name) or \
+                    (block.index_name and not block.index_table):    # not yet bound
+                block.rebind(dict(item.items()))
+        self.from_snapshot = False
+
+    def follow(self):
+        """Pick up the block changes made by the maintenance process of this
+           node (processes not running maintenance).
+        """
+        self.reload()
+        self.refresh()
+        self.stop_writers()
+        if self.autoscaler.enabled:
+            self.autoscaler.flush(util.now())
+
+    def stop_writers(self):
+        """Stop writing to turned down blocks (turned down by any process or
+           node).
+        """
+        for block in self.blocks:
+            if block.dp_writer and block.state == 'TURNED_DOWN':
+                block.dp_writer.flush()
+                block.dp_writer = None
+
+    def save_snapshot(self):
+        """Save the block items and table descriptions to the snapshot (at
+           most every half snapshot ttl).
+        """
+        if time.time() - self.saved < config.SNAPSHOT_TTL / 2:
+            return
+        self.saved = time.time()
+        config.snapshot.update(blocks={
+            'master': dict((int(block.n), block.item) for block in self.blocks),
+            'tables': table_status.descriptions()
+        })
+
     def should_create_next(self):
         """Should the next block be created?
         """
@@ -437,8 +902,11 @@ class DatapointsSchema(object):
         if block:
             return block.store_datapoint(timestamp, metric, tags, value, domain)
 
-    def query_index(self, domain, metric, start_time, end_time):
-        """Query index for keys.
+    def query_index(self, domain, metric, start_time, end_time, executor=None, tags=None):
+        """Query index for keys.  The index tables of the blocks in range are
+           read concurrently on executor (if given) and keys are yielded as
+           index pages arrive.  Blocks whose filter rules out metric (or tags)
+           are skipped.
         """
         now = util.now()
         max_time = now
@@ -452,6 +920,15 @@ class DatapointsSchema(object):
         #           'end_time:  ', end_time,   '\n', \
         #           'diff:      ', end_time - start_time
 
+        archived_keys = []
+        if archive:
+            # the oldest live block is still complete (until it is archived)
+            min_time = base_time(min_time)
+            if start_time < min_time:
+                live = set(block.tbase for block in self.blocks if block.state != 'INITIAL')
+                archived_keys = archive.query_index(util.index_hash_key(domain, metric),
+                                                    start_time, min(end_time, min_time - 1), live)
+
         start_time, end_time = min(max(min_time, start_time), max_time), \
                                max(min(max_time, end_time), min_time)
 
@@ -460,43 +937,81 @@ class DatapointsSchema(object):
         #           'diff:      ', end_time - start_time
         #     print "<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<"
 
-        if start_time == end_time: return []
-
-        ret = []
-        for block in filter(lambda v: v,
-                            [self.get_block(t) for t in range(start_time, end_time + BLOCK_SIZE, BLOCK_SIZE)]):
-            ret.extend(block.query_index(domain, metric, start_time, end_time))
-        return ret
-
-    def query_datapoints(self, index_key, start_time, end_time, attributes=tuple(['value'])):
-        """Query datapoints.
+        if start_time == end_time: return archived_keys
+
+        blocks = filter(lambda v: v and v.may_contain(domain, metric, tags),
+                        [self.get_block(t) for t in range(start_time, end_time + BLOCK_SIZE, BLOCK_SIZE)])
+        queries = [lambda block=block: block.query_index(domain, metric, start_time, end_time)
+                   for block in blocks]
+        if archived_keys:
+            queries.append(lambda: archived_keys)
+        if executor and len(queries) > 1:
+            return util.iter_concurrently(executor, queries)
+        return itertools.chain.from_iterable(query() for query in queries)
+
+    def query_datapoints(self, index_key, start_time, end_time, attributes=tuple(['value']), shard=0):
+        """Query datapoints of one shard of a column (from the hot tier if it
+           has the column, from the archive if the column's block expired).
         """
+        if isinstance(index_key, ArchivedIndexKey):
+            start, end = util.offset_range(index_key, start_time, end_time)
+            return archive.query_datapoints(index_key, start, end, shard)
+        if hot_tier:
+            start, end = util.offset_range(index_key, start_time, end_time)
+            ret = hot_tier.query(index_key.to_data_points_key(shard), index_key.get_tbase(), start, end, util.now())
+            if ret is not None:
+                return ret
         block = self.get_block(index_key.get_tbase())
         ret = []
         if block:
-            ret = block.query_datapoints(index_key, start_time, end_time, attributes)
+            ret = block.query_datapoints(index_key, start_time, end_time, attributes, shard)
         return ret
 
 
 class MaintenanceWorker(Thread):
     """Perform maintenance tasks.
     """
+    INTERVAL = 5    # seconds between maintenance runs
 
-    def __init__(self, blocks):
+    def __init__(self, blocks, lock_path=None):
         super(MaintenanceWorker, self).__init__()
         self.blocks = blocks
+        self.lock_path = lock_path
+        self.lock_file = None
         self.shutdown_ = False
         self.daemon = True
 
     def shutdown(self):
         self.shutdown_ = True
 
+    def elected(self):
+        """Return True if this process runs maintenance: it holds the lock file
+           (if any).  The lock is released when the process exits.
+        """
+        if not self.lock_path or self.lock_file:
+            return True
+        lock_file = open(self.lock_path, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            lock_file.close()
+            return False
+        self.lock_file = lock_file
+        return True
+
     # TODO shutdown
     def run(self):
         while not self.shutdown_:
             try:
-                time.sleep(5)
-                self.blocks.perform_maintenance()
+                time.sleep(MaintenanceWorker.INTERVAL)
+                table_status.refresh(MaintenanceWorker.INTERVAL)
+                if self.blocks.from_snapshot:
+                    self.blocks.reload()
+                if self.elected():
+                    self.blocks.perform_maintenance()
+                else:
+                    self.blocks.follow()
+                self.blocks.save_snapshot()
             except:     # TODO log
                 print "Unexpected error running table maintenance tasks:"
                 traceback.print_exc()
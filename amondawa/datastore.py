@@ -26,11 +26,12 @@ Classes for querying and storing datapoints.
 
 from amondawa import util
 from amondawa.mtime import timeit
-from amondawa.query import AggegatingQueryCallback, ComplexQueryCallback
-from amondawa.query import QueryTask, GatherTask, FREQ_MILLIS
+from amondawa.query import AggegatingQueryCallback, ComplexQueryCallback, GroupingQueryCallback
+from amondawa.query import QueryTask, GatherTask, FREQ_MILLIS, group_by, reader_pool
 from amondawa.query import SimpleQueryCallback, ResamplingQueryCallback
 from amondawa.schema import Schema
 
+import itertools
 import time
 
 
@@ -67,19 +68,25 @@ class Datastore(object):
         return self.dynamodb.get_tag_values(domain)
 
     @timeit
-    def query_database(self, query, query_callback, domain):
-        """Query datapoints by time interval and tags.
+    def query_database(self, query, query_callback, domain, scope=None):
+        """Query datapoints by time interval and tags.  Queries sharing a scope
+           (see QueryScope) share identical datapoints fetches.
         """
-        # for each matching index key, create a datapoints query thread
+        # for each matching index key, create and start a datapoints query
+        # thread (fetches start while later index pages are still loading)
         query_threads = []
+        columns = {}
         for index_key in self._query_index_keys(query.name, query.start_time,
                                                 query.end_time, query.tags, domain):
-            query_threads.append(QueryTask(self.dynamodb, index_key,
-                                           query.start_time, query.end_time))
-
-        # start the query threads
-        for query in query_threads:
-            query.start()
+            # one task per column, covering the most shards it is indexed with
+            column = (index_key.get_tag_string(), index_key.get_tbase(), index_key.get_height())
+            if column in columns:
+                columns[column].widen(index_key.get_shards())
+                continue
+            query_thread = columns[column] = QueryTask(self.dynamodb, index_key,
+                                                       query.start_time, query.end_time, scope)
+            query_thread.start()
+            query_threads.append(query_thread)
 
         gather_thread = GatherTask(query_threads, query_callback)
         gather_thread.start()
@@ -109,8 +116,9 @@ class Datastore(object):
     def _query_index_keys(self, metric, start_time, end_time, tags, domain):
         """Query index keys by time interval and tags.
         """
-        return filter(lambda key: len(tags) == 0 or key.has_tags(tags),
-                      self.dynamodb.query_index(domain, metric, start_time, end_time))
+        return itertools.ifilter(lambda key: len(tags) == 0 or key.has_tags(tags),
+                                 self.dynamodb.query_index(domain, metric, start_time, end_time,
+                                                           reader_pool.domain(domain), tags))
 
 
 class DataPoint(object):
@@ -185,15 +193,24 @@ class QueryMetric(object):
         """
         start, end = cls._time_interval_from_json(json)
         return [cls(start, end, metric['name'], metric.get('aggregate'),
-                    metric.get('downsample'), metric['tags']) for metric in json['metrics']]
+                    metric.get('downsample'), metric['tags'], group_by=metric.get('group_by'))
+                for metric in json['metrics']]
 
     @staticmethod
     def create_callback(query):
+        if query.group_by:
+            group_bys = [group_by(g, query.start_time) for g in query.group_by]
+            return GroupingQueryCallback(group_bys,
+                                         lambda: QueryMetric._create_callback(query))
+        return QueryMetric._create_callback(query)
+
+    @staticmethod
+    def _create_callback(query):
         aggregator = resampler = None
         if query.aggregator:
             aggregator = AggegatingQueryCallback(query.name, query.aggregator)
         if query.downsample:
-            resampler = ResamplingQueryCallback(query.name, query.downsample['name'],
+            resampler = ResamplingQueryCallback(query.name, query.downsample,
                                                 query.downsample['sampling']['value'],
                                                 query.downsample['sampling']['unit'])
         if aggregator:
@@ -232,7 +249,7 @@ class QueryMetric(object):
                 for stend in ('start', 'end'))
 
     def __init__(self, start_time, end_time, name, aggregator=None,
-                 downsample=None, tags=None, cache_time=0):
+                 downsample=None, tags=None, cache_time=0, group_by=None):
         self.start_time = start_time
         self.end_time = end_time
         self.cache_time = cache_time
@@ -240,12 +257,18 @@ class QueryMetric(object):
         self.tags = tags
         self.aggregator = aggregator
         self.downsample = downsample
+        self.group_by = []
+        for g in group_by or []:
+            self.add_group_by(g)
 
     def add_tag(self, name, value):
         self.tags[name] = value
 
     def add_group_by(self, group_by):
-        pass
+        """Group results e.g. {'name': 'tag', 'tags': ['dc']} or {'name': 'time',
+           'range_size': {'value': 1, 'unit': 'hours'}, 'group_count': 24}.
+        """
+        self.group_by.append(group_by)
 
     def is_exclude_tags(self):
         pass
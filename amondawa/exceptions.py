@@ -29,3 +29,9 @@ class WriteTooSkewedError(AmondawaError):
     """Attempt to write to archived table or table outside of buffered history.
     """
     pass
+
+
+class QueryError(AmondawaError):
+    """Invalid or unsupported query (e.g. unknown aggregator or sampling unit).
+    """
+    pass
@@ -0,0 +1,191 @@
+# Copyright (c) 2013 Daniel Gardner
+# All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""
+Membership structures of blocks.
+
+Bloom filters of the series in a block: a block's filter holds 'domain|metric' and 'domain|metric|tag=value' for
+every column in its index.  It is built from the index once no process
+writes to the block any more (it is compacted or, without compaction, was
+turned down long enough ago) and saved in the block's master item; a bulk
+import of a series the filter rules out clears it.  Queries skip blocks whose filter rules out the metric or any of the
+queried tags.
+
+Indexed columns: the index keys a node has written to a block's recent
+columns, so that each index key is written once per column.
+"""
+
+from amondawa import util
+from repoze.lru import LRUCache
+from threading import Lock
+
+import hashlib
+import math
+import numpy as np
+import struct
+
+HEADER = struct.Struct('<IB')
+
+
+class BloomFilter(object):
+    """A bloom filter of bits bits and hashes hash functions.
+    """
+
+    @classmethod
+    def create(cls, count, fp_rate, max_bytes):
+        """A filter sized for count keys at false positive rate fp_rate (but
+           no larger than max_bytes).
+        """
+        count = max(count, 1)
+        bits = int(math.ceil(-count * math.log(fp_rate) / math.log(2) ** 2))
+        bits = min(max(bits, 8), 8 * max_bytes)
+        hashes = int(min(max(round(float(bits) / count * math.log(2)), 1), 16))
+        return cls(bits, hashes)
+
+    @classmethod
+    def from_string(cls, data):
+        bits, hashes = HEADER.unpack_from(data)
+        return cls(bits, hashes, bytearray(data[HEADER.size:]))
+
+    def __init__(self, bits, hashes, data=None):
+        self.bits = bits
+        self.hashes = hashes
+        self.data = data if data is not None else bytearray((bits + 7) / 8)
+
+    def add(self, key):
+        for i in self._positions(key):
+            self.data[i >> 3] |= 1 << (i & 7)
+
+    def __contains__(self, key):
+        return all(self.data[i >> 3] & (1 << (i & 7)) for i in self._positions(key))
+
+    def to_string(self):
+        return HEADER.pack(self.bits, self.hashes) + str(self.data)
+
+    def _positions(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(key).digest())
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+
+def series_keys(domain, metric, tags):
+    """Filter keys of a series.
+    """
+    prefix = '|'.join([domain, metric])
+    return [prefix] + ['%s|%s=%s' % (prefix, name, value) for name, value in tags.items()]
+
+
+def may_contain(bloom, domain, metric, tags=None):
+    """False if no series of metric in the filter has all tags (a dict of tag
+       name to a list of values, any of which match).
+    """
+    prefix = '|'.join([domain, metric])
+    if prefix not in bloom:
+        return False
+    for name, values in (tags or {}).items():
+        if isinstance(values, basestring):
+            continue    # matched as a substring by IndexKey.has_tags
+        if not any('%s|%s=%s' % (prefix, name, value) in bloom for value in values):
+            return False
+    return True
+
+
+class FingerprintSet(object):
+    """A set of 64-bit fingerprints: recent additions are held in a set and
+       merged into a sorted array (8 bytes per fingerprint) in bulk.
+    """
+
+    MERGE = 4096
+
+    def __init__(self):
+        self.merged = np.empty(0, np.uint64)
+        self.recent = set()
+
+    def add(self, fingerprint):
+        self.recent.add(fingerprint)
+        if len(self.recent) >= FingerprintSet.MERGE:
+            self.merged = np.union1d(self.merged, np.fromiter(self.recent, np.uint64, len(self.recent)))
+            self.recent = set()
+
+    def __contains__(self, fingerprint):
+        if fingerprint in self.recent:
+            return True
+        i = np.searchsorted(self.merged, np.uint64(fingerprint))
+        return i < len(self.merged) and self.merged[i] == fingerprint
+
+    def __len__(self):
+        return len(self.merged) + len(self.recent)
+
+
+class IndexedColumns(object):
+    """Index keys written to the most recent columns (of each height) of a
+       block.  Keys are datapoints keys (hex SHA-1) and are remembered by a 64
+       bit fingerprint, so false positives (a skipped index write) are
+       practically impossible.  The key sets of older columns are kept in an
+       LRU of as many columns, so late datapoints do not write their index
+       keys again and again.  Columns in the future do not age the others.
+    """
+
+    def __init__(self, columns):
+        self.columns = columns
+        self.lock = Lock()
+        # (height, tbase) -> FingerprintSet
+        self.sets = {}
+        self.older = LRUCache(max(columns, 1))
+        # height -> newest tbase
+        self.newest = {}
+
+    def __contains__(self, column):
+        """Was (key, shards, tbase, height) added?
+        """
+        key, shards, tbase, height = column
+        fingerprints = self.sets.get((height, tbase))
+        if fingerprints is None:
+            with self.lock:
+                fingerprints = self.older.get((height, tbase))
+        return fingerprints is not None and fingerprint(key, shards) in fingerprints
+
+    def add(self, key, shards, tbase, height):
+        with self.lock:
+            fingerprints = self.sets.get((height, tbase))
+            if fingerprints is None:
+                newest = max(self.newest.get(height, 0), min(tbase, util.now()))
+                if tbase <= newest - self.columns * height:
+                    # late: an older column
+                    fingerprints = self.older.get((height, tbase))
+                    if fingerprints is None:
+                        fingerprints = FingerprintSet()
+                        self.older.put((height, tbase), fingerprints)
+                else:
+                    self.newest[height] = newest
+                    fingerprints = self.sets[(height, tbase)] = FingerprintSet()
+                    for column in self.sets.keys():
+                        if column[0] == height and column[1] <= newest - self.columns * height:
+                            self.older.put(column, self.sets.pop(column))
+            fingerprints.add(fingerprint(key, shards))
+
+
+def fingerprint(key, shards):
+    """64-bit fingerprint of a datapoints key (hex SHA-1) and shard count.
+    """
+    return (int(key[:16], 16) + shards) & 0xffffffffffffffff
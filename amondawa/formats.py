@@ -0,0 +1,186 @@
+# Copyright (c) 2013 Daniel Gardner
+# All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""
+Query response formats.
+
+Three layouts are offered for query results (selected via the Accept header):
+
+  application/json                         [[timestamp, value], ...] pairs
+  application/vnd.amondawa.columnar+json   {'timestamps': [...], 'values': [...]}
+  application/vnd.amondawa.binary          packed little-endian blocks (below)
+
+Binary layout (all integers little-endian):
+
+  header:   'AMDW' (4 bytes), version (uint8), query count (uint32)
+  query:    sample_size (uint32), result count (uint32), results...
+  result:   metadata length (uint32), metadata (utf-8 json: name, tags, ...),
+            point count n (uint32), value kind (1 byte),
+            n timestamps (int64),
+            kind 'f': n values (float64)
+            kind 'j': values length (uint32), values (utf-8 json array)
+"""
+
+from flask import json
+
+import numpy as np
+import struct
+
+JSON = 'application/json'
+COLUMNAR_JSON = 'application/vnd.amondawa.columnar+json'
+BINARY = 'application/vnd.amondawa.binary'
+
+# in order of preference (first is the default)
+MIMETYPES = [JSON, COLUMNAR_JSON, BINARY]
+
+MAGIC = 'AMDW'
+VERSION = 1
+
+FLOAT_VALUES = 'f'
+JSON_VALUES = 'j'
+
+
+def encode(queries, mimetype=JSON):
+    """Encode query results using the format for mimetype.
+    """
+    return ENCODERS[mimetype](queries)
+
+
+def encode_json(queries):
+    """Encode query results as [timestamp, value] pairs.
+    """
+    return json.dumps({'queries': queries})
+
+
+def encode_columnar(queries):
+    """Encode query results as timestamp and value columns.
+    """
+    return json.dumps({'queries': [{
+                'sample_size': query['sample_size'],
+                'results': [_to_columnar(result) for result in query['results']]
+            } for query in queries]})
+
+
+def encode_binary(queries):
+    """Encode query results as packed int64/float64 blocks.
+    """
+    out = [struct.pack('<4sBI', MAGIC, VERSION, len(queries))]
+    for query in queries:
+        results = query['results'] or []
+        out.append(struct.pack('<II', query['sample_size'], len(results)))
+        for result in results:
+            timestamps, values = _split(result['values'])
+            meta = _dumps(_metadata(result))
+            out.append(struct.pack('<I', len(meta)))
+            out.append(meta)
+            ts = np.asarray(timestamps, dtype='<i8')
+            vs = np.asarray(values)
+            if vs.ndim == 1 and vs.dtype.kind in 'iuf':
+                out.append(struct.pack('<Ic', len(ts), FLOAT_VALUES))
+                out.append(ts.tostring())
+                out.append(vs.astype('<f8').tostring())
+            else:
+                # non-numeric values (strings, lists, dicts) travel as json
+                vs = _dumps(list(values))
+                out.append(struct.pack('<Ic', len(ts), JSON_VALUES))
+                out.append(ts.tostring())
+                out.append(struct.pack('<I', len(vs)))
+                out.append(vs)
+    return ''.join(out)
+
+
+def decode_binary(data):
+    """Decode binary query results into the columnar layout; timestamps and
+       numeric values are returned as numpy arrays.
+    """
+    magic, version, count = struct.unpack_from('<4sBI', data, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('not an amondawa binary response (magic=%r, version=%s)' %
+                         (magic, version))
+    pos = struct.calcsize('<4sBI')
+    queries = []
+    for _ in range(count):
+        sample_size, nresults = struct.unpack_from('<II', data, pos)
+        pos += 8
+        results = []
+        for _ in range(nresults):
+            meta_len, = struct.unpack_from('<I', data, pos)
+            pos += 4
+            result = json.loads(data[pos:pos + meta_len])
+            pos += meta_len
+            n, kind = struct.unpack_from('<Ic', data, pos)
+            pos += 5
+            result['timestamps'] = _frombuffer(data, '<i8', n, pos)
+            pos += 8 * n
+            if kind == FLOAT_VALUES:
+                result['values'] = _frombuffer(data, '<f8', n, pos)
+                pos += 8 * n
+            else:
+                values_len, = struct.unpack_from('<I', data, pos)
+                pos += 4
+                result['values'] = json.loads(data[pos:pos + values_len])
+                pos += values_len
+            results.append(result)
+        queries.append({'sample_size': sample_size, 'results': results})
+    return {'queries': queries}
+
+
+def _dumps(obj):
+    """Json encode to utf-8 bytes (lengths are byte counts).
+    """
+    return json.dumps(obj).encode('utf-8')
+
+
+def _frombuffer(data, dtype, count, offset):
+    if not count:
+        return np.empty(0, dtype=dtype)
+    return np.frombuffer(data, dtype=dtype, count=count, offset=offset)
+
+
+def _split(values):
+    """Split [(timestamp, value), ...] into timestamp and value columns.
+    """
+    if not len(values):
+        return [], []
+    timestamps, values = zip(*values)
+    return timestamps, values
+
+
+def _metadata(result):
+    """Everything in a result except the datapoints.
+    """
+    return dict((k, v) for k, v in result.items() if k != 'values')
+
+
+def _to_columnar(result):
+    timestamps, values = _split(result['values'])
+    ret = _metadata(result)
+    ret['timestamps'] = list(timestamps)
+    ret['values'] = list(values)
+    return ret
+
+
+ENCODERS = {
+    JSON: encode_json,
+    COLUMNAR_JSON: encode_columnar,
+    BINARY: encode_binary
+}
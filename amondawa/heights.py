@@ -0,0 +1,99 @@
+# Copyright (c) 2013 Daniel Gardner
+# All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""
+Per metric column height.
+
+A metric's columns are HEIGHT milliseconds high, where height is one of the
+configured height classes (each dividing the block size, so columns never
+straddle blocks).  The height is fixed per metric and block: it is chosen
+when the metric's first datapoint of the block arrives, either from a
+configured per metric value or from the metric's rate in the previous block,
+so that columns hold about STORE_COLUMN_POINTS datapoints per series.
+
+The default height (STORE_COLUMN_HEIGHT) is not recorded in keys, so
+existing data keeps its layout.
+"""
+
+from repoze.lru import LRUCache
+from threading import Lock
+
+
+class HeightPolicy(object):
+    """Choose the column height of metrics.
+    """
+
+    def __init__(self, default, classes, block_size, column_points, overrides=None, size=1000):
+        self.default = default
+        self.classes = sorted(set(int(h) for h in classes or [] if block_size % int(h) == 0) | set([default]))
+        self.max_height = self.classes[-1]
+        self.block_size = block_size
+        self.column_points = float(column_points)
+        self.overrides = dict((metric, int(height)) for metric, height in (overrides or {}).items()
+                              if int(height) in self.classes)
+        self.lock = Lock()
+        # metric -> [block tbase, counted since, datapoints, series, height,
+        #            previous tbase, previous height]
+        self.metrics = LRUCache(size)
+
+    def height(self, metric, series, timestamp, block_tbase):
+        """Count a datapoint of metric (and series) at timestamp in block
+           block_tbase and return the column height of the metric in that block.
+        """
+        if metric in self.overrides:
+            return self.overrides[metric]
+        if len(self.classes) == 1:
+            return self.default
+        with self.lock:
+            state = self.metrics.get(metric)
+            if state is None:
+                state = [block_tbase, timestamp, 0, set(), self.default, None, self.default]
+                self.metrics.put(metric, state)
+            elif block_tbase > state[0]:
+                # new block: height for the rate in the previous one
+                height = self.choose(state[2], len(state[3]), block_tbase - state[1])
+                state[:] = [block_tbase, block_tbase, 0, set(), height, state[0], state[4]]
+            elif block_tbase < state[0]:
+                # late datapoint
+                return state[6] if block_tbase == state[5] else self.default
+            state[2] += 1
+            state[3].add(series)
+            return state[4]
+
+    def height_for(self, metric, count, series, period):
+        """Height of metric in a block given count datapoints of series in
+           period milliseconds (bulk loads, which know their rate upfront).
+        """
+        if metric in self.overrides:
+            return self.overrides[metric]
+        return self.choose(count, series, period)
+
+    def choose(self, count, series, period):
+        """Height for a metric with count datapoints of series in period
+           milliseconds: the largest class with at most column_points datapoints
+           per series column.
+        """
+        if not count or period <= 0:
+            return self.default
+        rate = float(count) / max(series, 1) / period
+        fits = [h for h in self.classes if h * rate <= self.column_points]
+        return fits[-1] if fits else self.classes[0]
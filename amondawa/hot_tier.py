@@ -0,0 +1,199 @@
+# Copyright (c) 2013 Daniel Gardner
+# All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""
+Local hot tier: recent datapoints columns kept in memory-mapped files on the
+node that ingested them.
+
+Each column (datapoints key, tbase) is a file of fixed width records
+(int64 toffset, float64 value) appended in arrival order.  Only numeric
+columns are kept; a column that receives any other value is marked mixed and
+served from the datastore, as is a column written around the tier (by a bulk
+import, see bypass).
+
+The tier is only complete for columns that started after the tier was created
+and assumes this node ingests all datapoints (single node deployments) in one
+process (it is disabled when AMDW_WORKERS > 1).  A column without a file is
+read from the datastore, in case it was written elsewhere.
+"""
+
+from threading import Lock
+
+import mmap
+import numpy as np
+import os
+import shutil
+import struct
+import time
+
+RECORD = np.dtype([('toffset', '<i8'), ('value', '<f8')])
+MAGIC = 'AMDH'
+HEADER = struct.Struct('<4sxxxxq')       # magic, record count
+GROWTH = 4096                            # records added when a file is full
+START_FILE = 'START'
+
+
+class HotColumn(object):
+    """Append only, memory-mapped records of one column.
+    """
+
+    def __init__(self, path):
+        self.lock = Lock()
+        exists = os.path.exists(path)
+        self.file = open(path, 'r+b' if exists else 'w+b')
+        if not exists:
+            self.file.truncate(HEADER.size + GROWTH * RECORD.itemsize)
+        self.mm = mmap.mmap(self.file.fileno(), 0)
+        magic, self.count = HEADER.unpack_from(self.mm)
+        if not exists or magic != MAGIC:
+            self.count = 0
+            HEADER.pack_into(self.mm, 0, MAGIC, 0)
+
+    def append(self, toffset, value):
+        with self.lock:
+            offset = HEADER.size + self.count * RECORD.itemsize
+            if offset + RECORD.itemsize > len(self.mm):
+                self._grow()
+            struct.pack_into('<qd', self.mm, offset, toffset, value)
+            self.count += 1
+            HEADER.pack_into(self.mm, 0, MAGIC, self.count)
+
+    def read(self, start, end):
+        """Return the latest value of each toffset in [start, end], ascending.
+        """
+        with self.lock:
+            records = np.frombuffer(self.mm, RECORD, self.count, HEADER.size).copy()
+        records = records[(records['toffset'] >= start) & (records['toffset'] <= end)]
+        # last write of a toffset wins (as an overwrite in the datastore)
+        records = records[::-1]
+        _, first = np.unique(records['toffset'], return_index=True)
+        return records[first]
+
+    def close(self):
+        with self.lock:
+            self.mm.close()
+            self.file.close()
+
+    def _grow(self):
+        self.mm.close()
+        self.file.truncate(os.fstat(self.file.fileno()).st_size + GROWTH * RECORD.itemsize)
+        self.mm = mmap.mmap(self.file.fileno(), 0)
+
+
+class HotTier(object):
+    """The most recent columns of every series, stored under directory as
+     <tbase>/<datapoints key>.
+    """
+
+    def __init__(self, directory, column_height, columns=2):
+        self.directory = directory
+        self.column_height = column_height
+        self.columns = columns
+        self.lock = Lock()
+        self.open = {}
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.start = self._start()
+
+    def covers(self, tbase, now):
+        """Is column tbase complete and retained?
+        """
+        return tbase >= self.start and tbase >= self.oldest(now)
+
+    def oldest(self, now):
+        """Base time of the oldest retained column.
+        """
+        return now - now % self.column_height - (self.columns - 1) * self.column_height
+
+    def append(self, key, tbase, toffset, value, now):
+        if not self.covers(tbase, now):
+            return
+        path = self._path(key, tbase)
+        if isinstance(value, (bool, basestring, set, frozenset)):
+            self._mark_mixed(key, tbase)
+            return
+        column = self._column(key, tbase, path)
+        if column:
+            column.append(toffset, float(value))
+
+    def query(self, key, tbase, start, end, now):
+        """Datapoints of column in [start, end] as datastore items, ascending,
+           or None if the column must be read from the datastore.
+        """
+        if not self.covers(tbase, now):
+            return None
+        path = self._path(key, tbase)
+        if os.path.exists(path + '.mixed'):
+            return None
+        column = self._column(key, tbase, path, create=False)
+        if not column:
+            return None
+        return [{'toffset': int(toffset), 'value': value}
+                for toffset, value in column.read(start, end).tolist()]
+
+    def bypass(self, key, tbase, now):
+        """Serve column from the datastore from now on (it is being written
+           around the tier).
+        """
+        if self.covers(tbase, now):
+            self._mark_mixed(key, tbase)
+
+    def expire(self, now):
+        """Delete columns that are no longer retained.
+        """
+        oldest = self.oldest(now)
+        with self.lock:
+            for key in [k for k in self.open if k[1] < oldest]:
+                self.open.pop(key).close()
+        for name in os.listdir(self.directory):
+            if name.isdigit() and int(name) < oldest:
+                shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+
+    def _column(self, key, tbase, path, create=True):
+        with self.lock:
+            column = self.open.get((key, tbase))
+            if column is None and (create or os.path.exists(path)):
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                column = self.open[(key, tbase)] = HotColumn(path)
+            return column
+
+    def _mark_mixed(self, key, tbase):
+        path = self._path(key, tbase)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        open(path + '.mixed', 'a').close()
+
+    def _path(self, key, tbase):
+        return os.path.join(self.directory, str(tbase), key)
+
+    def _start(self):
+        """Time the tier started ingesting (kept across restarts).
+        """
+        path = os.path.join(self.directory, START_FILE)
+        if os.path.exists(path):
+            with open(path) as f:
+                return int(f.read())
+        start = int(round(time.time() * 1000))
+        with open(path, 'w') as f:
+            f.write(str(start))
+        return start
@@ -24,18 +24,45 @@
 HTTP related classes.
 """
 
-from amondawa import config
+from amondawa import config, formats, streams
+from amondawa.admission import Admission, READ, WRITE
 from amondawa.server_auth import authorized
 from amondawa.datastore import QueryMetric, DataPointSet, Datastore
+from amondawa.exceptions import QueryError
 from amondawa.mtime import timeit
+from amondawa.query import QueryScope
 
 from flask import Flask, request, json
+from werkzeug.exceptions import BadRequest
 
 import amondawa
 
 app = Flask('amondawa')
 
 datastore = Datastore(amondawa.connect(config.REGION))
+config.watch()
+
+admission = Admission(config.WORKERS)
+
+TOO_MANY_REQUESTS = 'Too Many Requests', 429, [('Retry-After', '1')]
+
+
+@app.errorhandler(QueryError)
+def bad_query(error):
+    return str(error), 400, []
+
+
+def request_json(array=False):
+    """Parse the JSON request body as it streams in (element by element if
+       array), checking it against its signed hash (if sent).  Return None if
+       it does not match.
+    """
+    stream = streams.PayloadStream(request.stream, request.headers.get('x-amz-content-sha256'))
+    try:
+        body = list(streams.iter_json_array(stream)) if array else json.load(stream)
+    except ValueError as e:
+        raise BadRequest('invalid JSON body: %s' % e)
+    return body if stream.verify() else None
 
 
 @app.route('/api/v1/<domain>/datapoints', methods=['POST'])
@@ -44,10 +71,22 @@ def add_datapoints(domain):
     """
     if not authorized(request, domain, 'w'):
         return 'Forbidden', 403, []
+    if not admission.admit(domain, WRITE, 0):
+        return TOO_MANY_REQUESTS
+
+    try:
+        body = request_json(array=True)
+        if body is None:
+            return 'Forbidden', 403, []
 
-    for dps in DataPointSet.from_json_object(request.get_json()):
-        datastore.put_data_points(dps, domain)
-    return '', 204, []
+        datapoint_sets = DataPointSet.from_json_object(body)
+        if not admission.take(domain, WRITE, sum(len(dps) for dps in datapoint_sets)):
+            return TOO_MANY_REQUESTS
+        for dps in datapoint_sets:
+            datastore.put_data_points(dps, domain)
+        return '', 204, []
+    finally:
+        admission.release(domain, WRITE)
 
 
 @app.route('/api/v1/<domain>/datapoints/query', methods=['POST'])
@@ -55,18 +94,33 @@ def add_datapoints(domain):
 def query_database(domain):
     """Returns a list of metric values based on a set of criteria. Also returns a
       set of all tag names and values that are found across the data points.
+
+      The response layout is negotiated via the Accept header (see formats).
     """
     if not authorized(request, domain, 'r'):
         return 'Forbidden', 403, []
+    if not admission.admit(domain, READ):
+        return TOO_MANY_REQUESTS
 
-    # spawn all threads
-    gather_threads = [datastore.query_database(query, QueryMetric.create_callback(query), domain) \
-                      for query in QueryMetric.from_json_object(request.get_json())]
+    try:
+        body = request_json()
+        if body is None:
+            return 'Forbidden', 403, []
 
-    return (json.dumps({'queries': [{
-                'sample_size': result.sample_size,
-                'results': result.results
-            } for result in [t.get_result() for t in gather_threads]]}), 200, [])
+        mimetype = request.accept_mimetypes.best_match(formats.MIMETYPES, formats.JSON)
+
+        # spawn all threads (sub-queries share identical datapoints fetches)
+        scope = QueryScope(domain=domain)
+        gather_threads = [datastore.query_database(query, QueryMetric.create_callback(query), domain, scope) \
+                          for query in QueryMetric.from_json_object(body)]
+
+        return (formats.encode([{
+                    'sample_size': result.sample_size,
+                    'results': result.results
+                } for result in [t.get_result() for t in gather_threads]], mimetype),
+                200, [('Content-Type', mimetype)])
+    finally:
+        admission.release(domain, READ)
 
 
 @app.route('/api/v1/<domain>/datapoints/query/tags', methods=['POST'])
@@ -76,11 +130,20 @@ def query_metric_tags(domain):
     """
     if not authorized(request, domain, 'r'):
         return 'Forbidden', 403, []
-
-    return (json.dumps({'results': [{
-                'name': query.name,
-                'tags': datastore.query_metric_tags(query, domain)
-            } for query in QueryMetric.from_json_object(request.get_json())]}), 200, [])
+    if not admission.admit(domain, READ):
+        return TOO_MANY_REQUESTS
+
+    try:
+        body = request_json()
+        if body is None:
+            return 'Forbidden', 403, []
+
+        return (json.dumps({'results': [{
+                    'name': query.name,
+                    'tags': datastore.query_metric_tags(query, domain)
+                } for query in QueryMetric.from_json_object(body)]}), 200, [])
+    finally:
+        admission.release(domain, READ)
 
 
 @app.route('/api/v1/<domain>/metricnames')
@@ -0,0 +1,222 @@
+# Copyright (c) 2013 Daniel Gardner
+# All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""
+Bulk import of historical datapoints.
+
+Datapoints are read a chunk at a time, sorted and grouped by metric, block,
+series and column, and each column is written straight to its block's
+tables with batch writes, bypassing the HTTP interface and the buffered
+write path.  A metric keeps the column height its block's index already
+records (else the height is chosen from the first chunk's counts and kept
+for later chunks); shard counts are chosen from each column's size.
+Columns are written concurrently by a pool of writers, paced by a token
+bucket (Governor).  Imported columns are served from the datastore rather
+than the hot tier (run the import with the server's AMDW_HOT_TIER_DIR).
+
+Datapoints outside the blocks that can still be written (ACTIVE or
+TURNED_DOWN and not being compacted) are skipped.
+
+Input formats:
+
+  csv     metric,timestamp,value[,tag=value ...]
+  json    one JSON object per line, in the format of the datapoints POST
+          body: {"name": ..., "tags": {...}, "timestamp": ..., "value": ...}
+          or {"name": ..., "tags": {...}, "datapoints": [[timestamp, value], ...]}
+"""
+
+from amondawa import util
+from amondawa.datapoints_schema import BLOCK_SIZE, height_policy, shard_policy, table_status
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+import csv
+import itertools
+import json
+import operator
+import time
+
+FORMATS = ('csv', 'json')
+# datapoints written per governor request
+SLICE = 100
+
+
+def read_csv(lines):
+    """Yield (metric, tags, timestamp, value) of csv lines.
+    """
+    for row in csv.reader(line for line in lines if line.strip() and not line.startswith('#')):
+        metric, timestamp, value = row[:3]
+        try:
+            value = float(value)
+        except ValueError:
+            pass
+        yield metric, dict(tag.split('=', 1) for tag in row[3:]), int(timestamp), \
+            util.to_dynamo_compat_type(value)
+
+
+def read_json(lines):
+    """Yield (metric, tags, timestamp, value) of JSON lines.
+    """
+    for line in lines:
+        if not line.strip():
+            continue
+        o = json.loads(line)
+        if 'timestamp' in o:
+            yield o['name'], o['tags'], int(o['timestamp']), util.to_dynamo_compat_type(o['value'])
+        else:
+            for timestamp, value in o['datapoints']:
+                yield o['name'], o['tags'], int(timestamp), util.to_dynamo_compat_type(value)
+
+
+class Governor(object):
+    """Token bucket limiting the datapoints written per second.
+    """
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.tokens = self.rate
+        self.last = time.time()
+        self.lock = Lock()
+
+    def acquire(self, n):
+        """Take n tokens, sleeping while the bucket is in debt.
+        """
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate) - n
+            self.last = now
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+class Importer(object):
+    """Write datapoints directly to a schema's blocks.
+    """
+
+    def __init__(self, schema, domain, writers=8, rate=0, chunk_points=500000):
+        self.schema = schema
+        self.domain = domain
+        self.chunk_points = chunk_points
+        self.governor = Governor(rate) if rate else None
+        self.executor = ThreadPoolExecutor(max_workers=writers)
+        self.lock = Lock()
+        self.read = self.written = self.skipped = 0
+        self.started = time.time()
+        self.throughput = {}
+        self.heights = {}   # (block tbase, metric) -> column height
+
+    def load(self, datapoints):
+        """Import (metric, tags, timestamp, value) datapoints.
+        """
+        chunk = []
+        for metric, tags, timestamp, value in datapoints:
+            chunk.append((metric, timestamp - timestamp % BLOCK_SIZE, util.tag_string(tags), timestamp, value))
+            if len(chunk) >= self.chunk_points:
+                self._load_chunk(chunk)
+                chunk = []
+        if chunk:
+            self._load_chunk(chunk)
+
+    def raise_write_throughput(self, write):
+        """Raise the write throughput of writable blocks' datapoints tables (see
+           restore_throughput).
+        """
+        for block in self._writable():
+            table = block.data_points_table
+            provisioned = table_status.describe(table)['Table']['ProvisionedThroughput']
+            if provisioned['WriteCapacityUnits'] < write:
+                self.throughput[table] = {'read': provisioned['ReadCapacityUnits'],
+                                          'write': provisioned['WriteCapacityUnits']}
+                table.update({'read': provisioned['ReadCapacityUnits'], 'write': write})
+                table_status.invalidate(table)
+
+    def restore_throughput(self):
+        """Restore the throughput changed by raise_write_throughput.
+        """
+        for table, throughput in self.throughput.items():
+            table.update(throughput)
+            table_status.invalidate(table)
+        self.throughput = {}
+
+    def progress(self):
+        """Progress report.
+        """
+        elapsed = time.time() - self.started
+        return 'read: %d written: %d skipped: %d elapsed: %ds rate: %d points/s' % \
+               (self.read, self.written, self.skipped, elapsed, self.written / max(elapsed, 1))
+
+    def close(self):
+        self.executor.shutdown()
+
+    def _writable(self):
+        return [block for block in self.schema.blocks.blocks
+                if block.data_points_table and not block.compact_name and
+                block.state in ('ACTIVE', 'TURNED_DOWN')]
+
+    def _load_chunk(self, chunk):
+        """Sort, group and write a chunk of datapoints; return once written.
+        """
+        with self.lock:
+            self.read += len(chunk)
+        chunk.sort(key=operator.itemgetter(0, 1, 2, 3))
+        writable = dict((block.tbase, block) for block in self._writable())
+        futures = []
+        for (metric, block_tbase), rows in itertools.groupby(chunk, operator.itemgetter(0, 1)):
+            rows = list(rows)
+            block = writable.get(block_tbase)
+            if not block:
+                with self.lock:
+                    self.skipped += len(rows)
+                continue
+            block.clear_filter()    # rebuilt by maintenance
+            height = self._height(block, metric, rows)
+            for tag_string, series_rows in itertools.groupby(rows, operator.itemgetter(2)):
+                tags = util.tags_from_string(tag_string) if tag_string else {}
+                self.schema.store_series(self.domain, metric, tags)
+                for _, column in itertools.groupby(series_rows, lambda row: row[3] - row[3] % height):
+                    points = [(row[3], row[4]) for row in column]
+                    futures.append(self.executor.submit(self._write_column, block, metric, tags, points, height))
+        for future in futures:
+            future.result()
+
+    def _height(self, block, metric, rows):
+        """Column height of metric in block: the height of its columns already
+           indexed, else one chosen for rows.
+        """
+        key = (block.tbase, metric)
+        if key not in self.heights:
+            height = block.metric_height(self.domain, metric)
+            if height is None:
+                height = height_policy.height_for(metric, len(rows), len(set(row[2] for row in rows)), BLOCK_SIZE)
+            self.heights[key] = height
+        return self.heights[key]
+
+    def _write_column(self, block, metric, tags, points, height):
+        shards = shard_policy.shards_for(metric, len(points), height)
+        for i in range(0, len(points), SLICE):
+            points_ = points[i:i + SLICE]
+            if self.governor:
+                self.governor.acquire(len(points_))
+            block.store_column(self.domain, metric, tags, points_, height, shards)
+            with self.lock:
+                self.written += len(points_)
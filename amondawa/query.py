@@ -25,16 +25,40 @@ Classes for querying datapoints.
 """
 
 from amondawa import util, config
+from amondawa.admission import FairExecutor
+from amondawa.exceptions import QueryError
 from amondawa.mtime import timeit
+from amondawa.sketch import DDSketch, RELATIVE_ACCURACY
 from concurrent.futures import ThreadPoolExecutor
-from pandas.tseries import frequencies as freq
+from threading import RLock
+import collections
+import itertools
+import operator
 import numpy as np
-import pandas as pd
 
+per_worker = config.per_worker
+subscribe = config.subscribe
 config = config.get()
 
 # TODO: shutdown gracefully
-thread_pool = ThreadPoolExecutor(max_workers=config.MT_WRITERS)
+thread_pool = ThreadPoolExecutor(max_workers=per_worker(config.MT_WRITERS))
+# datapoints fetches (kept apart from the gather tasks that wait on them),
+# fairly queued by domain
+reader_pool = FairExecutor(per_worker(config.MT_READERS))
+
+
+def configure(previous, current):
+    """Resize the thread pools to a new configuration.
+    """
+    global thread_pool
+    if per_worker(current.MT_WRITERS) != per_worker(previous.MT_WRITERS):
+        # running and queued gather tasks finish in the previous pool
+        thread_pool, previous_pool = ThreadPoolExecutor(max_workers=per_worker(current.MT_WRITERS)), thread_pool
+        previous_pool.shutdown(wait=False)
+    if per_worker(current.MT_READERS) != per_worker(previous.MT_READERS):
+        reader_pool.resize(per_worker(current.MT_READERS))
+
+subscribe(configure, config)
 
 # time intervals
 FREQ_MILLIS = {
@@ -48,36 +72,215 @@ FREQ_MILLIS = {
     'years': 1000 * 60 * 60 * 24 * 365
 }
 
+# pandas offsets (name, n) of the time intervals
 FREQ_TYPE = {
-    'milliseconds': freq.Milli(),
-    'seconds': freq.Second(),
-    'minutes': freq.Minute(),
-    'hours': freq.Hour(),
-    'days': freq.Day(),
-    'weeks': freq.Week(),
-    'months': freq.Day(30),
-    'years': freq.Day(365)
+    'milliseconds': ('Milli', 1),
+    'seconds': ('Second', 1),
+    'minutes': ('Minute', 1),
+    'hours': ('Hour', 1),
+    'days': ('Day', 1),
+    'weeks': ('Week', 1),
+    'months': ('Day', 30),
+    'years': ('Day', 365)
 }
 
+
+# pandas is imported on first use (it dominates the import time of a server
+# process)
+def freq_type(unit):
+    """The pandas offset of time interval unit.
+    """
+    from pandas.tseries import frequencies as freq
+    name, n = FREQ_TYPE[unit]
+    return getattr(freq, name)(n)
+
+
+def to_series(values, index):
+    """A pandas time series of values at index (millis).
+    """
+    import pandas as pd
+    return pd.Series(values, pd.to_datetime(index, unit='ms'))
+
+
+class SketchAggregator(object):
+    """Summarize the values in each bucket with a mergeable quantile sketch.
+     Sketches of different series (or buckets) are merged before being
+     summarized.
+    """
+    PARAMS = ('relative_accuracy',)
+
+    def __init__(self, relative_accuracy=RELATIVE_ACCURACY):
+        self.relative_accuracy = float(relative_accuracy)
+        if not 0 < self.relative_accuracy < 1:
+            raise QueryError('relative_accuracy must be between 0 and 1: %s' % relative_accuracy)
+
+    def sketch(self):
+        return DDSketch(self.relative_accuracy)
+
+    def summarize(self, sketch):
+        raise NotImplementedError()
+
+
+class Percentile(SketchAggregator):
+    """Percentile (0 <= percentile <= 1) of the values in each bucket.
+    """
+    PARAMS = ('percentile', 'relative_accuracy')
+
+    def __init__(self, percentile=0.5, relative_accuracy=RELATIVE_ACCURACY):
+        super(Percentile, self).__init__(relative_accuracy)
+        self.percentile = float(percentile)
+        if not 0 <= self.percentile <= 1:
+            raise QueryError('percentile must be between 0 and 1: %s' % percentile)
+
+    def summarize(self, sketch):
+        return sketch.quantile(self.percentile)
+
+
+class Histogram(SketchAggregator):
+    """Distribution of the values in each bucket as [[value, count], ...].
+    """
+
+    def summarize(self, sketch):
+        return sketch.histogram()
+
+
+class Rate(object):
+    """Rate of change of a counter per unit of time.  A decrease is taken to
+     be a counter reset: the counter is assumed to have restarted from zero.
+    """
+    PARAMS = ('unit',)
+
+    def __init__(self, unit='seconds'):
+        if unit not in FREQ_MILLIS:
+            raise QueryError('unknown rate unit: %s' % unit)
+        self.millis = FREQ_MILLIS[unit]
+
+    def rates(self, values, index):
+        """Return (rates, index) for counter values observed at index (millis).
+        """
+        index = np.asarray(index, dtype=np.int64)
+        values = np.asarray(values, dtype=float)
+        order = np.argsort(index, kind='mergesort')
+        index, values = index[order], values[order]
+        dv, dt = np.diff(values), np.diff(index)
+        dv = np.where(dv < 0, values[1:], dv)   # reset
+        keep = dt > 0
+        return dv[keep] * self.millis / dt[keep], index[1:][keep]
+
+    def rate_series(self, series):
+        """Rate of a pandas time series.
+        """
+        values, index = self.rates(series.values, series.index.asi8 // 1000000)
+        return to_series(values, index)
+
+
 AGGREGATORS = {
     'avg': np.mean,
     'dev': np.std,
     'div': None,
-    'histogram': None,
+    'histogram': Histogram,
     'least_squares': None,
     'max': np.max,
     'min': np.min,
-    'rate': None,
+    'percentile': Percentile,
+    'rate': Rate,
     'sum': np.sum
 }
 
+
+def aggregator(how, **defaults):
+    """Look up aggregator how: a name or a dict with 'name' and parameters
+     (e.g. {'name': 'percentile', 'percentile': 0.95}).  Parameterized
+     aggregators are instantiated with their parameters.
+    """
+    params = dict(defaults)
+    if isinstance(how, dict):
+        params.update(how)
+        how = how.get('name')
+    if AGGREGATORS.get(how) is None:
+        raise QueryError('unsupported aggregator: %s' % how)
+    how = AGGREGATORS[how]
+    if isinstance(how, type):
+        return how(**dict((k, params[k]) for k in how.PARAMS if k in params))
+    return how
+
+
+class SketchSeries(object):
+    """A time series of per-bucket sketches.
+    """
+
+    def __init__(self, times, sketches, how):
+        self.times = times
+        self.sketches = sketches
+        self.how = how
+
+    def to_series(self):
+        """Summarize to a pandas time series.
+        """
+        return to_series([self.how.summarize(s) for s in self.sketches], self.times)
+
+    def to_data_points(self):
+        return zip([int(t) for t in self.times],
+                   [self.how.summarize(s) for s in self.sketches])
+
+
 # TODO optimize
 @timeit
 def resample(values, index, rule, how):
     """Downsample to fewer points.  This call will not add points (fill).
     """
-    return pd.Series(values,
-                     pd.to_datetime(index, unit='ms')).resample(rule, how).dropna()
+    return to_series(values, index).resample(rule, how).dropna()
+
+
+@timeit
+def sketch_resample(values, index, period, how):
+    """Downsample to one sketch per period (millis).
+    """
+    index = np.asarray(index, dtype=np.int64)
+    values = np.asarray(values, dtype=float)
+    times, inverse = np.unique(index - index % period, return_inverse=True)
+    order = np.argsort(inverse, kind='mergesort')
+    bounds = np.searchsorted(inverse[order], np.arange(len(times) + 1))
+    values = values[order]
+    return SketchSeries(times, [how.sketch().extend(values[bounds[i]:bounds[i + 1]])
+                                for i in range(len(times))], how)
+
+
+def downsample(values, index, rule, period, how):
+    """Downsample using aggregator how (see AGGREGATORS).
+    """
+    if isinstance(how, SketchAggregator):
+        return sketch_resample(values, index, period, how)
+    if isinstance(how, Rate):
+        values, index = how.rates(values, index)
+        return resample(values, index, rule, np.mean)
+    return resample(values, index, rule, how)
+
+
+def merge_sketches(series_list, how):
+    """Merge sketch series bucket by bucket.
+    """
+    merged = {}
+    for series in series_list:
+        for t, sketch in zip(series.times, series.sketches):
+            if t not in merged:
+                merged[t] = how.sketch()
+            merged[t].merge(sketch)
+    times = sorted(merged)
+    return SketchSeries(np.asarray(times, dtype=np.int64), [merged[t] for t in times], how)
+
+
+def to_pandas(series):
+    if isinstance(series, SketchSeries):
+        return series.to_series()
+    return series
+
+
+def to_sketches(series, period, how):
+    if isinstance(series, SketchSeries):
+        return series
+    return sketch_resample(series.values, series.index.asi8 // 1000000, period, how)
+
 
 # TODO optimize
 @timeit
@@ -89,7 +292,7 @@ def aggregate(series_list, how):
         mean = True
         how = np.sum
     final = series_list[0]
-    for series in series_list:
+    for series in series_list[1:]:
         l, r = map(lambda s: s.interpolate().dropna(), final.align(series))
         final = l.combine(r, lambda v1, v2: how([v1, v2])).dropna()
     if mean:
@@ -97,9 +300,25 @@ def aggregate(series_list, how):
     return final
 
 
+def combine(series_list, how, period):
+    """Aggregate across series using aggregator how.  Sketch aggregators merge
+     per-bucket sketches (raw series are first bucketed by period millis); rate
+     sums the per-series rates.
+    """
+    if isinstance(how, SketchAggregator):
+        return merge_sketches([to_sketches(s, period, how) for s in series_list], how)
+    series_list = map(to_pandas, series_list)
+    if isinstance(how, Rate):
+        series_list = map(how.rate_series, series_list)
+        how = np.sum
+    return aggregate(series_list, how)
+
+
 def to_data_points(series):
     """Convert pandas time series back to datapoints array.
     """
+    if isinstance(series, SketchSeries):
+        return series.to_data_points()
     timestamps = [int(round(dt.value / 1e6)) for dt in series.index]
     return zip(timestamps, series.values)
 
@@ -141,8 +360,11 @@ class ResamplingQueryCallback(object):
 
     def __init__(self, metric, how='avg', value=1, unit='seconds'):
         self.metric = metric
-        self.how = AGGREGATORS[how]          # TODO: check, raise exception here
-        self.rule = value * FREQ_TYPE[unit]  # TODO: check, raise exception here
+        if unit not in FREQ_TYPE:
+            raise QueryError('unknown sampling unit: %s' % unit)
+        self.how = aggregator(how, unit=unit)
+        self.rule = value * freq_type(unit)
+        self.period = int(value * FREQ_MILLIS[unit])
         self.results = []
         self.sample_size = 0
         self.index = self.values = None
@@ -161,7 +383,8 @@ class ResamplingQueryCallback(object):
 
     def end_datapoint_set(self):
         if self.current:
-            self.current['series'] = resample(self.values, self.index, self.rule, self.how)
+            self.current['series'] = downsample(self.values, self.index, self.rule,
+                                                self.period, self.how)
             self.results.append(self.current)
         self.sample_size += len(self.index)
         self.current = None
@@ -179,7 +402,8 @@ class AggegatingQueryCallback(object):
 
     def __init__(self, metric, how='avg'):
         self.metric = metric
-        self.how = AGGREGATORS[how]          # TODO: check, raise exception here
+        self.how = aggregator(how)
+        self.period = FREQ_MILLIS['seconds']  # sketch bucket size for raw series
         self.results = []
         self.sample_size = 0
         self.index = self.values = None
@@ -198,8 +422,7 @@ class AggegatingQueryCallback(object):
 
     def end_datapoint_set(self):
         if self.current:
-            self.current['series'] = pd.Series(self.values,
-                                               pd.to_datetime(self.index, unit='ms'))
+            self.current['series'] = to_series(self.values, self.index)
             self.results.append(self.current)
         self.sample_size += len(self.index)
         self.current = None
@@ -212,7 +435,8 @@ class AggegatingQueryCallback(object):
         self.results = [{
                             'name': self.metric,
                             'tags': util.to_multi_map([result['tags'] for result in self.results]),
-                            'values': to_data_points(aggregate([result['series'] for result in self.results], self.how))
+                            'values': to_data_points(combine([result['series'] for result in self.results],
+                                                             self.how, self.period))
                         }]
         return self.results
 
@@ -224,6 +448,7 @@ class ComplexQueryCallback(object):
     def __init__(self, aggregator, resampler):
         self.aggregator = aggregator
         self.resampler = resampler
+        self.aggregator.period = resampler.period
 
     def start_datapoint_set(self, tags):
         self.resampler.start_datapoint_set(tags)
@@ -242,6 +467,138 @@ class ComplexQueryCallback(object):
         return self.results
 
 
+class TagGroupBy(object):
+    """Group series by the values of tags.
+    """
+
+    def __init__(self, tags):
+        if not tags:
+            raise QueryError('tag group_by requires tags')
+        self.tags = list(tags)
+
+    def describe(self, tags):
+        return {'name': 'tag', 'tags': self.tags,
+                'group': dict((k, tags.get(k, '')) for k in self.tags)}
+
+
+class TimeGroupBy(object):
+    """Group datapoints into group_count time ranges of range_size (relative
+     to the query start time), e.g. the 24 hours of a day.
+    """
+
+    def __init__(self, range_size, group_count, start_time):
+        if range_size.get('unit') not in FREQ_MILLIS:
+            raise QueryError('unknown time group_by unit: %s' % range_size.get('unit'))
+        self.range_size = range_size
+        self.group_count = int(group_count)
+        self.range_millis = int(range_size['value']) * FREQ_MILLIS[range_size['unit']]
+        self.start_time = start_time
+        if self.range_millis <= 0 or self.group_count <= 0:
+            raise QueryError('time group_by range_size and group_count must be positive')
+
+    def group(self, timestamp, value):
+        return (timestamp - self.start_time) // self.range_millis % self.group_count
+
+    def describe(self, group):
+        return {'name': 'time', 'range_size': self.range_size, 'group_count': self.group_count,
+                'group': {'group_number': group}}
+
+
+class ValueGroupBy(object):
+    """Group datapoints into ranges of value of range_size.
+    """
+
+    def __init__(self, range_size):
+        self.range_size = float(range_size)
+        if self.range_size <= 0:
+            raise QueryError('value group_by range_size must be positive')
+
+    def group(self, timestamp, value):
+        try:
+            return int(value // self.range_size)
+        except (TypeError, ValueError, OverflowError):
+            raise QueryError('value group_by requires finite numeric values: %r' % (value,))
+
+    def describe(self, group):
+        return {'name': 'value', 'range_size': self.range_size,
+                'group': {'group_number': group}}
+
+
+def group_by(json, start_time):
+    """Create a group by from its json description.
+    """
+    name = json.get('name')
+    try:
+        if name == 'tag':
+            return TagGroupBy(json['tags'])
+        if name == 'time':
+            return TimeGroupBy(json['range_size'], json['group_count'], start_time)
+        if name == 'value':
+            return ValueGroupBy(json['range_size'])
+    except (KeyError, TypeError, ValueError), e:
+        raise QueryError('invalid %s group_by: %s' % (name, e))
+    raise QueryError('unsupported group_by: %s' % name)
+
+
+class GroupingQueryCallback(object):
+    """A collector that partitions results into groups and feeds each group
+     its own collector (created by create_callback).  Series are partitioned
+     by tag group as they arrive; datapoints by time or value group.  Every
+     series is fetched once regardless of the number of groups.
+    """
+
+    def __init__(self, group_bys, create_callback):
+        self.create_callback = create_callback
+        tag_groups = [g for g in group_bys if isinstance(g, TagGroupBy)]
+        self.tag_group = TagGroupBy(sum([g.tags for g in tag_groups], [])) if tag_groups else None
+        self.point_groups = [g for g in group_bys if not isinstance(g, TagGroupBy)]
+        self.callbacks = collections.OrderedDict()   # group key -> (tags, groups, callback)
+        self.open = {}
+        self.results = []
+        self.sample_size = 0
+        self.tags = self.tag_key = None
+
+    def start_datapoint_set(self, tags):
+        self.tags = tags
+        self.tag_key = tuple(tags.get(k) for k in self.tag_group.tags) if self.tag_group else ()
+        self.open = {}
+        if not self.point_groups:
+            self._start(self.tag_key, ())
+
+    def add_data_point(self, timestamp, value):
+        if not self.point_groups:
+            return self.open[self.tag_key].add_data_point(timestamp, value)
+        groups = tuple(g.group(timestamp, value) for g in self.point_groups)
+        key = self.tag_key + groups
+        callback = self.open.get(key) or self._start(key, groups)
+        callback.add_data_point(timestamp, value)
+
+    def end_datapoint_set(self):
+        for callback in self.open.values():
+            callback.end_datapoint_set()
+        self.open = {}
+
+    def finish(self):
+        for tags, groups, callback in self.callbacks.values():
+            callback.finish()
+            self.sample_size += callback.sample_size
+            group_by = [self.tag_group.describe(tags)] if self.tag_group else []
+            group_by.extend(g.describe(n) for g, n in zip(self.point_groups, groups))
+            for result in callback.results or []:
+                result['group_by'] = group_by
+                self.results.append(result)
+        self.callbacks = None  # release memory
+        return self.results
+
+    def _start(self, key, groups):
+        if key not in self.callbacks:
+            self.callbacks[key] = (self.tags, groups, self.create_callback())
+        callback = self.callbacks[key][2]
+        callback.start_datapoint_set(self.tags)
+        self.open[key] = callback
+        return callback
+
+
 class GatherTask(object):
     """IO thread to read multiple query results and serialize together.
     """
@@ -281,23 +638,91 @@ class GatherTask(object):
         return self.future.result()
 
 
+class QueryCoordinator(object):
+    """Share datapoints fetches across requests: identical fetches in flight at
+     the same time are performed once (single-flight) and the result is handed
+     to every waiter.
+    """
+
+    def __init__(self, executor):
+        self.executor = executor
+        self.lock = RLock()   # done callbacks may run in submit()
+        self.in_flight = {}
+
+    def submit(self, key, fn, *args):
+        """Return the future of the in flight fetch for key, submitting fn if
+           there is none.
+        """
+        return self.submit_to(self.executor, key, fn, *args)
+
+    def submit_to(self, executor, key, fn, *args):
+        """As submit, submitting fn to executor.
+        """
+        with self.lock:
+            future = self.in_flight.get(key)
+            if future is None:
+                future = self.in_flight[key] = executor.submit(fn, *args)
+                future.add_done_callback(lambda f: self._done(key, f))
+            return future
+
+    def _done(self, key, future):
+        with self.lock:
+            if self.in_flight.get(key) is future:
+                del self.in_flight[key]
+
+
+coordinator = QueryCoordinator(reader_pool)
+
+
+class QueryScope(object):
+    """Fetches of a single request: an identical fetch is performed once per
+     request (even after it completes) and shared with concurrent requests
+     through the coordinator.  Fetches are queued for the request's domain.
+    """
+
+    def __init__(self, coordinator=coordinator, domain=None):
+        self.coordinator = coordinator
+        self.executor = reader_pool.domain(domain)
+        self.futures = {}
+
+    def submit(self, key, fn, *args):
+        if key not in self.futures:
+            self.futures[key] = self.coordinator.submit_to(self.executor, key, fn, *args)
+        return self.futures[key]
+
+
 class QueryTask(object):
     """A thread used to query the datapoints.
     """
 
-    def __init__(self, dynamodb, index_key, start_time, end_time):
+    def __init__(self, dynamodb, index_key, start_time, end_time, scope=None):
         super(QueryTask, self).__init__()
         self.dynamodb = dynamodb
         self.index_key = index_key
         self.start_time, self.end_time = start_time, end_time
+        self.scope = scope or coordinator
+        self.futures = []
 
     def start(self):
-        self.future = thread_pool.submit(self.run)
+        self.widen(self.index_key.get_shards())
 
-    def run(self):
+    def widen(self, shards):
+        """Fetch the shards of the column not fetched yet (a column may be
+           indexed with more than one number of shards).
+        """
+        for shard in range(len(self.futures), shards):
+            self.futures.append(self.scope.submit(self.fetch_key(shard), self.run, shard))
+
+    def fetch_key(self, shard=0):
+        """Identifies the fetch: series key, column and offset range.
+        """
+        return (self.index_key.to_data_points_key(shard),
+                util.offset_range(self.index_key, self.start_time, self.end_time))
+
+    def run(self, shard=0):
         return [(item['toffset'] + self.get_tbase(), item['value']) for item in \
                 self.dynamodb.query_datapoints(self.index_key, self.start_time,
-                                               self.end_time)]
+                                               self.end_time, shard=shard)]
 
     def get_tbase(self):
         return self.index_key.get_tbase()
@@ -309,7 +734,11 @@ class QueryTask(object):
         return self.index_key.get_tags()
 
     def get_result(self):
-        return self.future.result()
+        if len(self.futures) == 1:
+            return self.futures[0].result()
+        # merge shards (each ascending by time)
+        return sorted(itertools.chain.from_iterable(f.result() for f in self.futures),
+                      key=operator.itemgetter(0))
 
     def __cmp__(self, other):
         ret = cmp(self.get_tag_string(), other.get_tag_string())
@@ -25,10 +25,10 @@ Classes dealing directly with the dynamodb schema.
 """
 
 from amondawa import config
+from amondawa.autoscale import Autoscaler
 from amondawa.datapoints_schema import DatapointsSchema
 
 from boto.dynamodb2.fields import HashKey, RangeKey
-from boto.dynamodb2.table import Table
 
 from repoze.lru import LRUCache
 
@@ -41,9 +41,10 @@ class Schema(object):
     #   'metric_names': 'amdw1_metric_names',
     #   'tag_names': 'amdw1_tag_names',
     #   'tag_values': 'amdw1_tag_values',
-    #   'credentials': 'amdw1_credentials'
+    #   'credentials': 'amdw1_credentials',
+    #   'capacity': 'amdw1_capacity'
     # }
-    table_names = config.table_names(['metric_names', 'tag_names', 'tag_values', 'credentials'])
+    table_names = config.table_names(['metric_names', 'tag_names', 'tag_values', 'credentials', 'capacity'])
     # these (core_tables) tables won't be deleted by the delete operation below
     core_tables = config.table_names(['credentials', 'config']).values()
 
@@ -62,8 +63,8 @@ class Schema(object):
         for table in Schema.table_names.values():
             try:
                 # don't delete credentials table
-                if table.table_name not in Schema.core_tables:
-                    Table(table, connection=connection).delete()
+                if table not in Schema.core_tables:
+                    connection.table(table).delete()
             except:
                 pass
 
@@ -73,23 +74,24 @@ class Schema(object):
     def bind(connection):
         """Bind to existing dynamodb tables.
         """
-        return dict(((table, Table(table_name, connection=connection)) \
+        return dict(((table, connection.table(table_name)) \
                      for table, table_name in Schema.table_names.items()))
 
     @staticmethod
     def create(connection):
         """Create dynamodb tables.
         """
-        Table.create(config.table_name('metric_names'),
-                     schema=[HashKey('domain'), RangeKey('name')],
-                     throughput=Schema.metric_names_tp, connection=connection)
-        Table.create(config.table_name('tag_names'),
-                     schema=[HashKey('domain'), RangeKey('name')],
-                     throughput=Schema.tag_names_tp, connection=connection)
-        Table.create(config.table_name('tag_values'),
-                     schema=[HashKey('domain'), RangeKey('value')],
-                     throughput=Schema.tag_values_tp, connection=connection)
-
+        connection.create_table(config.table_name('metric_names'),
+                                schema=[HashKey('domain'), RangeKey('name')],
+                                throughput=Schema.metric_names_tp)
+        connection.create_table(config.table_name('tag_names'),
+                                schema=[HashKey('domain'), RangeKey('name')],
+                                throughput=Schema.tag_names_tp)
+        connection.create_table(config.table_name('tag_values'),
+                                schema=[HashKey('domain'), RangeKey('value')],
+                                throughput=Schema.tag_values_tp)
+
+        Autoscaler.create(connection)
         DatapointsSchema.create(connection)
 
     Credential = collections.namedtuple('Key', 'access_key_id permissions secret_access_key state')
@@ -152,20 +154,25 @@ class Schema(object):
            will buffer write operations into the provided writer before sending to
            dynamodb.
         """
-        self._store_tags(domain, tags)
-        self._store_metric(domain, metric)
+        self.store_series(domain, metric, tags)
 
         self.blocks.store_datapoint(timestamp, metric, tags, value, domain)
 
-    def query_index(self, domain, metric, start_time, end_time):
+    def store_series(self, domain, metric, tags):
+        """Add a series' metric name and tags to ancillary tables if required.
+        """
+        self._store_tags(domain, tags)
+        self._store_metric(domain, metric)
+
+    def query_index(self, domain, metric, start_time, end_time, executor=None, tags=None):
         """Query index for keys.
         """
-        return self.blocks.query_index(domain, metric, start_time, end_time)
+        return self.blocks.query_index(domain, metric, start_time, end_time, executor, tags)
 
-    def query_datapoints(self, index_key, start_time, end_time, attributes=['value']):
-        """Query datapoints.
+    def query_datapoints(self, index_key, start_time, end_time, attributes=['value'], shard=0):
+        """Query datapoints (of one shard of the column).
         """
-        return self.blocks.query_datapoints(index_key, start_time, end_time, attributes)
+        return self.blocks.query_datapoints(index_key, start_time, end_time, attributes, shard)
 
     def _store_cache(self, key, cache, table, data):
         if not key in cache:
@@ -0,0 +1,150 @@
+# Copyright (c) 2013 Daniel Gardner
+# All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""
+Pre-fork server.
+
+The parent process binds the listening socket and forks WORKERS processes
+that accept on it, each running the application in a threaded WSGI server.
+The parent imports no part of the application (which connects to the
+datastore and starts threads on import); it restarts workers that exit.
+
+With gevent (optional, see requirements-gevent.txt) workers serve
+asynchronously instead: each request and each datapoints fetch is a
+greenlet, up to CONNECTIONS requests are in flight per worker and at most
+BACKEND_CALLS DynamoDB requests are outstanding (the embedded SQLite backend
+blocks the worker while it runs).  gevent workers run in a fresh interpreter
+that is patched before anything else is imported.
+
+One process per node runs maintenance, elected by a lock file
+(AMDW_MAINTENANCE_LOCK); the others follow its block changes.  The hot
+tier, which must see every datapoint written, is disabled with more than
+one worker.
+"""
+
+import imp
+import os
+import signal
+import socket
+import sys
+import tempfile
+import time
+
+RESTART_DELAY = 1
+# gevent worker program (argument: the listening socket's file descriptor)
+GEVENT_WORKER = 'from gevent import monkey; monkey.patch_all(); ' \
+                'import sys; from amondawa.server import serve_gevent; serve_gevent(int(sys.argv[1]))'
+
+
+def serve(host, port, workers, backlog=128, gevent=False, connections=1000, backend_calls=100):
+    """Serve on host:port with workers processes (until SIGTERM/SIGINT),
+       asynchronously if gevent.
+    """
+    if gevent:
+        try:
+            imp.find_module('gevent')
+        except ImportError:
+            print 'gevent is not installed (pip install -r requirements-gevent.txt)'
+            sys.exit(1)
+        os.environ['AMDW_ASYNC'] = 'gevent'
+        os.environ['AMDW_CONNECTIONS'] = str(connections)
+        os.environ['AMDW_BACKEND_CALLS'] = str(backend_calls)
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+
+    os.environ['AMDW_WORKERS'] = str(workers)
+    os.environ.setdefault('AMDW_MAINTENANCE_LOCK',
+                          os.path.join(tempfile.gettempdir(), 'amondawa-%s.lock' % port))
+    if workers > 1 and os.environ.pop('AMDW_HOT_TIER_DIR', None):
+        print 'hot tier disabled (it requires a single worker)'
+
+    children = {}
+    stopping = []
+
+    def stop(signum, frame):
+        stopping.append(signum)
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for n in range(workers):
+        children[spawn(sock, host, n, gevent)] = n
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except OSError:     # interrupted by a signal
+            continue
+        n = children.pop(pid, None)
+        if n is not None and not stopping:
+            print 'worker %d (pid %d) exited with status %d: restarting' % (n, pid, status)
+            time.sleep(RESTART_DELAY)
+            children[spawn(sock, host, n, gevent)] = n
+    sock.close()
+
+
+def spawn(sock, host, n, gevent=False):
+    """Fork worker n.
+    """
+    pid = os.fork()
+    if pid:
+        return pid
+    # noinspection PyBroadException
+    try:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        os.environ['AMDW_WORKER'] = str(n)
+        if gevent:
+            # this process has imported threading (as has the server): run
+            # the worker in a fresh interpreter, importing what this one can
+            os.environ['PYTHONPATH'] = os.pathsep.join(path for path in sys.path if path)
+            os.execv(sys.executable, [sys.executable, '-c', GEVENT_WORKER, str(sock.fileno())])
+        else:
+            from amondawa.http import app
+            from werkzeug.serving import make_server
+            make_server(host, 0, app, threaded=True, fd=sock.fileno()).serve_forever()
+    except:
+        import traceback
+        traceback.print_exc()
+    finally:
+        os._exit(1)
+
+
+def serve_gevent(fd):
+    """Serve asynchronously on the listening socket fd (in a worker process,
+       patched by gevent before the application is imported; see
+       GEVENT_WORKER).
+    """
+    from gevent.pool import Pool
+    from gevent.pywsgi import WSGIServer
+    import amondawa
+    from amondawa.http import app
+    listener = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+    WSGIServer(listener, app, spawn=Pool(amondawa.CONNECTIONS)).serve_forever()
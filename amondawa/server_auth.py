@@ -20,8 +20,9 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
 # IN THE SOFTWARE.
 
+from amondawa.credentials import CredentialStore
 from amondawa.schema import Schema
-from auth import check_access, auth_check_auth, ProxyHTTPRequest
+from auth import auth_check_signature, ProxyHTTPRequest
 import amondawa
 import config
 import datetime
@@ -29,9 +30,15 @@ import datetime
 # TODO: make configurable? maybe more secure hardcoded
 MAX_SKEW = 15 * 60          # 15 minutes
 
-schema = Schema(amondawa.connect(config.REGION))
-# scan the credentials table  TODO: periodically scan
-amdw_credentials = schema.get_credentials()
+credentials_table = Schema.bind(amondawa.connect(config.REGION))['credentials']
+amdw_credentials = CredentialStore(credentials_table, int(config.get().MX_CREDENTIALS_REFRESH))
+amdw_credentials.start()
+
+
+def configure(previous, current):
+    amdw_credentials.interval = int(current.MX_CREDENTIALS_REFRESH)
+
+config.subscribe(configure)
 
 def authorized(request, domain, op):
     """Compute AWS4-HMAC-SHA256 authentication signature and return True if
@@ -62,30 +69,32 @@ def authorized(request, domain, op):
         _, parts = auth_header.split()
         credentials, signed_headers, signature = parts.split(',')
         _, credentials = credentials.split('=')
+        name, signature = signature.split('=')
+        if name != 'Signature':
+            return False
         aws_access_key_id = credentials.split('/')[0]
         record = amdw_credentials.get(aws_access_key_id)
         if not record:
             return False
-        if record.state != 'ACTIVE': return False
+        if not record.active: return False
         aws_secret_access_key = record.secret_access_key
     except:
         # cannot find access_key_id or secret_access_key
         return False
 
     # check domain:operation permissions
-    if not check_access(domain, op, record.permissions):
+    if not record.allows(domain, op):
         return False
 
+    # only x-amz-* headers (and host) are signed
     headers = {}
     for k in request.headers.keys(lower=True):
-        #   Authorization header must be recomputed
-        if not k in ('authorization'):
+        if k.startswith('x-amz'):
             headers[k] = request.headers[k]
 
     # This is a hack (uppercase date header name) to reuse the boto client for
     # signature validation.  That class uses uppercase date header name.
-    headers['X-Amz-Date'] = headers['x-amz-date']
-    del headers['x-amz-date']
+    headers['X-Amz-Date'] = headers.pop('x-amz-date')
 
     host_port = host_header.split(':')
     if len(host_port) == 1:
@@ -100,9 +109,7 @@ def authorized(request, domain, op):
     prequest = ProxyHTTPRequest(request.method, host, port,
                                 request.path, headers, protocol='http')
 
-    auth_check_auth(prequest, aws_access_key_id, aws_secret_access_key)
-    # TODO: just compare signature (not whole header)
-    return auth_header == headers['Authorization']
+    return auth_check_signature(prequest, signature, aws_secret_access_key)
 
 
 
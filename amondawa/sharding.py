@@ -0,0 +1,94 @@
+# Copyright (c) 2013 Daniel Gardner
+# All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""
+Write sharding of hot series.
+
+A series' column is spread over K hash keys (shards); a datapoint goes to
+shard shard(timestamp, K), a hash of its timestamp, and shard 0 is the
+unsharded key.  K is recorded in the
+index key of the column and is fixed per column: it is chosen when the
+column's first datapoint arrives, from the rate the series was written at in
+its previous column (or a configured per metric value).
+"""
+
+from repoze.lru import LRUCache
+from threading import Lock
+
+import math
+
+
+def shard(timestamp, shards):
+    """Shard of a datapoint at timestamp in a column of shards shards.  The
+       timestamp is hashed: timestamps (ms) are mostly whole seconds, so
+       timestamp % shards would leave shards unused.
+    """
+    return ((int(timestamp) * 0x9E3779B1 & 0xffffffff) >> 16) % shards
+
+
+class ShardPolicy(object):
+    """Choose the number of shards of series columns.
+    """
+
+    def __init__(self, column_height, shard_rate, max_shards, overrides=None, size=1000):
+        self.column_height = column_height
+        self.shard_rate = float(shard_rate)
+        self.max_shards = max_shards
+        self.overrides = dict((metric, int(shards)) for metric, shards in (overrides or {}).items()
+                              if int(shards) >= 1)
+        self.lock = Lock()
+        # series -> [tbase, datapoints in column, shards, previous tbase, previous shards]
+        self.series = LRUCache(size)
+
+    def shards(self, series, metric, tbase, height=None):
+        """Count a datapoint of series in column tbase (of height, default:
+           column_height) and return the number of shards of that column.
+        """
+        if metric in self.overrides:
+            return self.overrides[metric]
+        with self.lock:
+            state = self.series.get(series)
+            if state is None:
+                state = [tbase, 0, 1, None, 1]
+                self.series.put(series, state)
+            elif tbase > state[0]:
+                # new column: shard for the rate of the previous one
+                state[:] = [tbase, 0, self.choose(state[1], height), state[0], state[2]]
+            elif tbase < state[0]:
+                # late datapoint
+                return state[4] if tbase == state[3] else 1
+            state[1] += 1
+            return state[2]
+
+    def shards_for(self, metric, count, height=None):
+        """Number of shards of a column of metric holding count datapoints
+           (bulk loads, which know a column's size upfront).
+        """
+        if metric in self.overrides:
+            return self.overrides[metric]
+        return self.choose(count, height)
+
+    def choose(self, count, height=None):
+        """Number of shards for a column of count datapoints.
+        """
+        rate = 1000. * count / (height or self.column_height)
+        return int(min(max(math.ceil(rate / self.shard_rate), 1), self.max_shards))
@@ -0,0 +1,139 @@
+# Copyright (c) 2013 Daniel Gardner
+# All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""
+Mergeable quantile sketch (DDSketch).
+
+Values are counted in logarithmically sized buckets so that any quantile is
+reported within a fixed relative error.  Two sketches built with the same
+relative accuracy merge by adding bucket counts, which lets per-series and
+per-bucket summaries be combined cheaply.
+"""
+
+import math
+import numpy as np
+
+# relative error of reported quantiles
+RELATIVE_ACCURACY = 0.01
+
+# values smaller (in magnitude) than this are counted as zero
+MIN_VALUE = 1e-9
+
+
+class DDSketch(object):
+    """A relative-error quantile sketch.
+    """
+
+    def __init__(self, relative_accuracy=RELATIVE_ACCURACY):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.positive = {}       # bucket index -> count
+        self.negative = {}       # bucket index (of -value) -> count
+        self.zero_count = 0
+        self.count = 0
+        self.min = self.max = None
+        self.sum = 0.
+
+    def add(self, value):
+        """Add a single value.
+        """
+        self.extend([value])
+
+    def extend(self, values):
+        """Add values (vectorized).
+        """
+        values = np.asarray(values, dtype=float)
+        if not len(values):
+            return self
+        magnitude = np.abs(values)
+        zero = magnitude < MIN_VALUE
+        self.zero_count += int(zero.sum())
+        self._count(self.positive, magnitude[(values > 0) & ~zero])
+        self._count(self.negative, magnitude[(values < 0) & ~zero])
+        self.count += len(values)
+        self.sum += float(values.sum())
+        vmin, vmax = float(values.min()), float(values.max())
+        self.min = vmin if self.min is None else min(self.min, vmin)
+        self.max = vmax if self.max is None else max(self.max, vmax)
+        return self
+
+    def merge(self, other):
+        """Merge other sketch (of equal accuracy) into this sketch.
+        """
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError('cannot merge sketches of different accuracy (%s, %s)' %
+                             (self.relative_accuracy, other.relative_accuracy))
+        if not other.count:
+            return self
+        for mine, theirs in ((self.positive, other.positive), (self.negative, other.negative)):
+            for i, n in theirs.iteritems():
+                mine[i] = mine.get(i, 0) + n
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.sum += other.sum
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+        return self
+
+    def quantile(self, q):
+        """Return the value at quantile q (0 <= q <= 1).
+        """
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for value, n in self._buckets():
+            seen += n
+            if seen > rank:
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    def histogram(self):
+        """Return the sketch's buckets as [[value, count], ...] in ascending
+           value order (value is the bucket's representative value).
+        """
+        return [[value, n] for value, n in self._buckets()]
+
+    def _value(self, i):
+        """Representative value of bucket i.
+        """
+        return 2 * self.gamma ** i / (self.gamma + 1)
+
+    def _buckets(self):
+        for i in sorted(self.negative, reverse=True):
+            yield -self._value(i), self.negative[i]
+        if self.zero_count:
+            yield 0., self.zero_count
+        for i in sorted(self.positive):
+            yield self._value(i), self.positive[i]
+
+    def _count(self, store, magnitude):
+        if not len(magnitude):
+            return
+        indexes = np.ceil(np.log(magnitude) / self.log_gamma).astype(int)
+        unique, inverse = np.unique(indexes, return_inverse=True)
+        for i, n in zip(unique, np.bincount(inverse)):
+            store[int(i)] = store.get(int(i), 0) + int(n)
+
+    def __repr__(self):
+        return 'DDSketch{count=%s, min=%s, max=%s}' % (self.count, self.min, self.max)
@@ -0,0 +1,86 @@
+# Copyright (c) 2013 Daniel Gardner
+# All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""
+Local snapshot of the configuration and block metadata.
+
+Server processes start from the snapshot file while it is fresh instead of
+reading the config and master tables and describing every block table at
+import; the tables are then read again in the background (configuration
+refresh, table maintenance) and the snapshot rewritten.  Credentials are
+never written to the snapshot.
+"""
+
+from threading import Lock
+
+import cPickle as pickle
+import os
+import time
+
+
+class Snapshot(object):
+    """Named sections (picklable values) kept in file path, fresh for ttl
+     seconds after they are written.
+    """
+
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self.lock = Lock()
+
+    def get(self, name):
+        """Return section name if the snapshot is fresh, else None.
+        """
+        sections = self._read()
+        if name not in sections or sections[name][0] + self.ttl < time.time():
+            return None
+        return sections[name][1]
+
+    def update(self, **sections):
+        """Write sections (replacing them) to the snapshot.
+        """
+        if not self.path:
+            return
+        with self.lock:
+            current = self._read()
+            now = time.time()
+            current.update((name, (now, value)) for name, value in sections.items())
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            tmp = '%s.%d.tmp' % (self.path, os.getpid())
+            with open(tmp, 'wb') as f:
+                pickle.dump(current, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp, self.path)
+
+    def _read(self):
+        """Sections: name -> (time written, value); empty if the snapshot is
+           missing or unreadable.
+        """
+        if not self.path:
+            return {}
+        # noinspection PyBroadException
+        try:
+            with open(self.path, 'rb') as f:
+                return pickle.load(f)
+        except:
+            return {}
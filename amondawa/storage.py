@@ -0,0 +1,694 @@
+# Copyright (c) 2013 Daniel Gardner
+# All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""
+Storage backends.
+
+A backend is a factory for tables.  Tables offer the subset of the boto
+dynamodb2 Table interface used by the schema classes:
+
+  describe()                        status and provisioned throughput
+  update(throughput), delete()      table lifecycle
+  put_item(data, overwrite=False)
+  get_item(**key)                   raises ItemNotFound if missing
+  delete_item(**key)
+  batch_write()                     buffered puts: put_item(data), flush()
+  query(consistent=False, reverse=False, attributes=None, limit=None,
+        <key>__<op>=value)          range query on hash (+ range) key
+                                    (op: eq, lt, lte, gt, gte, between,
+                                     beginswith), items in ascending range
+                                    key order (descending if reverse)
+  scan()
+
+and backends offer
+
+  increment(table, key, counts)     atomically add counts to item attributes
+
+Items are returned as dict-like objects.  Three backends are provided:
+
+  DynamoDBBackend   Amazon DynamoDB (via boto)
+  SQLiteBackend     embedded, single node storage in a local SQLite database
+  MemoryBackend     process memory (benchmarks and tests)
+"""
+
+from amondawa.exceptions import AmondawaError
+from boto.dynamodb.types import Dynamizer
+from boto.dynamodb2.exceptions import ConditionalCheckFailedException, ItemNotFound
+from boto.dynamodb2.layer1 import DynamoDBConnection
+from boto.dynamodb2.table import Table
+from boto.dynamodb2.types import NUMBER
+from boto.regioninfo import connect
+from decimal import Decimal
+
+import bisect
+import collections
+import cPickle as pickle
+import json
+import os
+import sqlite3
+import threading
+
+
+class TableNotFoundError(AmondawaError):
+    """Table does not exist.
+    """
+    pass
+
+
+class CapacityMeter(object):
+    """Consumed read/write capacity units per table since the last take().
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.consumed = collections.defaultdict(lambda: [0., 0.])
+
+    def add(self, table_name, read=0., write=0.):
+        with self.lock:
+            consumed = self.consumed[table_name]
+            consumed[0] += read
+            consumed[1] += write
+
+    def take(self):
+        """Return {table_name: (read, write)} and reset.
+        """
+        with self.lock:
+            consumed, self.consumed = self.consumed, collections.defaultdict(lambda: [0., 0.])
+        return dict((name, tuple(units)) for name, units in consumed.items())
+
+
+# bounds the outstanding DynamoDB requests of the process (see limit_calls)
+call_limit = None
+
+
+def limit_calls(calls):
+    """Allow at most calls outstanding DynamoDB requests in this process (for
+       asynchronous serving, where requests in flight are not bounded by
+       threads).
+    """
+    global call_limit
+    if call_limit is None:
+        call_limit = threading.BoundedSemaphore(calls)
+
+
+class MeteredDynamoDBConnection(DynamoDBConnection):
+    """Requests consumed capacity for data operations and records it in meter
+       (and waits for a call_limit slot if set).
+    """
+    READS = frozenset(['GetItem', 'BatchGetItem', 'Query', 'Scan'])
+    WRITES = frozenset(['PutItem', 'UpdateItem', 'DeleteItem', 'BatchWriteItem'])
+
+    meter = None
+
+    def make_request(self, action, body):
+        metered = self.meter is not None and (action in self.READS or action in self.WRITES)
+        if metered:
+            params = json.loads(body)
+            params['ReturnConsumedCapacity'] = 'TOTAL'
+            body = json.dumps(params)
+        if call_limit is None:
+            response = super(MeteredDynamoDBConnection, self).make_request(action, body)
+        else:
+            with call_limit:
+                response = super(MeteredDynamoDBConnection, self).make_request(action, body)
+        if metered and response:
+            consumed = response.get('ConsumedCapacity') or []
+            for units in consumed if isinstance(consumed, list) else [consumed]:
+                if action in self.READS:
+                    self.meter.add(units['TableName'], read=units['CapacityUnits'])
+                else:
+                    self.meter.add(units['TableName'], write=units['CapacityUnits'])
+        return response
+
+
+class DynamoDBTable(Table):
+    """Table whose query returns items in ascending range key order
+       (descending if reverse), as the other backends do (boto's legacy
+       Table.query inverts reverse).
+    """
+
+    def query(self, limit=None, reverse=False, **filters):
+        return self.query_2(limit=limit, reverse=reverse, **filters)
+
+
+class DynamoDBBackend(object):
+    """Amazon DynamoDB storage.
+    """
+
+    @classmethod
+    def connect(cls, region):
+        connection = connect('dynamodb', region, connection_cls=MeteredDynamoDBConnection)
+        connection.meter = CapacityMeter()
+        return cls(connection)
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.meter = getattr(connection, 'meter', None)
+        self.dynamizer = Dynamizer()
+
+    def table(self, name):
+        """Bind to table name (the table need not exist yet).
+        """
+        return DynamoDBTable(name, connection=self.connection)
+
+    def create_table(self, name, schema, throughput):
+        """Create table with schema (HashKey [, RangeKey]) and throughput
+           {'read': n, 'write': n}.
+        """
+        return DynamoDBTable.create(name, schema=schema, throughput=throughput,
+                                    connection=self.connection)
+
+    def increment(self, table, key, counts):
+        """Atomically add counts ({attribute: number}) to the item with key.
+        """
+        encode = lambda value: self.dynamizer.encode(Decimal(str(value)) if isinstance(value, float) else value)
+        self.connection.update_item(table.table_name,
+                                    key=dict((name, encode(value)) for name, value in key.items()),
+                                    attribute_updates=dict((name, {'Action': 'ADD', 'Value': encode(value)})
+                                                           for name, value in counts.items()))
+
+    def close(self):
+        self.connection.close()
+
+
+class SQLiteBackend(object):
+    """Embedded storage in a local SQLite database (one file for all tables).
+     Tables are ACTIVE as soon as they are created; provisioned throughput is
+     recorded (so table state is reported as for DynamoDB) but not enforced.
+    """
+    FILENAME = 'amondawa.db'
+    BUSY_TIMEOUT = 60     # seconds to wait for a lock held by another process
+
+    meter = None          # capacity is not consumed
+
+    def __init__(self, directory):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.path = os.path.join(directory, SQLiteBackend.FILENAME)
+        self.local = threading.local()
+        with self.transaction() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS amdw_tables ('
+                       'name TEXT PRIMARY KEY, hash_key TEXT, hash_type TEXT, '
+                       'range_key TEXT, range_type TEXT, read INTEGER, write INTEGER)')
+
+    def db(self):
+        """Connection for the calling thread.
+        """
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = self.local.db = sqlite3.connect(self.path, timeout=SQLiteBackend.BUSY_TIMEOUT,
+                                                 isolation_level=None)
+            db.text_factory = str
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+        return db
+
+    def transaction(self):
+        return _Transaction(self.db())
+
+    def table(self, name):
+        return SQLiteTable(self, name)
+
+    def create_table(self, name, schema, throughput):
+        hash_key = schema[0]
+        range_key = schema[1] if len(schema) > 1 else None
+        with self.transaction() as db:
+            db.execute('INSERT INTO amdw_tables VALUES (?, ?, ?, ?, ?, ?, ?)',
+                       (name, hash_key.name, hash_key.data_type,
+                        range_key.name if range_key else None,
+                        range_key.data_type if range_key else None,
+                        throughput['read'], throughput['write']))
+            db.execute('CREATE TABLE %s (h %s NOT NULL, r %s NOT NULL, data BLOB, PRIMARY KEY (h, r))' %
+                       (_quote(name), _affinity(hash_key.data_type),
+                        _affinity(range_key.data_type if range_key else None)))
+        return self.table(name)
+
+    def increment(self, table, key, counts):
+        return table.increment(key, counts)
+
+    def close(self):
+        db = getattr(self.local, 'db', None)
+        if db is not None:
+            db.close()
+            self.local.db = None
+
+
+class SQLiteTable(object):
+    """A table stored in SQLite: rows of (hash key, range key, pickled item).
+    """
+    OPERATORS = {
+        'eq': '= ?',
+        'lt': '< ?',
+        'lte': '<= ?',
+        'gt': '> ?',
+        'gte': '>= ?',
+        'between': 'BETWEEN ? AND ?',
+    }
+    PAGE_SIZE = 1000
+
+    def __init__(self, backend, name):
+        self.backend = backend
+        self.table_name = name
+        self.meta = None
+
+    def describe(self):
+        meta = self._meta()
+        return {'Table': {
+            'TableName': self.table_name,
+            'TableStatus': 'ACTIVE',
+            'ProvisionedThroughput': {'ReadCapacityUnits': meta['read'],
+                                      'WriteCapacityUnits': meta['write']}
+        }}
+
+    def update(self, throughput):
+        self._meta()
+        with self.backend.transaction() as db:
+            db.execute('UPDATE amdw_tables SET read = ?, write = ? WHERE name = ?',
+                       (throughput['read'], throughput['write'], self.table_name))
+        self.meta = None
+        return True
+
+    def delete(self):
+        self._meta()
+        with self.backend.transaction() as db:
+            db.execute('DELETE FROM amdw_tables WHERE name = ?', (self.table_name,))
+            db.execute('DROP TABLE %s' % _quote(self.table_name))
+        self.meta = None
+        return True
+
+    def put_item(self, data, overwrite=False):
+        row = self._row(data)
+        with self.backend.transaction() as db:
+            try:
+                db.execute('%s INTO %s VALUES (?, ?, ?)' %
+                           ('INSERT OR REPLACE' if overwrite else 'INSERT', _quote(self.table_name)), row)
+            except sqlite3.IntegrityError:
+                raise ConditionalCheckFailedException(400, 'Bad Request',
+                                                      {'message': 'The conditional request failed'})
+        return True
+
+    def get_item(self, consistent=False, attributes=None, **key):
+        h, r = self._key(key)
+        row = self.backend.db().execute('SELECT data FROM %s WHERE h = ? AND r = ?' %
+                                        _quote(self.table_name), (h, r)).fetchone()
+        if row is None:
+            raise ItemNotFound('Item %s couldn\'t be found.' % key)
+        return _project(pickle.loads(str(row[0])), attributes)
+
+    def delete_item(self, **key):
+        with self.backend.transaction() as db:
+            db.execute('DELETE FROM %s WHERE h = ? AND r = ?' % _quote(self.table_name), self._key(key))
+        return True
+
+    def increment(self, key, counts):
+        h, r = self._key(key)
+        with self.backend.transaction() as db:
+            row = db.execute('SELECT data FROM %s WHERE h = ? AND r = ?' %
+                             _quote(self.table_name), (h, r)).fetchone()
+            item = pickle.loads(str(row[0])) if row else dict(key)
+            for name, value in counts.items():
+                item[name] = item.get(name, 0) + value
+            db.execute('INSERT OR REPLACE INTO %s VALUES (?, ?, ?)' % _quote(self.table_name),
+                       (h, r, sqlite3.Binary(pickle.dumps(item, pickle.HIGHEST_PROTOCOL))))
+        return True
+
+    def batch_write(self):
+        return SQLiteBatchTable(self)
+
+    def query(self, consistent=False, reverse=False, attributes=None, limit=None, **filters):
+        meta = self._meta()
+        where, args = [], []
+        for name, value in filters.items():
+            attr, op = name.rsplit('__', 1)
+            if attr == meta['hash_key']:
+                column, data_type = 'h', meta['hash_type']
+            elif attr == meta['range_key']:
+                column, data_type = 'r', meta['range_type']
+            else:
+                raise ValueError('%s is not a key of %s' % (attr, self.table_name))
+            if op == 'beginswith':
+                where.append('substr(%s, 1, ?) = ?' % column)
+                args.extend([len(value), value])
+            elif op in SQLiteTable.OPERATORS:
+                where.append('%s %s' % (column, SQLiteTable.OPERATORS[op]))
+                values = value if op == 'between' else [value]
+                args.extend(_to_sql(v, data_type) for v in values)
+            else:
+                raise ValueError('unsupported query operator: %s' % op)
+        sql = 'SELECT data FROM %s' % _quote(self.table_name)
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY h, r %s' % ('DESC' if reverse else 'ASC')
+        if limit:
+            sql += ' LIMIT %d' % int(limit)
+        return self._results(sql, args, attributes)
+
+    def scan(self, limit=None, attributes=None):
+        self._meta()
+        sql = 'SELECT data FROM %s' % _quote(self.table_name)
+        if limit:
+            sql += ' LIMIT %d' % int(limit)
+        return self._results(sql, [], attributes)
+
+    def _results(self, sql, args, attributes):
+        """Yield query results page by page.
+        """
+        cursor = self.backend.db().execute(sql, args)
+        while True:
+            rows = cursor.fetchmany(SQLiteTable.PAGE_SIZE)
+            if not rows:
+                break
+            for row in rows:
+                yield _project(pickle.loads(str(row[0])), attributes)
+
+    def _meta(self):
+        if self.meta is None:
+            row = self.backend.db().execute('SELECT hash_key, hash_type, range_key, range_type, read, write '
+                                            'FROM amdw_tables WHERE name = ?', (self.table_name,)).fetchone()
+            if row is None:
+                raise TableNotFoundError('table %s does not exist' % self.table_name)
+            self.meta = dict(zip(('hash_key', 'hash_type', 'range_key', 'range_type', 'read', 'write'), row))
+        return self.meta
+
+    def _key(self, key):
+        meta = self._meta()
+        h = _to_sql(key[meta['hash_key']], meta['hash_type'])
+        r = _to_sql(key[meta['range_key']], meta['range_type']) if meta['range_key'] else ''
+        return h, r
+
+    def _row(self, data):
+        h, r = self._key(data)
+        return h, r, sqlite3.Binary(pickle.dumps(dict(data), pickle.HIGHEST_PROTOCOL))
+
+
+class SQLiteBatchTable(object):
+    """Buffered puts, written in one transaction per flush.
+    """
+    BATCH_SIZE = 500
+
+    def __init__(self, table):
+        self.table = table
+        self.rows = []
+
+    def put_item(self, data, overwrite=False):
+        self.rows.append(self.table._row(data))
+        if len(self.rows) >= SQLiteBatchTable.BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        rows, self.rows = self.rows, []
+        if not rows:
+            return True
+        with self.table.backend.transaction() as db:
+            db.executemany('INSERT OR REPLACE INTO %s VALUES (?, ?, ?)' % _quote(self.table.table_name), rows)
+        return True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.flush()
+
+
+class MemoryBackend(object):
+    """Storage in process memory, shared by all connections of the process
+     (see shared()).  Tables are ACTIVE as soon as they are created.
+    """
+    instance = None
+
+    meter = None          # capacity is not consumed
+
+    @classmethod
+    def shared(cls):
+        """The backend of this process.
+        """
+        if cls.instance is None:
+            cls.instance = cls()
+        return cls.instance
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.tables = {}    # name -> MemoryTable.Data
+
+    def table(self, name):
+        return MemoryTable(self, name)
+
+    def create_table(self, name, schema, throughput):
+        hash_key = schema[0]
+        range_key = schema[1] if len(schema) > 1 else None
+        with self.lock:
+            if name in self.tables:
+                raise ValueError('table %s already exists' % name)
+            self.tables[name] = MemoryTable.Data(hash_key.name, hash_key.data_type,
+                                                 range_key.name if range_key else None,
+                                                 range_key.data_type if range_key else None,
+                                                 throughput['read'], throughput['write'])
+        return self.table(name)
+
+    def increment(self, table, key, counts):
+        return table.increment(key, counts)
+
+    def close(self):
+        pass
+
+
+class MemoryTable(object):
+    """A table in memory: range keys of each hash key kept sorted.
+    """
+
+    class Data(object):
+        def __init__(self, hash_key, hash_type, range_key, range_type, read, write):
+            self.hash_key, self.hash_type = hash_key, hash_type
+            self.range_key, self.range_type = range_key, range_type
+            self.read, self.write = read, write
+            self.hashes = {}    # hash key -> (sorted range keys, {range key: item})
+
+    def __init__(self, backend, name):
+        self.backend = backend
+        self.table_name = name
+
+    def describe(self):
+        data = self._data()
+        return {'Table': {
+            'TableName': self.table_name,
+            'TableStatus': 'ACTIVE',
+            'ProvisionedThroughput': {'ReadCapacityUnits': data.read,
+                                      'WriteCapacityUnits': data.write}
+        }}
+
+    def update(self, throughput):
+        data = self._data()
+        data.read, data.write = throughput['read'], throughput['write']
+        return True
+
+    def delete(self):
+        self._data()
+        with self.backend.lock:
+            del self.backend.tables[self.table_name]
+        return True
+
+    def put_item(self, data, overwrite=False):
+        table = self._data()
+        h, r = self._key(table, data)
+        with self.backend.lock:
+            if not overwrite and r in table.hashes.get(h, ((), {}))[1]:
+                raise ConditionalCheckFailedException(400, 'Bad Request',
+                                                      {'message': 'The conditional request failed'})
+            self._put(table, h, r, dict(data))
+        return True
+
+    def get_item(self, consistent=False, attributes=None, **key):
+        table = self._data()
+        h, r = self._key(table, key)
+        item = table.hashes.get(h, ((), {}))[1].get(r)
+        if item is None:
+            raise ItemNotFound('Item %s couldn\'t be found.' % key)
+        return _project(item, attributes) if attributes else dict(item)
+
+    def delete_item(self, **key):
+        table = self._data()
+        h, r = self._key(table, key)
+        with self.backend.lock:
+            keys, items = table.hashes.get(h, ([], {}))
+            if items.pop(r, None) is not None:
+                del keys[bisect.bisect_left(keys, r)]
+        return True
+
+    def increment(self, key, counts):
+        table = self._data()
+        h, r = self._key(table, key)
+        with self.backend.lock:
+            item = dict(table.hashes.get(h, ((), {}))[1].get(r) or key)
+            for name, value in counts.items():
+                item[name] = item.get(name, 0) + value
+            self._put(table, h, r, item)
+        return True
+
+    def batch_write(self):
+        return MemoryBatchTable(self)
+
+    def query(self, consistent=False, reverse=False, attributes=None, limit=None, **filters):
+        table = self._data()
+        hash_filters, range_filters = [], []
+        for name, value in filters.items():
+            attr, op = name.rsplit('__', 1)
+            if attr == table.hash_key:
+                hash_filters.append((op, value, table.hash_type))
+            elif attr == table.range_key:
+                range_filters.append((op, value, table.range_type))
+            else:
+                raise ValueError('%s is not a key of %s' % (attr, self.table_name))
+        # a hash key equality (as in every query of a dynamoDB table) is a
+        # lookup; other hash key conditions scan the hash keys in order
+        eq = [value for op, value, data_type in hash_filters if op == 'eq']
+        results = []
+        with self.backend.lock:
+            for h in [_to_sql(eq[0], table.hash_type)] if eq else sorted(table.hashes):
+                if h not in table.hashes or \
+                        not all(_matches(h, op, value, data_type) for op, value, data_type in hash_filters):
+                    continue
+                keys, items = table.hashes[h]
+                lo, hi = 0, len(keys)
+                for op, value, data_type in range_filters:
+                    lo, hi = _range(keys, lo, hi, op, value, data_type)
+                results.extend(items[r] for r in keys[lo:hi])
+        if reverse:
+            results.reverse()
+        return (_project(item, attributes) if attributes else dict(item) for item in results[:limit or None])
+
+    def scan(self, limit=None, attributes=None):
+        return self.query(attributes=attributes, limit=limit)
+
+    def _data(self):
+        data = self.backend.tables.get(self.table_name)
+        if data is None:
+            raise TableNotFoundError('table %s does not exist' % self.table_name)
+        return data
+
+    def _key(self, table, key):
+        h = _to_sql(key[table.hash_key], table.hash_type)
+        r = _to_sql(key[table.range_key], table.range_type) if table.range_key else ''
+        return h, r
+
+    @staticmethod
+    def _put(table, h, r, item):
+        keys, items = table.hashes.setdefault(h, ([], {}))
+        if r not in items:
+            bisect.insort(keys, r)
+        items[r] = item
+
+
+class MemoryBatchTable(object):
+    """Buffered puts, applied together per flush.
+    """
+    BATCH_SIZE = 500
+
+    def __init__(self, table):
+        self.table = table
+        self.items = []
+
+    def put_item(self, data, overwrite=False):
+        self.items.append(dict(data))
+        if len(self.items) >= MemoryBatchTable.BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        items, self.items = self.items, []
+        if not items:
+            return True
+        table = self.table._data()
+        with self.table.backend.lock:
+            for item in items:
+                h, r = self.table._key(table, item)
+                MemoryTable._put(table, h, r, item)
+        return True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.flush()
+
+
+def _matches(key, op, value, data_type):
+    if op == 'beginswith':
+        return key.startswith(value)
+    if op == 'between':
+        return _to_sql(value[0], data_type) <= key <= _to_sql(value[1], data_type)
+    value = _to_sql(value, data_type)
+    return {'eq': key == value, 'lt': key < value, 'lte': key <= value,
+            'gt': key > value, 'gte': key >= value}[op]
+
+
+def _range(keys, lo, hi, op, value, data_type):
+    """Narrow keys[lo:hi] (sorted) to the keys matching op value.
+    """
+    if op == 'beginswith':
+        return bisect.bisect_left(keys, value, lo, hi), bisect.bisect_left(keys, value + '\xff', lo, hi)
+    if op == 'between':
+        low, high = _to_sql(value[0], data_type), _to_sql(value[1], data_type)
+        return bisect.bisect_left(keys, low, lo, hi), bisect.bisect_right(keys, high, lo, hi)
+    value = _to_sql(value, data_type)
+    if op == 'eq':
+        return bisect.bisect_left(keys, value, lo, hi), bisect.bisect_right(keys, value, lo, hi)
+    if op == 'lt':
+        return lo, bisect.bisect_left(keys, value, lo, hi)
+    if op == 'lte':
+        return lo, bisect.bisect_right(keys, value, lo, hi)
+    if op == 'gt':
+        return bisect.bisect_right(keys, value, lo, hi), hi
+    if op == 'gte':
+        return bisect.bisect_left(keys, value, lo, hi), hi
+    raise ValueError('unsupported query operator: %s' % op)
+
+
+class _Transaction(object):
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        self.db.execute('BEGIN IMMEDIATE')
+        return self.db
+
+    def __exit__(self, type, value, traceback):
+        self.db.execute('ROLLBACK' if type else 'COMMIT')
+
+
+def _quote(name):
+    return '"t_%s"' % name.replace('"', '""')
+
+
+def _affinity(data_type):
+    return 'NUMERIC' if data_type == NUMBER else 'TEXT'
+
+
+def _to_sql(value, data_type):
+    if data_type == NUMBER:
+        value = Decimal(str(value))
+        return int(value) if value == value.to_integral_value() else float(value)
+    return value
+
+
+def _project(item, attributes):
+    if attributes:
+        return dict((k, item[k]) for k in attributes if k in item)
+    return item
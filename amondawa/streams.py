@@ -0,0 +1,122 @@
+# Copyright (c) 2013 Daniel Gardner
+# All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""
+Request body streams.
+
+Request bodies are parsed as they are read from the connection instead of
+being buffered first: PayloadStream hashes the body (SHA-256) as it is read,
+for comparison with the signed X-Amz-Content-Sha256 header, and
+iter_json_array yields the elements of a JSON array as they arrive.
+"""
+
+from amondawa.auth import compare_digest
+from hashlib import sha256
+
+import json
+
+CHUNK_SIZE = 64 * 1024
+WHITESPACE = ' \t\n\r'
+
+
+class PayloadStream(object):
+    """A file-like body stream hashing what is read from it.
+    """
+
+    def __init__(self, stream, expected=None):
+        self.stream = stream
+        self.expected = expected
+        self.hash = sha256()
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.hash.update(data)
+        return data
+
+    def verify(self):
+        """Read the rest of the body; return True if its hash is the expected
+           one (or no hash is expected).
+        """
+        while self.read(CHUNK_SIZE):
+            pass
+        return self.expected is None or compare_digest(self.hash.hexdigest(), str(self.expected).lower())
+
+
+def iter_json_array(stream):
+    """Yield the elements of the JSON array read from stream (a single other
+       JSON value is yielded as is).  Only whitespace may follow the array.
+    """
+    decoder = json.JSONDecoder()
+    buf, pos, eof = '', 0, False
+
+    def more(buf, pos, size):
+        if pos:
+            buf, pos = buf[pos:], 0
+        data = stream.read(max(size, CHUNK_SIZE))
+        return buf + data, pos, not data
+
+    def skip(buf, pos, eof):
+        while True:
+            while pos < len(buf) and buf[pos] in WHITESPACE:
+                pos += 1
+            if pos < len(buf) or eof:
+                return buf, pos, eof
+            buf, pos, eof = more(buf, pos, 0)
+
+    buf, pos, eof = skip(buf, pos, eof)
+    if pos == len(buf):
+        raise ValueError('empty body')
+    if buf[pos] != '[':
+        while not eof:
+            buf, pos, eof = more(buf, pos, len(buf))
+        yield json.loads(buf[pos:])
+        return
+
+    pos += 1
+    first = True
+    while True:
+        buf, pos, eof = skip(buf, pos, eof)
+        if pos < len(buf) and buf[pos] == ']':
+            buf, pos, eof = skip(buf, pos + 1, eof)
+            if pos < len(buf):
+                raise ValueError('extra data after ] at %d' % pos)
+            return
+        if not first:
+            if pos == len(buf) or buf[pos] != ',':
+                raise ValueError('expected , or ] at %d' % pos)
+            buf, pos, eof = skip(buf, pos + 1, eof)
+        while True:
+            try:
+                element, end = decoder.raw_decode(buf, pos)
+                # a value not followed by a separator may continue in the next
+                # chunk (e.g. the fraction or exponent of a number)
+                if eof or end < len(buf) and buf[end] in WHITESPACE + ',]':
+                    break
+            except ValueError:
+                if eof:
+                    raise
+            # read at least as much again as is buffered (linear parsing of
+            # large elements)
+            buf, pos, eof = more(buf, pos, len(buf) - pos)
+        yield element
+        pos = end
+        first = False
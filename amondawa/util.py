@@ -28,7 +28,10 @@ from boto.dynamodb.types import get_dynamodb_type, is_str, is_num
 from decimal import Decimal
 from flask import json
 from amondawa import config
+from repoze.lru import LRUCache
+import Queue
 import hashlib
+import sys
 import time
 
 MAGIC = '0xCAFEBABE'
@@ -69,18 +72,18 @@ def now():
     return int(round(time.time() * 1000))
 
 
-def base_time(timestamp):
+def base_time(timestamp, height=COLUMN_HEIGHT):
     """Given absolute time in epoch milliseconds, calculate base time for
-     configured COLUMN_HEIGHT.
+     column height (default: configured COLUMN_HEIGHT).
     """
-    return timestamp - timestamp % COLUMN_HEIGHT
+    return timestamp - timestamp % height
 
 
-def offset_time(timestamp):
+def offset_time(timestamp, height=COLUMN_HEIGHT):
     """Given absolute time in epoch milliseconds, calculate offset time for
-     configured COLUMN_HEIGHT.
+     column height (default: configured COLUMN_HEIGHT).
     """
-    return timestamp % COLUMN_HEIGHT
+    return timestamp % height
 
 
 def to_millis(dt_string):
@@ -95,23 +98,32 @@ def index_hash_key(domain, metric):
     return '|'.join([domain, metric])
 
 
-def index_range_key(timestamp, tags):
-    """Create index range key.
+def index_range_key(timestamp, tags, shards=1, height=COLUMN_HEIGHT):
+    """Create index range key: tbase|tags[|shards[|height]] (the number of
+     shards and the column height are only included if not the default).
     """
-    return '|'.join(map(str, [base_time(timestamp), tag_string(tags)]))
+    key = '|'.join(map(str, [base_time(timestamp, height), tag_string(tags)]))
+    if height != COLUMN_HEIGHT:
+        key = '%s|%d|%d' % (key, shards, height)
+    elif shards > 1:
+        key = '%s|%d' % (key, shards)
+    return key
 
 
-def data_points_key(domain, metric, timestamp, tags):
+def data_points_key(domain, metric, timestamp, tags, shard=0, height=COLUMN_HEIGHT):
     """Create datapoints hash key data.
     """
-    return '|'.join([index_hash_key(domain, metric), index_range_key(timestamp,
-                                                                     tags)])
+    key = '|'.join([index_hash_key(domain, metric), index_range_key(timestamp,
+                                                                    tags, height=height)])
+    if shard:
+        key = '%s|%d' % (key, shard)
+    return key
 
 
-def hdata_points_key(domain, metric, timestamp, tags):
+def hdata_points_key(domain, metric, timestamp, tags, shard=0, height=COLUMN_HEIGHT):
     """Create datapoints hash key.
     """
-    return hdata_points_key_str(data_points_key(domain, metric, timestamp, tags))
+    return hdata_points_key_str(data_points_key(domain, metric, timestamp, tags, shard, height))
 
 #@lru_cache(500)
 def hdata_points_key_str(key_str):
@@ -134,10 +146,10 @@ def offset_range(index_key, start_time, end_time):
     """Given absolute start and end time of query, calculate the start and
      end index for a given bucket (index key).
     """
-    start, end = 0, COLUMN_HEIGHT
-    tbase = index_key.get_tbase()
-    if tbase == base_time(start_time): start = offset_time(start_time)
-    if tbase == base_time(end_time): end = offset_time(end_time)
+    tbase, height = index_key.get_tbase(), index_key.get_height()
+    start, end = 0, height
+    if tbase == base_time(start_time, height): start = offset_time(start_time, height)
+    if tbase == base_time(end_time, height): end = offset_time(end_time, height)
     return start, end
 
 
@@ -155,6 +167,56 @@ def to_multi_map(dicts):
     return ret
 
 
+def resized_cache(cache, size):
+    """A new LRUCache of size entries (at least one) holding the entries of
+       (repoze) LRUCache cache, or as many of them as fit.
+    """
+    resized = LRUCache(max(int(size), 1))
+    with cache.lock:
+        entries = [(key, value) for key, (_, value) in cache.data.items()]
+    for key, value in entries[:resized.size]:
+        resized.put(key, value)
+    return resized
+
+
+class _Failure(object):
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+
+_DONE = object()
+
+
+def iter_concurrently(executor, iterables):
+    """Drain the iterables (given as callables returning iterables) concurrently
+     on executor, yielding items as they arrive.  An exception raised by any
+     iterable is re-raised to the consumer.
+    """
+    queue = Queue.Queue()
+
+    def drain(iterable):
+        try:
+            for item in iterable():
+                queue.put(item)
+        except:
+            queue.put(_Failure(sys.exc_info()))
+        finally:
+            queue.put(_DONE)
+
+    for iterable in iterables:
+        executor.submit(drain, iterable)
+
+    remaining = len(iterables)
+    while remaining:
+        item = queue.get()
+        if item is _DONE:
+            remaining -= 1
+        elif isinstance(item, _Failure):
+            raise item.exc_info[0], item.exc_info[1], item.exc_info[2]
+        else:
+            yield item
+
+
 class IndexKey(object):
     """Wrapper class for parsing and converting index key components.
     """
@@ -163,6 +225,8 @@ class IndexKey(object):
         self.key = key
         self.tbase = self.domain = self.tag_string = self.metric = None
         self.tags = None
+        self.shards = 1
+        self.height = COLUMN_HEIGHT
 
     def get_tags(self):
         """Parses the tags component of index key into a dict.
@@ -183,6 +247,18 @@ class IndexKey(object):
         self.__init()
         return self.tbase
 
+    def get_shards(self):
+        """Returns the number of shards the column is spread over.
+        """
+        self.__init()
+        return self.shards
+
+    def get_height(self):
+        """Returns the height of the column.
+        """
+        self.__init()
+        return self.height
+
     def get_domain(self):
         """Returns the domain component of index key.
         """
@@ -199,8 +275,12 @@ class IndexKey(object):
         """Lazy initialization (parsing) of index key.
         """
         if self.tbase is None:
-            self.tbase, self.tag_string = self.key['tbase_tags'].split('|')
-            self.tbase = int(self.tbase)
+            parts = self.key['tbase_tags'].split('|')
+            self.tbase, self.tag_string = int(parts[0]), parts[1]
+            if len(parts) > 2:
+                self.shards = int(parts[2])
+            if len(parts) > 3:
+                self.height = int(parts[3])
             self.domain, self.metric = self.key['domain_metric'].split('|')
 
     def has_tags(self, tags):
@@ -209,10 +289,10 @@ class IndexKey(object):
         key_tags = self.get_tags()
         return len([k for k in tags if k in key_tags and key_tags[k] in tags[k]]) == len(tags)
 
-    def to_data_points_key(self):
+    def to_data_points_key(self, shard=0):
         """return the datapoints hash key representation of this index key.
         """
         self.__init()
         return hdata_points_key(self.domain, self.metric, self.tbase,
-                                self.get_tags())
+                                self.get_tags(), shard, self.height)
 
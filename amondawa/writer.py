@@ -26,6 +26,8 @@ from concurrent.futures import ThreadPoolExecutor
 from threading import Lock, Thread
 import sched, time, traceback
 
+per_worker = config.per_worker
+subscribe = config.subscribe
 config = config.get()
 
 
@@ -60,8 +62,17 @@ class ScheduledIOPool(Thread):
         return self.scheduler.cancel(event)
 
     def schedule(self, *args):
-        return self.scheduler.enter(self.delay, 1,
-                                    self.thread_pool.submit, args)
+        return self.scheduler.enter(self.delay, 1, self.submit, args)
+
+    def submit(self, *args):
+        return self.thread_pool.submit(*args)
+
+    def resize(self, workers):
+        """Replace the worker pool (running flushes finish in the previous
+           one).
+        """
+        self.thread_pool, thread_pool = ThreadPoolExecutor(max_workers=workers), self.thread_pool
+        thread_pool.shutdown(wait=False)
 
 
 class TimedBatchTable(object):
@@ -69,7 +80,7 @@ class TimedBatchTable(object):
      flushed when buffer is full OR DELAY timer expires.
     """
 
-    io_pool = ScheduledIOPool(int(config.MT_WRITERS), int(config.MT_WRITE_DELAY))
+    io_pool = ScheduledIOPool(per_worker(int(config.MT_WRITERS)), int(config.MT_WRITE_DELAY))
     io_pool.start()
 
     #TODO where is this called?
@@ -77,6 +88,15 @@ class TimedBatchTable(object):
     def shutdown():
         TimedBatchTable.io_pool.shutdown()
 
+    @staticmethod
+    def configure(previous, current):
+        """Apply a new configuration to the IO pool.
+        """
+        io_pool = TimedBatchTable.io_pool
+        io_pool.delay = int(current.MT_WRITE_DELAY)
+        if per_worker(int(current.MT_WRITERS)) != per_worker(int(previous.MT_WRITERS)):
+            io_pool.resize(per_worker(int(current.MT_WRITERS)))
+
     def __init__(self, batch_table):
         self.lock = Lock()  # lock for datastores dict
         self.batch_table = batch_table
@@ -103,3 +123,6 @@ class TimedBatchTable(object):
         except:       # TODO log
             print "Unexpected error flushing datapoints:"
             traceback.print_exc()
+
+
+subscribe(TimedBatchTable.configure, config)
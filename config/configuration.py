@@ -33,7 +33,8 @@ configuration = {
                                         #   datapoints write buffer
  'cache_datapoints':      400,          # datapoints LRU cache size
  'cache_query_index_key': 400,          # index_key (query) LRU cache size
- 'cache_write_index_key': 400,          # index_key (write) LRU cache size
+ 'cache_write_index_key': 400,          # series LRU cache size of the shard and height policies
+ 'cache_index_columns':   2,            # recent columns (per height) whose written index keys are remembered
  'tp_write_datapoints':   160,          # dynamo datapoints table write throughput
  'tp_read_datapoints':    80,           # dynamo datapoints table read throughput
  'tp_write_index_key':    160,          # dynamo index key table write throughput
@@ -42,4 +43,34 @@ configuration = {
  'mx_create_next_pct':    15,           # cutoff time in percent remaining for creating next datapoints tables
  'mx_turndown_min':       2,            # cutoff time in minutes expired for turning down write throughput
  'mx_turndown_pct':       20,           # cutoff time in percent expired for turning down write throughput
+ 'mx_status_ttl':         60,           # seconds to cache table status (describe)
+ 'mx_compact':            1,            # compact turned down blocks into compressed chunks (0 disables)
+ 'mx_compact_columns':    50,           # columns compacted per maintenance run
+ 'mx_compact_write':      10,           # compact table write throughput while compacting
+ 'mx_config_refresh':     30,           # seconds between refreshes of the configuration by servers (see below)
+ 'mx_credentials_refresh': 60,          # seconds between refreshes of the credentials (key changes need no restart)
+ 'store_hot_columns':     2,            # recent columns of each series kept in the hot tier (AMDW_HOT_TIER_DIR)
+ 'store_shard_rate':      200,          # datapoints per second per hash key before a series' columns are sharded
+ 'store_max_shards':      16,           # maximum hash keys (shards) a series' column is spread over
+ 'store_shards':          {},           # fixed shard counts by metric name e.g. {'cpu.load': 4}
+ 'store_height_classes':  [1*MIN, 5*MIN, 20*MIN], # column heights metrics may use (each must divide the block size)
+ 'store_column_points':   2000,         # target datapoints per series column when choosing a metric's height
+ 'store_column_heights':  {},           # fixed column heights by metric name e.g. {'cpu.load': 1*MIN}
+ 'store_archive_history': 0,            # milliseconds of expired blocks kept in the archive (0: keep all, AMDW_ARCHIVE_DIR)
+ 'store_filter_fp':       0.01,         # false positive rate of the series bloom filters of turned down blocks
+ 'store_filter_bytes':    32768,        # maximum size of a block's bloom filter (0: no filters)
+ 'ad_read_rate':          0,            # queries per second per domain on a node (0: unlimited)
+ 'ad_read_concurrency':   0,            # queries in progress per domain on a node (0: unlimited)
+ 'ad_write_rate':         0,            # datapoints written per second per domain on a node (0: unlimited)
+ 'ad_write_concurrency':  0,            # write requests in progress per domain on a node (0: unlimited)
+ 'ad_domains':            {},           # limits and fair queuing weights by domain e.g. {'ops': {'read_rate': 5, 'weight': 2}}
+ 'tp_autoscale':          1,            # scale block table throughput to consumed capacity (0 disables)
+ 'tp_scale_interval':     60,           # seconds between throughput scaling decisions
+ 'tp_scale_window':       5,            # minutes of consumed capacity considered when scaling
+ 'tp_target_pct':         70,           # target utilization in percent of provisioned throughput
+ 'tp_min_read':           1,            # minimum read throughput of a block table
+ 'tp_max_read':           1000,         # maximum read throughput of a block table
+ 'tp_min_write':          2,            # minimum write throughput of a block table being written to
+ 'tp_max_write':          1000,         # maximum write throughput of a block table
+ 'tp_max_decreases':      4,            # throughput decreases allowed per table per (UTC) day
 }
@@ -0,0 +1,191 @@
+# Copyright (c) 2013 Daniel Gardner
+# All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""
+Offline benchmarks of the datastore against the memory backend (see bin/bench):
+ingest rate, query latency by callback and series count, key functions and
+JSON encoding/decoding.  Results are saved as JSON for comparison between
+runs.
+"""
+
+from amondawa import formats, streams, util
+from amondawa.datastore import DataPoint, DataPointSet, QueryMetric
+from amondawa.query import QueryScope
+from cStringIO import StringIO
+from flask import json
+import platform, sys, time
+
+DOMAIN = 'bench'
+
+# query callbacks measured: metric query options (see QueryMetric)
+QUERIES = {
+  'simple': {},
+  'resample': {'downsample': {'name': 'avg', 'sampling': {'value': 10, 'unit': 'seconds'}}},
+  'aggregate': {'aggregate': 'sum'},
+  'aggregate_resample': {'aggregate': 'sum',
+                         'downsample': {'name': 'max', 'sampling': {'value': 10, 'unit': 'seconds'}}}
+}
+
+
+def timed(fn, repeat):
+  """Run fn repeat times; return the best time (seconds) of a run.
+  """
+  best = None
+  for _ in range(repeat):
+    start = time.time()
+    fn()
+    elapsed = time.time() - start
+    best = elapsed if best is None else min(best, elapsed)
+  return best
+
+
+class Benchmarks(object):
+  """Benchmarks of a datastore (with a current block) writing series of
+   points each to metric.
+  """
+  def __init__(self, datastore, points=1000, repeat=5):
+    self.datastore = datastore
+    self.points = points
+    self.repeat = repeat
+    self.results = {}
+    self.written = set()    # metrics written
+
+  def record(self, name, value, unit, higher_is_better):
+    self.results[name] = {'value': value, 'unit': unit, 'higher_is_better': higher_is_better}
+    print '%-40s %12.3f %s' % (name, value, unit)
+    sys.stdout.flush()
+
+  def flush(self):
+    for block in self.datastore.dynamodb.blocks.blocks:
+      if block.dp_writer:
+        block.dp_writer.flush()
+
+  def write_series(self, metric, count):
+    """Write count series of points each (timestamps within the current
+       block); return the time it took.
+    """
+    block = self.datastore.dynamodb.blocks.current()
+    self.start = max(block.tbase, util.now() - 10 * 60 * 1000)
+    step = max(1, (util.now() - self.start) // self.points)
+    self.written.add(metric)
+    start = time.time()
+    for s in range(count):
+      dps = DataPointSet(metric, {'host': 'h%d' % s, 'dc': 'dc%d' % (s % 4)},
+                         [DataPoint(self.start + i * step, float(i % 97)) for i in range(self.points)])
+      self.datastore.put_data_points(dps, DOMAIN)
+    self.flush()
+    return time.time() - start
+
+  def ingest(self, series):
+    elapsed = self.write_series('ingest', series)
+    self.record('ingest.points_per_sec', series * self.points / elapsed, 'points/s', True)
+
+  def run_query(self, metric, name):
+    """Query metric with the options of QUERIES[name]; return the result.
+    """
+    request = {'start_absolute': self.start, 'metrics': [dict(QUERIES[name], name=metric, tags={})]}
+    query = QueryMetric.from_json_object(request)[0]
+    return self.datastore.query_database(query, QueryMetric.create_callback(query),
+                                         DOMAIN, QueryScope(domain=DOMAIN)).get_result()
+
+  def query(self, series_counts):
+    for count in series_counts:
+      metric = 'query%d' % count
+      self.write_series(metric, count)
+      for name in sorted(QUERIES):
+        elapsed = timed(lambda: self.run_query(metric, name), self.repeat)
+        self.record('query.%s.series_%d' % (name, count), 1000 * elapsed, 'ms', False)
+
+  def keys(self, calls=20000):
+    tags = {'host': 'h1', 'dc': 'dc1', 'service': 'api'}
+    now = util.now()
+    functions = [
+      ('data_points_key', lambda: util.data_points_key(DOMAIN, 'cpu', now, tags)),
+      ('hdata_points_key', lambda: util.hdata_points_key(DOMAIN, 'cpu', now, tags)),
+      ('index_range_key', lambda: util.index_range_key(now, tags)),
+      ('tag_string', lambda: util.tag_string(tags)),
+    ]
+    for name, fn in functions:
+      elapsed = timed(lambda: [fn() for _ in xrange(calls)], self.repeat)
+      self.record('keys.%s' % name, 1e6 * elapsed / calls, 'us', False)
+
+  def json(self, series=10):
+    now = util.now()
+    body = json.dumps([{'name': 'cpu', 'tags': {'host': 'h%d' % s},
+                        'datapoints': [[now + i, i * .5] for i in range(self.points)]}
+                       for s in range(series)])
+    points = series * self.points
+
+    def decode():
+      DataPointSet.from_json_object(streams.iter_json_array(StringIO(body)))
+    self.record('json.decode_datapoints', points / timed(decode, self.repeat), 'points/s', True)
+
+    # encode the results of a simple query
+    metric = 'query%d' % series
+    if metric not in self.written:
+      self.write_series(metric, series)
+    result = self.run_query(metric, 'simple')
+    queries = [{'sample_size': result.sample_size, 'results': result.results}]
+    for mimetype, name in ((formats.JSON, 'json'), (formats.COLUMNAR_JSON, 'columnar'),
+                           (formats.BINARY, 'binary')):
+      elapsed = timed(lambda: formats.encode(queries, mimetype), self.repeat)
+      self.record('json.encode_%s' % name, result.sample_size / elapsed, 'points/s', True)
+
+  def run(self, ingest_series, series_counts):
+    self.ingest(ingest_series)
+    self.query(series_counts)
+    self.keys()
+    self.json()
+    return self.results
+
+
+def save(results, path, settings):
+  """Save results (and the settings and platform they were measured with).
+  """
+  with open(path, 'w') as f:
+    json.dump({'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+               'platform': platform.platform(), 'settings': settings, 'results': results},
+              f, indent=2, sort_keys=True)
+
+
+def compare(results, path, settings, threshold=10.):
+  """Print the change of each result from the results saved in path; return
+     the names of results worse by more than threshold percent.
+  """
+  with open(path) as f:
+    saved = json.load(f)
+  if saved['settings'] != settings:
+    print 'warning: %s was measured with other settings: %s' % (path, saved['settings'])
+  baseline = saved['results']
+  regressions = []
+  for name in sorted(results):
+    if name not in baseline:
+      continue
+    before, after = baseline[name]['value'], results[name]['value']
+    change = 100. * (after - before) / before if before else 0.
+    worse = -change if results[name]['higher_is_better'] else change
+    flag = ''
+    if worse > threshold:
+      regressions.append(name)
+      flag = '  REGRESSION'
+    print '%-40s %12.3f -> %12.3f %s (%+.1f%%)%s' % (name, before, after, results[name]['unit'], change, flag)
+  return regressions
@@ -97,9 +97,10 @@ class HTTPWriter(MetricWriter):
     def send(self):
         try:
             # TODO: use protocol (http/https)
+            body = simplejson.dumps(self.dps)
             headers = auth_add_auth1(self.access_key_id, self.secret_access_key,
-                         'POST', self.host, self.port, self.path, {'Content-Type': 'application/json'})
-            self.connection.request('POST', self.path, simplejson.dumps(self.dps), headers)
+                         'POST', self.host, self.port, self.path, {'Content-Type': 'application/json'}, body=body)
+            self.connection.request('POST', self.path, body, headers)
             response = self.connection.getresponse()
             response.read()
             self._count_response(response)
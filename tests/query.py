@@ -20,6 +20,7 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
 # IN THE SOFTWARE.
 
+from amondawa import formats
 from amondawa.auth import auth_add_auth1
 import simplejson, httplib
 from threading import Thread
@@ -35,13 +36,25 @@ class QueryRunner(Thread):
     self.port = port
     self._connect()
     
-  def perform_query(self, query):
-    return self._perform_query(simplejson.dumps(query))
+  def perform_query(self, query, mimetype=formats.JSON):
+    """Perform query asking for the response in the given layout (see
+       amondawa.formats).
+    """
+    return self._perform_query(simplejson.dumps(query), mimetype)
 
-  def _perform_query(self, query):
+  def decode(self, response):
+    """Read and decode a query response according to its Content-Type.
+    """
+    body = response.read()
+    if response.getheader('content-type', '').startswith(formats.BINARY):
+      return formats.decode_binary(body)
+    return simplejson.loads(body)
+
+  def _perform_query(self, query, mimetype=formats.JSON):
     try:
       headers = auth_add_auth1(self.access_key_id, self.secret_access_key,
-       'POST', self.host, self.port, QueryRunner.PATH, {'Content-Type': 'application/json'})
+       'POST', self.host, self.port, QueryRunner.PATH, {'Content-Type': 'application/json'}, body=query)
+      headers['Accept'] = mimetype
       self.connection.request('POST', QueryRunner.PATH, query, headers)
       return self.connection.getresponse()
     except:
@@ -0,0 +1,161 @@
+# Copyright (c) 2013 Daniel Gardner
+# All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""
+Smoke test of asynchronous (gevent) serving: signed writes and queries to
+bin/serve --gevent against a local backend in a temporary directory (skipped
+without gevent; run with python -m unittest tests.test_gevent).
+"""
+
+import httplib
+import imp
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+try:
+  imp.find_module('gevent')
+  GEVENT = True
+except ImportError:
+  GEVENT = False
+
+
+def free_port():
+  sock = socket.socket()
+  sock.bind(('127.0.0.1', 0))
+  port = sock.getsockname()[1]
+  sock.close()
+  return port
+
+
+# test credential, written before the server first loads credentials
+ACCESS_KEY_ID, SECRET_ACCESS_KEY = 'SMOKETESTKEY', 'smoke-test-secret'
+
+ADD_CREDENTIAL = """
+import amondawa
+from amondawa import config
+amondawa.connect(config.REGION).table(config.table_name('credentials')).put_item(data={
+    'access_key_id': %r, 'secret_access_key': %r,
+    'permissions': set(['smoke:r', 'smoke:w']), 'state': 'ACTIVE'})
+""" % (ACCESS_KEY_ID, SECRET_ACCESS_KEY)
+
+# amondawa.auth imports amondawa.config (which connects to the backend), so
+# requests are signed by a child process in the test environment
+SIGN = """
+import json, sys
+from amondawa.auth import auth_add_auth1
+method, port, path, body = json.load(sys.stdin)
+print json.dumps(auth_add_auth1(%r, %r, method, '127.0.0.1', port, path,
+                                {'Content-Type': 'application/json'}, body=body))
+""" % (ACCESS_KEY_ID, SECRET_ACCESS_KEY)
+
+
+@unittest.skipUnless(GEVENT, 'gevent is not installed')
+class GeventServeTest(unittest.TestCase):
+  def setUp(self):
+    self.data_dir = tempfile.mkdtemp()
+    self.port = free_port()
+    path = [ROOT] + filter(None, [os.environ.get('PYTHONPATH')])
+    self.env = dict(os.environ, AMDW_BACKEND='local', AMDW_DATA_DIR=self.data_dir,
+                    AMDW_MAINTENANCE_LOCK=os.path.join(self.data_dir, 'maintenance.lock'),
+                    PYTHONPATH=os.pathsep.join(path))
+    self.run_script('configure', 'config/configuration.py')
+    self.run_script('create_schema')
+    self.run_script('ac', 'create_table')
+    self.assertEqual(subprocess.call([sys.executable, '-c', ADD_CREDENTIAL], cwd=ROOT, env=self.env), 0)
+    self.server = subprocess.Popen([sys.executable, 'bin/serve', '--gevent', '--workers', '1',
+                                    '--host', '127.0.0.1', '--port', str(self.port)],
+                                   cwd=ROOT, env=self.env)
+
+  def tearDown(self):
+    self.server.terminate()
+    self.server.wait()
+    shutil.rmtree(self.data_dir, ignore_errors=True)
+
+  def run_script(self, *args):
+    script = subprocess.Popen([sys.executable, os.path.join('bin', args[0])] + list(args[1:]),
+                              cwd=ROOT, env=self.env, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    script.communicate('Y\n')
+    self.assertEqual(script.returncode, 0)
+
+  def sign(self, method, path, body):
+    signer = subprocess.Popen([sys.executable, '-c', SIGN], cwd=ROOT, env=self.env,
+                              stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    headers = signer.communicate(json.dumps([method, self.port, path, body]))[0]
+    self.assertEqual(signer.returncode, 0)
+    return json.loads(headers.splitlines()[-1])
+
+  def request(self, method, path, body=None, sign=True, timeout=60):
+    """(status, body) of the request, once the worker accepts connections.
+    """
+    headers = self.sign(method, path, body) if sign else {}
+    deadline = time.time() + timeout
+    while True:
+      try:
+        connection = httplib.HTTPConnection('127.0.0.1', self.port, timeout=10)
+        connection.request(method, path, body, headers)
+        response = connection.getresponse()
+        return response.status, response.read()
+      except socket.error:
+        if time.time() > deadline or self.server.poll() is not None:
+          raise
+        time.sleep(.5)
+
+  def test_serves_requests(self):
+    # unsigned: refused by authentication
+    self.assertEqual(self.request('GET', '/api/v1/smoke/metricnames', sign=False)[0], 403)
+
+    # signed write, read back through the same worker
+    now = int(time.time() * 1000)
+    datapoints = [[now - 2000, 1], [now - 1000, 2]]
+    body = json.dumps([{'name': 'smoke.metric', 'tags': {'host': 'a'},
+                        'datapoints': datapoints}])
+    query = json.dumps({'start_absolute': now - 60000,
+                        'metrics': [{'name': 'smoke.metric', 'tags': {'host': ['a']}}]})
+
+    # the first maintenance run creates the current block (writes before it
+    # are dropped) and batched writes are flushed after a delay: write again
+    # (same points) until they are read back
+    deadline = time.time() + 60
+    while True:
+      self.assertEqual(self.request('POST', '/api/v1/smoke/datapoints', body)[0], 204)
+      time.sleep(3)
+      status, response = self.request('POST', '/api/v1/smoke/datapoints/query', query)
+      self.assertEqual(status, 200)
+      results = json.loads(response)['queries'][0]['results']
+      values = [value for result in results for value in result['values']]
+      if values or time.time() > deadline:
+        break
+    self.assertEqual(values, datapoints)
+    self.assertIsNone(self.server.poll())
+
+
+if __name__ == '__main__':
+  unittest.main()
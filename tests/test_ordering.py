@@ -0,0 +1,199 @@
+# Copyright (c) 2013 Daniel Gardner
+# All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""
+Query ordering of the storage backends, of compaction and of queries (run
+with python -m unittest tests.test_ordering).
+"""
+
+import os
+os.environ['AMDW_BACKEND'] = 'memory'
+
+from amondawa import config
+
+execfile('config/configuration.py')
+config.write(configuration)
+
+# modules reading the configuration at import load after it is written
+from amondawa import compaction, util
+from amondawa.datapoints_schema import BLOCK_SIZE
+from amondawa.datastore import Datastore, QueryMetric
+from amondawa.schema import Schema
+from amondawa.storage import DynamoDBTable
+import amondawa
+import itertools
+import unittest
+
+
+datastore = None
+
+
+def setUpModule():
+  global datastore
+  connection = amondawa.connect(config.REGION)
+  try:
+    Schema.create(connection)
+  except ValueError:    # created by another test module (shared memory backend)
+    pass
+  datastore = Datastore(connection)
+  datastore.dynamodb.blocks.stop_maintenance()
+
+
+class RecordingConnection(object):
+  """Records the arguments of DynamoDB query requests.
+  """
+
+  def __init__(self):
+    self.requests = []
+
+  def query(self, table_name, **kwargs):
+    self.requests.append(kwargs)
+    return {'Items': [], 'Count': 0}
+
+
+class InvertedTable(object):
+  """Table returning query results in the opposite order (as boto's legacy
+     Table.query does).
+  """
+
+  def __init__(self, table):
+    self.table = table
+
+  def __getattr__(self, name):
+    return getattr(self.table, name)
+
+  def query(self, reverse=False, **kwargs):
+    return self.table.query(reverse=not reverse, **kwargs)
+
+
+class RecordingCallback(object):
+  """Query callback recording the datapoints of each datapoint set.
+  """
+
+  def __init__(self):
+    self.sets = []
+
+  def start_datapoint_set(self, tags):
+    self.sets.append([])
+
+  def add_data_point(self, timestamp, value):
+    self.sets[-1].append((timestamp, int(value)))
+
+  def end_datapoint_set(self):
+    pass
+
+  def finish(self):
+    pass
+
+
+class DynamoDBOrderingTest(unittest.TestCase):
+  def scan_index_forward(self, **kwargs):
+    connection = RecordingConnection()
+    list(DynamoDBTable('ordering', connection=connection).query(key__eq='k', **kwargs))
+    return connection.requests[0].get('scan_index_forward', True)
+
+  def test_ascending(self):
+    self.assertTrue(self.scan_index_forward())
+
+  def test_reverse_descending(self):
+    self.assertFalse(self.scan_index_forward(reverse=True))
+
+
+class CompactionOrderingTest(unittest.TestCase):
+  POINTS = 2 * compaction.CHUNK_POINTS + 500
+
+  def setUp(self):
+    self.block = datastore.dynamodb.blocks.create_current()
+    self.block.create_tables()
+    self.start = util.base_time(util.now())
+    self.points = [(self.start + 10 * i, i) for i in range(self.POINTS)]
+    self.block.store_column('ordering', 'test.metric', {'host': 'a'}, self.points)
+    self.index_key = self.block.index_keys().next()
+    self.key = self.index_key.to_data_points_key(0)
+
+  def tearDown(self):
+    self.block.delete_tables()
+
+  def compact(self):
+    self.block.create_compact_table()
+    self.block.compact_column(self.key)
+    self.block.item['compacted'] = util.now()
+
+  def values(self, start, end):
+    return [int(item['value']) for item in self.block.query_datapoints(self.index_key, start, end)]
+
+  def test_read_column_ascending_whatever_the_backend(self):
+    self.block.data_points_table = InvertedTable(self.block.data_points_table)
+    self.assertEqual([int(value) for _, value in self.block.read_column(self.key)], range(self.POINTS))
+
+  def test_compacted_chunks_start_at_their_first_point(self):
+    self.compact()
+    chunks = list(self.block.compact_table.query(domain_metric_tbase_tags__eq=self.key))
+    self.assertEqual([int(chunk['chunk']) for chunk in chunks],
+                     [util.offset_time(self.points[i][0]) for i in range(0, self.POINTS, compaction.CHUNK_POINTS)])
+
+  def test_query_datapoints_ascending(self):
+    self.assertEqual(self.values(self.start + 10 * 1500, self.start + 10 * 2200), range(1500, 2201))
+
+  def test_query_compacted_returns_every_point_ascending(self):
+    self.compact()
+    self.assertEqual(self.values(self.start, self.start + 10 * self.POINTS), range(self.POINTS))
+    self.assertEqual(self.values(self.start + 10 * 1500, self.start + 10 * 2200), range(1500, 2201))
+
+
+class QueryOrderingTest(unittest.TestCase):
+  STEP = 30 * 1000
+
+  def setUp(self):
+    # the previous block: its columns are all in the past
+    self.block = datastore.dynamodb.blocks.create_block(util.now() - BLOCK_SIZE)
+    self.block.create_tables()
+    self.start = self.block.tbase + util.COLUMN_HEIGHT
+    self.points = [(self.start + i * self.STEP, i) for i in range(2 * util.COLUMN_HEIGHT / self.STEP)]
+    for _, column in itertools.groupby(self.points, lambda point: util.base_time(point[0])):
+      self.block.store_column('ordering', 'query.metric', {'host': 'a'}, list(column))
+
+  def tearDown(self):
+    self.block.delete_tables()
+
+  def query(self):
+    request = {'start_absolute': self.start, 'end_absolute': self.points[-1][0],
+               'metrics': [{'name': 'query.metric', 'tags': {}}]}
+    query = QueryMetric.from_json_object(request)[0]
+    callback = RecordingCallback()
+    datastore.query_database(query, callback, 'ordering').get_result()
+    return callback.sets
+
+  def test_ascending_across_columns(self):
+    self.assertEqual(len(set(util.base_time(timestamp) for timestamp, _ in self.points)), 2)
+    self.assertEqual(self.query(), [self.points])
+
+  def test_compacted_ascending_across_columns(self):
+    self.block.create_compact_table()
+    for key in self.block.column_keys(self.block.index_keys()):
+      self.block.compact_column(key)
+    self.block.item['compacted'] = util.now()
+    self.assertEqual(self.query(), [self.points])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,146 @@
+# Copyright (c) 2013 Daniel Gardner
+# All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+"""
+Streamed request bodies: JSON array parsing and payload hash checks (run
+with python -m unittest tests.test_streams).
+"""
+
+import os
+os.environ['AMDW_BACKEND'] = 'memory'
+
+from amondawa import config
+
+execfile('config/configuration.py')
+config.write(configuration)
+
+# modules reading the configuration at import load after it is written
+from amondawa import auth, streams
+from amondawa.schema import Schema
+from boto.dynamodb2.fields import HashKey
+from hashlib import sha256
+import amondawa
+import json
+import unittest
+
+
+http = None
+
+
+def setUpModule():
+  global http
+  connection = amondawa.connect(config.REGION)
+  try:
+    Schema.create(connection)
+  except ValueError:    # created by another test module (shared memory backend)
+    pass
+  try:
+    connection.create_table(config.table_name('credentials'), schema=[HashKey('access_key_id')],
+                            throughput={'read': 1, 'write': 1})
+  except ValueError:
+    pass
+  from amondawa import http, server_auth
+  http.datastore.dynamodb.blocks.stop_maintenance()
+  server_auth.credentials_table.put_item(data={'access_key_id': 'AK', 'secret_access_key': 'SECRET',
+                                               'permissions': set(['d:r', 'd:w']), 'state': 'ACTIVE'},
+                                         overwrite=True)
+  server_auth.amdw_credentials.refresh()
+
+
+class ChunkedStream(object):
+  """Stream returning at most size bytes per read.
+  """
+
+  def __init__(self, data, size):
+    self.data = data
+    self.size = size
+
+  def read(self, size=-1):
+    data, self.data = self.data[:self.size], self.data[self.size:]
+    return data
+
+
+def parse(data, size=64 * 1024):
+  return list(streams.iter_json_array(ChunkedStream(data, size)))
+
+
+class IterJsonArrayTest(unittest.TestCase):
+  def test_elements_split_across_chunks(self):
+    data = ' [12345, -6.5e3, "a,]\\" b", {"k": [1, 2]}, [], true, null , 7 ] \n'
+    for size in range(1, len(data) + 1):
+      self.assertEqual(parse(data, size), json.loads(data))
+
+  def test_empty_array(self):
+    self.assertEqual(parse('[]'), [])
+    self.assertEqual(parse(' [ \n ] '), [])
+
+  def test_empty_body(self):
+    for data in ('', ' \n\t'):
+      self.assertRaises(ValueError, parse, data)
+
+  def test_non_array_body(self):
+    self.assertEqual(parse('{"a": 1}', 3), [{'a': 1}])
+    self.assertEqual(parse(' 42 '), [42])
+    self.assertRaises(ValueError, parse, '{"a": 1} x')
+
+  def test_extra_data_after_array(self):
+    for data in ('[1]xyz', '[1] ]', '[1][2]', '[] x'):
+      for size in (1, 64 * 1024):
+        self.assertRaises(ValueError, parse, data, size)
+
+  def test_malformed_separators(self):
+    for data in ('[1 2]', '[1,,2]', '[,1]', '[1,]', '[1;2]', '[1', '[1,', '['):
+      for size in (1, 64 * 1024):
+        self.assertRaises(ValueError, parse, data, size)
+
+
+class PayloadStreamTest(unittest.TestCase):
+  body = '[{"name": "m", "tags": {"h": "a"}, "datapoints": [[1, 2]]}]'
+
+  def test_verify_reads_rest_of_body(self):
+    stream = streams.PayloadStream(ChunkedStream(self.body, 5), sha256(self.body).hexdigest().upper())
+    stream.read(5)
+    self.assertTrue(stream.verify())
+
+  def test_verify_mismatch(self):
+    stream = streams.PayloadStream(ChunkedStream(self.body, 5), sha256(self.body + ' ').hexdigest())
+    list(streams.iter_json_array(stream))
+    self.assertFalse(stream.verify())
+
+  def test_verify_without_expected_hash(self):
+    self.assertTrue(streams.PayloadStream(ChunkedStream(self.body, 5)).verify())
+
+  def post(self, body, signed_body):
+    path = '/api/v1/d/datapoints'
+    headers = auth.auth_add_auth1('AK', 'SECRET', 'POST', 'localhost', 80, path,
+                                  {'Content-Type': 'application/json'}, body=signed_body)
+    return http.app.test_client().post(path, data=body, headers=headers).status_code
+
+  def test_payload_hash_mismatch_forbidden(self):
+    self.assertEqual(self.post(self.body, self.body), 204)
+    self.assertEqual(self.post(self.body, self.body.replace('2', '3')), 403)
+
+  def test_malformed_body_bad_request(self):
+    self.assertEqual(self.post('[1]xyz', '[1]xyz'), 400)
+
+
+if __name__ == '__main__':
+  unittest.main()